@@ -0,0 +1,334 @@
+'''
+PIPELINE BENCHMARK! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Generates synthetic movies (see synthetic_movie.py) for every combination of frame count, resolution, cell count and bit
+depth, runs every stage of the analysis pipeline on them and measures time and peak memory per stage:
+	preprocessing, motion_correction, projection (std), labeling (vs. skimage's measure.label, on the binary frame and on
+	random masks of 10/30/50 % density and diagonal lines), ccl (method='ccl'),
+	segmentation (method='segmentation'), single_cell_traces, percentile_baseline, filter_traces (bandpass),
+	kalman_smoothing, event_detection, plot_cell_traces, draw_cell_traces (rendering), save_pdf, save_txt, save_results,
+	save_tiffs
+Every measurement is appended as one JSON line to a history file. Each stage is compared to the last run with the same
+parameters on the same machine, '--fail-on-regression' turns slowdowns beyond the tolerance into exit code 1.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+
+usage: python benchmarks/benchmark_pipeline.py [--grid quick|default|full] [--frames 1000 10000] [--size 2048]
+	[--cells 1000] [--bit-depth 16] [--history benchmarks/pipeline_history.jsonl] [--fail-on-regression]
+
+'--grid full' covers the real scale of our recordings (2048 x 2048 pixels, 10000 frames, 1000 cells). The largest
+movies need ~80 GB of free disk space in '--work-directory', they are deleted after each combination.
+'''
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+os.environ.setdefault("CALCIUM_ANALYZER_BACKEND", "Agg") # no windows are opened during benchmarks
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmark_directory, "..", "sample"))
+import numpy as np
+import matplotlib.pyplot as plt
+import helpers as hlp # imports helpers.py
+from synthetic_movie import SyntheticMovie
+
+try:
+	import tracemalloc # python >= 3.4, numpy reports its allocations to it
+except ImportError:
+	tracemalloc = None
+
+default_history_path = os.path.join(benchmark_directory, "pipeline_history.jsonl")
+
+# frames, size (height = width), cells, bit depth; every combination of the values is benchmarked
+grids = dict(
+	quick=dict(frames=[200], size=[256], cells=[20], bit_depth=[8]),
+	default=dict(frames=[1000], size=[512, 1024], cells=[100], bit_depth=[8, 16]),
+	full=dict(frames=[1000, 10000], size=[512, 2048], cells=[100, 1000], bit_depth=[8, 16]),
+	)
+
+class StageTimer():
+	'''
+	Context manager that measures the wall time and the peak of newly allocated memory (in MB, tracemalloc) of a block.
+	Without tracemalloc (python 2.7) 'peak_mb' is None. An exception raised in the block is not propagated but stored
+	as 'error' (e.g. "ValueError: ..."), so a single failing stage doesn't abort a whole benchmark run.
+	'''
+	def __enter__(self):
+		self.error = None
+		if tracemalloc is not None:
+			tracemalloc.start()
+		self.timer_start = timeit.default_timer()
+		return(self)
+
+	def __exit__(self, exception_type, exception, trace):
+		self.seconds = timeit.default_timer() - self.timer_start
+		self.peak_mb = None
+		if tracemalloc is not None:
+			self.peak_mb = tracemalloc.get_traced_memory()[1] / 1024.0**2
+			tracemalloc.stop()
+		if exception_type is None or not issubclass(exception_type, Exception):
+			return(False) # no error, or KeyboardInterrupt and SystemExit
+		self.error = "{}: {}".format(exception_type.__name__, exception)
+		return(True)
+
+def run_pipeline(movie_path, save_directory, movie):
+	'''
+	Runs every stage of the pipeline once on 'movie_path' and returns a list of (stage, seconds, peak_mb, info) tuples.
+	The stages are called the way sample.py and batch.py call them. A failing stage is returned with an 'error' in its
+	info, stages that depend on it are skipped (seconds is None) and the remaining stages still run.
+	'''
+	results = list()
+	failed = set()
+	def record(stage, timer, **info):
+		if timer.error is not None:
+			failed.add(stage)
+			info = dict(error=timer.error)
+		results.append((stage, timer.seconds, timer.peak_mb, info))
+		print("  {:<20} {:>9.3f} sec {:>10} MB {}".format(stage, timer.seconds,
+			"-" if timer.peak_mb is None else "{:.1f}".format(timer.peak_mb), info if info else ""))
+
+	def ready(stage, *required_stages):
+		# returns False (and records the stage as skipped) if a stage it depends on failed
+		missing = [required for required in required_stages if required in failed]
+		if missing:
+			failed.add(stage)
+			results.append((stage, None, None, dict(error="skipped, {} failed".format(", ".join(missing)))))
+			print("  {:<20} skipped, {} failed".format(stage, ", ".join(missing)))
+		return(not missing)
+
+	# import the lazily loaded modules up front, the first stage that uses them should not pay for the import
+	for module in (hlp.measure, hlp.filters, hlp.skimage_segmentation, hlp.ndi):
+		dir(module)
+
+	hlp.movie_cache.clear()
+	reader = hlp.movie_cache.reader(movie_path)
+	selected_image = reader.read_frame(0)
+	pixel_threshold = hlp.PixelHistogram(image=selected_image).otsuThreshold()
+
+	with StageTimer() as timer:
+		figure = hlp.preprocessingFunction(image_number=1, cutoff1=pixel_threshold // 2, cutoff2=pixel_threshold,
+			file_path=movie_path, save_directory=save_directory, save_tiff_checkbox=0, save_pdf_checkbox=0)
+		plt.close(figure)
+	record("preprocessing", timer)
+
+	with StageTimer() as timer:
+		hlp.MotionCorrection(movie_path, cache_directory=os.path.join(save_directory, "cache"))
+	record("motion_correction", timer, frames_per_second=round(movie.n_frames / timer.seconds, 1))
+
+	with StageTimer() as timer: # the most expensive of the streaming projections
+		hlp.project_movie(reader, mode="std")
+	record("projection", timer, frames_per_second=round(movie.n_frames / timer.seconds, 1))
+
+	# the labeling step of 'ccl' on its own (labels and region table), compared with skimage's measure.label (labels
+	# only) on the same binary image; random pixels and diagonal lines are the worst cases (many tiny components)
+	binary_image = selected_image >= pixel_threshold
+	random_values = np.random.RandomState(0).random_sample(binary_image.shape)
+	binary_images = [("labeling", binary_image)]
+	binary_images += [("labeling_random_{}".format(density), random_values < density / 100.0) for density in (10, 30, 50)]
+	binary_images.append(("labeling_diagonal", np.add.outer(*map(np.arange, binary_image.shape)) % 4 == 0))
+	for stage, image in binary_images:
+		with StageTimer() as timer:
+			hlp.label_runs(image)
+		with StageTimer() as comparison_timer: # best of 3 for both, without tracemalloc
+			label_runs_seconds = min(timeit.repeat(lambda: hlp.label_runs(image), number=1, repeat=3))
+			skimage_seconds = min(timeit.repeat(lambda: hlp.measure.label(image, connectivity=2), number=1, repeat=3))
+		record(stage, timer, **(dict() if comparison_timer.error else dict(label_runs_seconds=round(label_runs_seconds, 4),
+			measure_label_seconds=round(skimage_seconds, 4), ratio=round(label_runs_seconds / skimage_seconds, 2))))
+
+	ccl_objects = dict()
+	for method, stage in (("ccl", "ccl"), ("segmentation", "segmentation")):
+		with StageTimer() as timer:
+			ccl_objects[method] = hlp.ConnectedComponentsLabeling(input_image=selected_image, pixel_threshold=pixel_threshold,
+				min_threshold=20, max_threshold=10000, skimage=False, method=method, tile_size=512)
+		record(stage, timer, cells=len(ccl_objects[method].cell_table) if method in ccl_objects else None,
+			true_cells=movie.n_cells)
+
+	if ready("single_cell_traces", "segmentation"):
+		with StageTimer() as timer:
+			single_cell_object = hlp.AnalyzeSingleCells(input_movie=reader, ccl_object=ccl_objects["segmentation"],
+				start=0, stop=min(30, movie.n_frames), legend=False, plot=False)
+		record("single_cell_traces", timer)
+
+	if ready("percentile_baseline", "single_cell_traces"):
+		with StageTimer() as timer:
+			single_cell_object.NormalizeCellTraces(single_cell_object.single_cell_traces, 0, 30, baseline="percentile",
+				window=min(300, movie.n_frames))
+		record("percentile_baseline", timer)
+
+	if ready("filter_traces", "single_cell_traces"):
+		with StageTimer() as timer:
+			hlp.TransformAndFilter(single_cell_object.normalized_traces).bandpass(0.01, 0.2)
+		record("filter_traces", timer)
+
+	if ready("kalman_smoothing", "single_cell_traces"):
+		with StageTimer() as timer:
+			hlp.TransformAndFilter(single_cell_object.normalized_traces).kalmanSmoother()
+		record("kalman_smoothing", timer)
+
+	if ready("event_detection", "single_cell_traces"):
+		with StageTimer() as timer:
+			single_cell_object.detectEvents(threshold=0.2)
+		record("event_detection", timer)
+
+	if ready("plot_cell_traces", "single_cell_traces"):
+		with StageTimer() as timer:
+			figure = single_cell_object.PlotCellTraces(cell_traces=single_cell_object.normalized_traces, legend=False)
+		record("plot_cell_traces", timer)
+
+	if ready("draw_cell_traces", "plot_cell_traces"):
+		with StageTimer() as timer:
+			figure.canvas.draw()
+		record("draw_cell_traces", timer)
+
+	if ready("save_pdf", "plot_cell_traces"):
+		with StageTimer() as timer: # includes waiting for the background export
+			hlp.save_pdf(save_directory=save_directory, figure=figure, save_pdf_checkbox=1, name="single_cell_traces")
+			hlp.figure_exporter.wait()
+		record("save_pdf", timer)
+		plt.close(figure)
+
+	if ready("save_txt", "single_cell_traces"):
+		with StageTimer() as timer:
+			hlp.save_txt(save_directory=save_directory, matrix=single_cell_object.normalized_traces, save_txt_checkbox=1,
+				name="normalized_cell_traces")
+		record("save_txt", timer)
+
+	try:
+		dir(hlp.h5py)
+	except ImportError:
+		print("  {:<20} skipped, h5py is not installed".format("save_results"))
+	else:
+		if ready("save_results", "segmentation", "single_cell_traces"):
+			with StageTimer() as timer:
+				hlp.save_results(save_directory=save_directory, single_cell_object=single_cell_object,
+					ccl_object=ccl_objects["segmentation"], save_results_checkbox=1, recording="synthetic")
+			record("save_results", timer)
+
+	with StageTimer() as timer: # includes waiting for the background export
+		hlp.export_tiffs(save_directory=save_directory, file_path=movie_path, save_tiff_checkbox=1)
+		hlp.tiff_exporter.wait()
+	record("save_tiffs", timer)
+
+	hlp.movie_cache.clear()
+	return(results)
+
+def git_commit():
+	try:
+		output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=benchmark_directory,
+			stderr=subprocess.STDOUT)
+		return(output.decode("utf-8").strip())
+	except (OSError, subprocess.CalledProcessError):
+		return(None)
+
+def read_history(history_path):
+	'''
+	Returns all records of a history file (one JSON object per line) as a list of dictionaries.
+	'''
+	if not os.path.exists(history_path):
+		return(list())
+	with open(history_path) as history_file:
+		return([json.loads(line) for line in history_file if line.strip()])
+
+def compare_to_history(records, history, tolerance):
+	'''
+	Compares every new record to the latest record with the same stage, parameters and machine in 'history'.
+	Prints the change and returns the list of regressed records (slower than 'tolerance' times the previous run).
+	'''
+	latest = dict()
+	for record in history:
+		if "error" in record: # failed and skipped stages have no comparable time
+			continue
+		latest[(record["host"], record["stage"], json.dumps(record["params"], sort_keys=True))] = record
+
+	regressions = list()
+	for record in records:
+		previous = latest.get((record["host"], record["stage"], json.dumps(record["params"], sort_keys=True)))
+		if "error" in record or previous is None or previous["seconds"] <= 0:
+			continue
+		ratio = record["seconds"] / previous["seconds"]
+		status = "REGRESSION" if ratio > tolerance else "ok"
+		print("{:<20} {params} {:>9.3f} sec -> {:>9.3f} sec ({:+.0f} %) {}".format(record["stage"], previous["seconds"],
+			record["seconds"], (ratio - 1) * 100, status, params=record["params"]))
+		if ratio > tolerance:
+			regressions.append(record)
+	return(regressions)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Times every stage of the analysis pipeline on synthetic movies.")
+	parser.add_argument("--grid", choices=sorted(grids), default="quick", help="predefined parameter grid (default: quick)")
+	parser.add_argument("--frames", type=int, nargs="+", help="frame counts, overrides the grid")
+	parser.add_argument("--size", type=int, nargs="+", help="frame sizes in pixels (square frames), overrides the grid")
+	parser.add_argument("--cells", type=int, nargs="+", help="cell counts, overrides the grid")
+	parser.add_argument("--bit-depth", type=int, nargs="+", choices=[8, 12, 16], help="bit depths, overrides the grid")
+	parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic movies (default: 0)")
+	parser.add_argument("--history", default=default_history_path, help="JSON lines file results are appended to")
+	parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown factor per stage (default: 1.25)")
+	parser.add_argument("--fail-on-regression", action="store_true", help="exit with code 1 if a stage regressed")
+	parser.add_argument("--work-directory", default=None, help="where movies and outputs are written (default: temp dir)")
+	args = parser.parse_args(argv)
+
+	grid = dict(grids[args.grid])
+	for key in ("frames", "size", "cells", "bit_depth"):
+		if getattr(args, key):
+			grid[key] = getattr(args, key)
+
+	work_directory = tempfile.mkdtemp(prefix="calcium_benchmark_", dir=args.work_directory)
+	run = dict(date=datetime.now().isoformat(), host=platform.node(), python=platform.python_version(),
+		numpy=np.__version__, commit=git_commit())
+	records = list()
+	try:
+		for frames, size, cells, bit_depth in itertools.product(grid["frames"], grid["size"], grid["cells"],
+																grid["bit_depth"]):
+			params = dict(frames=frames, height=size, width=size, cells=cells, bit_depth=bit_depth)
+			print("{frames} frames, {height} x {width} pixels, {cells} cells, {bit_depth} bit".format(**params))
+			movie = SyntheticMovie(n_frames=frames, height=size, width=size, n_cells=cells, bit_depth=bit_depth,
+				seed=args.seed)
+			movie_path = os.path.join(work_directory, "synthetic.lsm")
+			save_directory = os.path.join(work_directory, "output")
+
+			with StageTimer() as timer:
+				movie.write(movie_path)
+			print("  {:<20} {:>9.3f} sec (not a pipeline stage)".format("generate movie", timer.seconds))
+			if timer.error is None:
+				with StageTimer() as timer:
+					results = run_pipeline(movie_path, save_directory, movie)
+			if timer.error is not None: # the movie couldn't be written or read, no stage ran
+				print("  failed: {}".format(timer.error))
+				results = [("pipeline", None, None, dict(error=timer.error))]
+
+			for stage, seconds, peak_mb, info in results:
+				record = dict(run, stage=stage, params=params, seconds=None if seconds is None else round(seconds, 4),
+					peak_mb=None if peak_mb is None else round(peak_mb, 2))
+				record.update(info)
+				records.append(record)
+			if os.path.exists(movie_path):
+				os.remove(movie_path)
+			shutil.rmtree(save_directory, ignore_errors=True)
+	finally:
+		shutil.rmtree(work_directory, ignore_errors=True)
+
+	history = read_history(args.history)
+	with open(args.history, "a") as history_file:
+		for record in records:
+			history_file.write(json.dumps(record, sort_keys=True) + "\n")
+	print("{} results appended to {}.".format(len(records), args.history))
+
+	errors = [record for record in records if "error" in record]
+	for record in errors:
+		print("{:<20} {params} {error}".format(record["stage"], params=record["params"], error=record["error"]))
+	regressions = compare_to_history(records, history, args.tolerance)
+	if regressions:
+		print("{} stage(s) regressed by more than {:.0f} %!".format(len(regressions), (args.tolerance - 1) * 100))
+	if errors:
+		print("{} stage(s) failed or were skipped!".format(len(errors)))
+		return(1)
+	return(1 if regressions and args.fail_on_regression else 0)
+
+if __name__ == "__main__":
+	sys.exit(main())
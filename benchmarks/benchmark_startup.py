@@ -0,0 +1,88 @@
+'''
+STARTUP BENCHMARK! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Measures how long 'import helpers' takes in a fresh interpreter (best of several runs) and fails (exit code 1) if
+- the import time exceeds the stored baseline by more than the allowed tolerance (or '--max-seconds'), or
+- a heavy dependency that should be imported lazily is loaded at startup.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+
+usage: python benchmarks/benchmark_startup.py [--runs 5] [--tolerance 1.25] [--max-seconds 1.5] [--update-baseline]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+sample_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sample")
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+# modules that must not be imported when the app starts
+lazy_modules = ["keras", "tensorflow", "google.protobuf", "pandas", "pylab", "skimage", "scipy.ndimage", "h5py"]
+
+# executed in a fresh interpreter, prints the import time and all lazy modules that were imported anyway
+import_snippet = """
+import json, sys, timeit
+timer_start = timeit.default_timer()
+import helpers
+seconds = timeit.default_timer() - timer_start
+print(json.dumps(dict(seconds=seconds, loaded=[name for name in {modules!r} if name in sys.modules])))
+"""
+
+def measure_import(runs=5, python=sys.executable):
+	'''
+	Imports helpers.py 'runs' times in a new interpreter each and returns the fastest run, the fastest total process time
+	(interpreter start included) and the lazy modules that were loaded.
+	'''
+	import_times, process_times, loaded = list(), list(), set()
+	for run in range(runs):
+		timer_start = timeit.default_timer()
+		output = subprocess.check_output([python, "-c", import_snippet.format(modules=lazy_modules)], cwd=sample_directory)
+		process_times.append(timeit.default_timer() - timer_start)
+		result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+		import_times.append(result["seconds"])
+		loaded.update(result["loaded"])
+	return(dict(import_seconds=min(import_times), process_seconds=min(process_times), loaded=sorted(loaded)))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Fails if 'import helpers' got slower or imports heavy modules eagerly.")
+	parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters to time (default: 5)")
+	parser.add_argument("--tolerance", type=float, default=1.25, help="allowed factor over the baseline (default: 1.25)")
+	parser.add_argument("--max-seconds", type=float, default=None, help="absolute limit, overrides the baseline")
+	parser.add_argument("--update-baseline", action="store_true", help="store the measured time as new baseline")
+	args = parser.parse_args(argv)
+
+	result = measure_import(runs=args.runs)
+	print("import helpers: {:.3f} sec (process incl. interpreter start: {:.3f} sec)".format(result["import_seconds"],
+		result["process_seconds"]))
+
+	if args.update_baseline:
+		with open(baseline_path, "w") as baseline_file:
+			json.dump(dict(import_seconds=result["import_seconds"], python=sys.version.split()[0]), baseline_file, indent=2)
+		print("Baseline written to {}.".format(baseline_path))
+
+	failed = False
+	if result["loaded"]:
+		print("FAILED: imported at startup although they should be lazy: {}".format(", ".join(result["loaded"])))
+		failed = True
+
+	if args.max_seconds is not None:
+		limit = args.max_seconds
+	elif os.path.exists(baseline_path):
+		with open(baseline_path) as baseline_file:
+			limit = json.load(baseline_file)["import_seconds"] * args.tolerance
+	else:
+		limit = None
+		print("No baseline found, run with '--update-baseline' to create one.")
+	if limit is not None:
+		if result["import_seconds"] > limit:
+			print("FAILED: import time regressed ({:.3f} sec > {:.3f} sec).".format(result["import_seconds"], limit))
+			failed = True
+		else:
+			print("OK: import time within limit ({:.3f} sec).".format(limit))
+	return(1 if failed else 0)
+
+if __name__ == "__main__":
+	sys.exit(main())
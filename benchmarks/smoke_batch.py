@@ -0,0 +1,68 @@
+'''
+BATCH SMOKE TEST! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Runs batch.process_file on a small synthetic movie (see synthetic_movie.py), once with the default config (and an otsu
+threshold) and once with every optional stage enabled (motion correction, projection, baselines, filters, events,
+tiffs, results), and exits with code 1 if any run fails. Catches breakages of the headless pipeline (e.g. by new versions of matplotlib or
+skimage) in a few seconds.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+
+usage: python smoke_batch.py [--frames 60] [--size 256] [--cells 30]
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+os.environ.setdefault("CALCIUM_ANALYZER_BACKEND", "Agg") # no windows are opened during smoke tests
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmark_directory, "..", "sample"))
+import batch # imports batch.py (and helpers.py)
+from synthetic_movie import SyntheticMovie
+
+# every optional stage of the batch pipeline, on top of the default config
+all_stages_config = dict(motion_correction=True, projection="std", baseline="percentile", baseline_window=20,
+	trace_filter="kalman", detect_events=True, save_tiffs=True, save_results=True, cell_identification="ccl")
+
+def smoke_configs():
+	# the fixed default threshold (10) lies below the background of synthetic movies, otsu adapts to them
+	default = dict(batch.default_config, pixel_threshold="otsu")
+	all_stages = dict(default)
+	all_stages.update(all_stages_config)
+	try:
+		dir(batch.hlp.h5py)
+	except ImportError: # h5py is optional
+		all_stages["save_results"] = False
+	return([("default", default), ("all stages", all_stages)])
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Runs the batch pipeline on a synthetic movie.")
+	parser.add_argument("--frames", type=int, default=60, help="frames of the synthetic movie (default: 60)")
+	parser.add_argument("--size", type=int, default=256, help="height and width in pixels (default: 256)")
+	parser.add_argument("--cells", type=int, default=30, help="number of cells (default: 30)")
+	args = parser.parse_args(argv)
+
+	work_directory = tempfile.mkdtemp(prefix="calcium_smoke_")
+	failed = list()
+	try:
+		movie_path = SyntheticMovie(n_frames=args.frames, height=args.size, width=args.size,
+			n_cells=args.cells).write(os.path.join(work_directory, "synthetic.lsm"))
+		for name, config in smoke_configs():
+			output_directory = os.path.join(work_directory, name.replace(" ", "_"))
+			summary = batch.process_file((movie_path, output_directory, config, None))
+			print("{name}: {status} ({cells} cells, {seconds} sec) {error}".format(name=name, **summary))
+			if summary["status"] != "ok" or not summary["cells"]:
+				failed.append(name)
+	finally:
+		shutil.rmtree(work_directory, ignore_errors=True)
+
+	if failed:
+		print("Smoke test failed: {}!".format(", ".join(failed)))
+		return(1)
+	print("Smoke test passed!")
+	return(0)
+
+if __name__ == "__main__":
+	sys.exit(main())
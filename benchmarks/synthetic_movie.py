@@ -0,0 +1,99 @@
+'''
+SYNTHETIC CALCIUM MOVIES! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Generates calcium imaging movies with a known ground truth (cell masks and traces) for benchmarks. Frame count,
+resolution, cell count and bit depth are configurable. Movies are written frame chunk by frame chunk as (Big)TIFF with a
+.lsm file extension (tifffile cannot write real LSM files, but the app reads both the same way), so even
+2048 x 2048 x 10000 movies can be generated without holding them in memory.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+'''
+import numpy as np
+import tifffile as tiff
+
+def cell_label_image(height, width, n_cells, min_radius=4, max_radius=10, random_state=None):
+	'''
+	Returns a label image (0 = background, 1..n_cells = cells) with disk shaped cells at random positions. Overlapping
+	cells are allowed, the cell with the higher label wins.
+	'''
+	random_state = random_state or np.random.RandomState(0)
+	label_image = np.zeros((height, width), dtype=np.int32)
+	for label in range(1, n_cells + 1):
+		radius = random_state.randint(min_radius, max_radius + 1)
+		row, col = random_state.randint(radius, height - radius), random_state.randint(radius, width - radius)
+		rows, cols = np.ogrid[row - radius:row + radius + 1, col - radius:col + radius + 1]
+		disk = (rows - row)**2 + (cols - col)**2 <= radius**2
+		label_image[row - radius:row + radius + 1, col - radius:col + radius + 1][disk] = label
+	return(label_image)
+
+def cell_traces(n_cells, n_frames, events_per_100_frames=1.0, decay_frames=15.0, bleaching=0.3, random_state=None):
+	'''
+	Returns relative fluorescence traces of shape (n_cells, n_frames): calcium transients (instant rise, exponential decay)
+	at random times on top of a baseline of 1.0 that bleaches by 'bleaching' (fraction) over the recording.
+	'''
+	random_state = random_state or np.random.RandomState(0)
+	spikes = (random_state.rand(n_cells, n_frames) < events_per_100_frames / 100.0).astype(np.float32)
+	spikes *= random_state.uniform(0.5, 2.0, size=spikes.shape).astype(np.float32)
+
+	# convolve all traces with the transient kernel at once (along the time axis)
+	kernel_length = int(5 * decay_frames)
+	kernel = np.exp(-np.arange(kernel_length) / decay_frames).astype(np.float32)
+	n_fft = int(2**np.ceil(np.log2(n_frames + kernel_length)))
+	transients = np.fft.irfft(np.fft.rfft(spikes, n_fft, axis=1) * np.fft.rfft(kernel, n_fft), n_fft, axis=1)[:, :n_frames]
+
+	baseline = 1.0 - bleaching * np.linspace(0.0, 1.0, n_frames, dtype=np.float32)
+	return((baseline * (1.0 + transients)).astype(np.float32))
+
+class SyntheticMovie():
+	'''
+	A synthetic calcium imaging movie. 'label_image' and 'traces' hold the ground truth, frames are rendered on demand
+	(see renderFrames) or written to disk (see write). 'bit_depth' is 8 (uint8), 12 or 16 (both uint16).
+	'''
+	def __init__(self, n_frames=500, height=512, width=512, n_cells=50, bit_depth=8, noise=0.03, seed=0):
+		if bit_depth not in (8, 12, 16):
+			raise ValueError("Specify a valid bit depth! (8, 12, 16)")
+		random_state = np.random.RandomState(seed)
+		self.n_frames, self.height, self.width, self.n_cells, self.bit_depth = n_frames, height, width, n_cells, bit_depth
+		self.noise = noise
+		self.dtype = np.uint8 if bit_depth == 8 else np.uint16
+		self.max_value = 2**bit_depth - 1
+		self.label_image = cell_label_image(height, width, n_cells, random_state=random_state)
+		self.traces = cell_traces(n_cells, n_frames, random_state=random_state)
+		# cells are at ~30 % of the gray scale range, transients add up to ~40 %, background is at ~5 %
+		self.cell_brightness = random_state.uniform(0.2, 0.4, size=n_cells).astype(np.float32) * self.max_value
+		self.background = 0.05 * self.max_value
+		self._random_state = random_state
+
+	def renderFrames(self, start, stop):
+		'''
+		Returns frames 'start' until 'stop' as an array of shape (frames, height, width) and dtype 'dtype'.
+		'''
+		# column 0 is the background, column i the brightness of cell i in every frame; rendering is a lookup of the
+		# label image in that table
+		intensity_table = np.empty((stop - start, self.n_cells + 1), dtype=np.float32)
+		intensity_table[:, 0] = self.background
+		intensity_table[:, 1:] = (self.traces[:, start:stop] * self.cell_brightness[:, np.newaxis]).T
+		frames = intensity_table[:, self.label_image]
+		frames += self._random_state.normal(0.0, self.noise * self.max_value, size=frames.shape).astype(np.float32)
+		return(np.clip(frames, 0, self.max_value).astype(self.dtype))
+
+	def framesPerChunk(self, chunk_bytes=64 * 1024**2):
+		return(int(max(1, chunk_bytes // (4 * self.height * self.width))))
+
+	def write(self, file_path):
+		'''
+		Writes the movie to 'file_path' (one page per frame, uncompressed BigTIFF) and returns the path.
+		'''
+		with tiff.TiffWriter(file_path, bigtiff=True) as writer:
+			chunk = self.framesPerChunk()
+			for start in range(0, self.n_frames, chunk):
+				for frame in self.renderFrames(start, min(start + chunk, self.n_frames)):
+					write_page(writer, frame)
+		return(file_path)
+
+def write_page(writer, frame):
+	# tifffile >= 2020 renamed TiffWriter.save to TiffWriter.write
+	if hasattr(writer, "write"):
+		writer.write(frame, contiguous=True)
+	else:
+		writer.save(frame, contiguous=True)
@@ -0,0 +1,272 @@
+'''
+BATCH PROCESSING! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Runs the analysis pipeline (preprocessing, cell identification, single cell traces) without the GUI
+on every .lsm file in a directory. Files are processed in parallel worker processes.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+
+usage: python batch.py <input_directory> <output_directory> [--config config.json] [--workers 4] [--memory-cap 8000]
+'''
+current_app_version = "v0.2"
+#####################################
+#### Import All Required Modules ####
+#####################################
+import os, sys
+os.environ.setdefault("CALCIUM_ANALYZER_BACKEND", "Agg") # no windows are opened during batch runs
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import timeit
+import traceback
+import numpy as np
+import matplotlib.pyplot as plt
+import helpers as hlp # imports helpers.py
+
+# every parameter can be overwritten in a .json config file (see batch_config_example.json)
+default_config = dict(
+	image_number=1,             # frame that is previewed and used to identify cells (1-indexed, like in the GUI)
+	channel=1,                  # channel and position of multi-channel/multi-position recordings (1-indexed)
+	position=1,
+	projection="frame",         # identify cells in 'image_number' ("frame") or a "max", "mean", "std" or "percentile" projection
+	projection_percentile=95,   # percentile of the "percentile" projection
+	cutoff1=30,                 # preview filter 1
+	cutoff2=60,                 # preview filter 2
+	pixel_threshold=10,         # analysis filter, a number or "otsu"
+	min_cell_size=100,          # in pixels
+	max_cell_size=10000,        # in pixels
+	cell_identification="segmentation", # 'ccl' or 'segmentation'
+	segmentation_tile_size=512, # 'segmentation' runs on tiles of this size in parallel, null for a single tile
+	motion_correction=False,    # rigid motion correction (reference: 'image_number'), cached in '<output>/<file>/cache/'
+	trace_method="mean",        # 'mean', 'sum', 'median', 'max', 'min'
+	baseline_start=0,           # frames used as baseline (F0) for normalization
+	baseline_stop=30,
+	baseline="mean",            # F0: 'mean' (of baseline_start:baseline_stop), 'percentile', 'minimum' or 'bleach'
+	baseline_window=300,        # sliding window in frames for 'percentile' and 'minimum'
+	baseline_percentile=10,
+	trace_plot_style="auto",    # 'lines', 'heatmap' or 'auto' (heatmap for more than 50 cells)
+	trace_filter=None,          # 'lowpass', 'highpass', 'bandpass' or 'kalman' to also save filtered traces (null = no filter)
+	trace_filter_cutoffs=[0.1], # one cutoff ('lowpass', 'highpass') or two ('bandpass'), in cycles per frame or Hz
+	sampling_rate=1.0,          # frames per second, 1.0 = cutoffs in cycles per frame
+	detect_events=False,        # save onset, peak, offset, duration and amplitude of calcium events per cell
+	event_threshold=0.2,        # dF/F an event has to reach
+	event_end_threshold=0.1,    # dF/F below which an event ends (hysteresis)
+	event_min_duration=2,       # in frames
+	save_preview=True,          # exploratory data analysis figure
+	save_tiffs=False,
+	save_figures=True,
+	figure_formats=["pdf"],     # any of 'pdf', 'png', 'svg'
+	figure_dpi=150,             # resolution of images, contours and traces in figures
+	save_traces=True,           # normalized traces as .txt
+	save_results=False,         # traces, region table, label image and parameters in results/analysis_results.h5
+	)
+
+def read_config(config_path):
+	'''
+	Returns the default config updated with the values of a .json config file. Unknown keys raise a ValueError.
+	'''
+	config = dict(default_config)
+	if config_path:
+		with open(config_path) as config_file:
+			user_config = json.load(config_file)
+		unknown_keys = set(user_config) - set(default_config)
+		if unknown_keys:
+			raise ValueError("Unknown config key(s): {}".format(", ".join(sorted(unknown_keys))))
+		config.update(user_config)
+	return(config)
+
+def find_input_files(input_directory, pattern="*.lsm", recursive=False):
+	'''
+	Returns a sorted list of all files in 'input_directory' whose name matches 'pattern'.
+	'''
+	input_files = list()
+	for directory, subdirectories, file_names in os.walk(input_directory):
+		input_files.extend(os.path.join(directory, name) for name in fnmatch.filter(file_names, pattern))
+		if not recursive:
+			break
+	return(sorted(input_files))
+
+def init_worker(memory_cap):
+	'''
+	Runs once in every worker process: limits the (heap) memory of the process to 'memory_cap' bytes (where the OS
+	supports it). The movie cache may use half of it, the rest is left to the analysis.
+	'''
+	if memory_cap:
+		hlp.movie_cache.memory_budget = memory_cap // 2
+		try:
+			import resource
+			resource.setrlimit(resource.RLIMIT_DATA, (memory_cap, memory_cap)) # file-backed memory maps stay allowed
+		except (ImportError, ValueError, OSError, AttributeError):
+			print("Could not limit the memory of worker {}!".format(os.getpid()))
+
+def process_file(job):
+	'''
+	Analyzes a single .lsm file. Output files are written to '<output_directory>/<file name>/' using the 'tiffs/',
+	'figures/' and 'results/' layout of the GUI. Returns a summary dictionary; errors are reported, not raised, so that
+	one broken recording does not stop the whole batch.
+	'''
+	file_path, output_directory, config, memory_cap = job
+	timer_start = timeit.default_timer()
+	name = os.path.splitext(os.path.basename(file_path))[0]
+	save_directory = os.path.join(output_directory, name)
+	summary = dict(file=file_path, output=save_directory, cells=0, status="ok", error="")
+
+	try:
+		hlp.figure_exporter.formats, hlp.figure_exporter.dpi = config["figure_formats"], config["figure_dpi"]
+		hlp.create_new_directories(save_directory=save_directory)
+		channel, position = int(config["channel"]) - 1, int(config["position"]) - 1
+		reader = hlp.movie_cache.reader(file_path, channel=channel, position=position)
+		hlp.export_tiffs(save_directory=save_directory, file_path=file_path, save_tiff_checkbox=config["save_tiffs"])
+
+		# 1) preprocessing / exploratory data analysis
+		if config["save_preview"]:
+			preview_figure = hlp.preprocessingFunction(image_number=config["image_number"], cutoff1=config["cutoff1"],
+				cutoff2=config["cutoff2"], file_path=file_path, save_directory=save_directory,
+				save_tiff_checkbox=False, save_pdf_checkbox=config["save_figures"], channel=channel, position=position)
+			plt.close(preview_figure)
+
+		# 2) identify cells (in the motion corrected movie, if enabled)
+		movie = reader
+		if config["motion_correction"]:
+			movie = hlp.MotionCorrection(file_path, cache_directory=os.path.join(save_directory, "cache"),
+				reference_frame=int(config["image_number"]) - 1, workers=1, # one worker process per CPU already
+				channel=channel, position=position)
+			hlp.save_txt(save_directory=save_directory, matrix=movie.shifts, save_txt_checkbox=config["save_traces"],
+				name="motion_correction_shifts")
+		if config["projection"] == "frame":
+			selected_image = movie.read_frame(int(config["image_number"]) - 1)
+		else:
+			selected_image = hlp.projection_image(file_path, mode=config["projection"],
+				percentile=config["projection_percentile"], movie=movie, cache_directory=os.path.join(save_directory, "cache"),
+				channel=channel, position=position)
+		pixel_threshold = config["pixel_threshold"]
+		if pixel_threshold == "otsu":
+			pixel_threshold = hlp.PixelHistogram(image=selected_image).otsuThreshold()
+		ccl_object = hlp.ConnectedComponentsLabeling(input_image=selected_image, pixel_threshold=pixel_threshold,
+			min_threshold=config["min_cell_size"], max_threshold=config["max_cell_size"], skimage=False,
+			method=config["cell_identification"], projection=None if config["projection"] == "frame" else config["projection"],
+			tile_size=config["segmentation_tile_size"])
+		cells_figure = hlp.plot_cell_identification(selected_image=selected_image, ccl_object=ccl_object,
+			image_number=config["image_number"] if config["projection"] == "frame" else "({} projection)".format(
+			config["projection"]), pixel_threshold=pixel_threshold, min_threshold=config["min_cell_size"],
+			max_threshold=config["max_cell_size"])
+		hlp.save_pdf(save_directory=save_directory, figure=cells_figure, save_pdf_checkbox=config["save_figures"],
+			name="cell_identification_output")
+		plt.close(cells_figure)
+
+		# 3) single cell traces; the movie is streamed from disk in chunks that fit into the memory cap
+		chunk_size = 256
+		if memory_cap:
+			frame_bytes = int(np.prod(reader.frame_shape)) * reader.dtype.itemsize
+			chunk_size = int(max(1, min(chunk_size, memory_cap // (4 * frame_bytes)))) # leave room for copies
+		single_cell_object = hlp.AnalyzeSingleCells(input_movie=movie, ccl_object=ccl_object, start=config["baseline_start"],
+			stop=config["baseline_stop"], method=config["trace_method"], legend=False, chunk_size=chunk_size,
+			baseline=config["baseline"], baseline_window=config["baseline_window"],
+			baseline_percentile=config["baseline_percentile"], plot_style=config["trace_plot_style"])
+		hlp.save_pdf(save_directory=save_directory, figure=single_cell_object.figure,
+			save_pdf_checkbox=config["save_figures"], name="single_cell_traces")
+		hlp.save_txt(save_directory=save_directory, matrix=single_cell_object.normalized_traces,
+			save_txt_checkbox=config["save_traces"], name="normalized_cell_traces")
+		if config["trace_filter"]:
+			trace_filter = hlp.TransformAndFilter(single_cell_object.normalized_traces, sampling_rate=config["sampling_rate"])
+			if config["trace_filter"] == "kalman":
+				filtered_traces = trace_filter.kalmanSmoother()
+			else:
+				filtered_traces = trace_filter.filterTraces(config["trace_filter"], config["trace_filter_cutoffs"])
+			hlp.save_txt(save_directory=save_directory, matrix=filtered_traces, save_txt_checkbox=config["save_traces"],
+				name="filtered_cell_traces")
+		if config["detect_events"]:
+			events = single_cell_object.detectEvents(threshold=config["event_threshold"],
+				end_threshold=config["event_end_threshold"], min_duration=config["event_min_duration"])
+			hlp.save_txt(save_directory=save_directory, matrix=events, save_txt_checkbox=config["save_traces"],
+				name="cell_events")
+		hlp.save_results(save_directory=save_directory, single_cell_object=single_cell_object, ccl_object=ccl_object,
+			save_results_checkbox=config["save_results"], recording=name, parameters=config, source_file=file_path)
+		plt.close(single_cell_object.figure)
+		summary["cells"] = int(single_cell_object.normalized_traces.shape[0])
+
+	except Exception as error: # MemoryError included, the next file gets a fresh worker anyway
+		summary["status"] = "failed"
+		summary["error"] = "{}: {}".format(type(error).__name__, error)
+		traceback.print_exc()
+
+	hlp.tiff_exporter.wait() # .tif and figure exports run on background threads, finish them before the worker exits
+	hlp.figure_exporter.wait()
+	hlp.movie_cache.clear()
+	summary["seconds"] = round(timeit.default_timer() - timer_start, 2)
+	return(summary)
+
+def relative_folder(file_path, input_directory):
+	'''
+	Returns the folder of 'file_path' relative to 'input_directory' ('' for files directly in it).
+	'''
+	folder = os.path.relpath(os.path.dirname(os.path.abspath(file_path)), os.path.abspath(input_directory))
+	return("" if folder == os.curdir else folder)
+
+def run_batch(input_files, output_directory, config, workers=1, memory_cap=None, input_directory=None):
+	'''
+	Processes all 'input_files' on a pool of 'workers' processes and returns the list of per-file summaries.
+	Every worker handles a single file and is then replaced, so memory is returned to the OS after each recording.
+	With 'input_directory', the output folder of a file keeps its path relative to it (e.g. input/day1/cell.lsm is
+	written to output/day1/cell/), so files of the same name in different subfolders do not overwrite each other.
+	'''
+	jobs = [(file_path, os.path.join(output_directory, relative_folder(file_path, input_directory)) if input_directory
+			 else output_directory, config, memory_cap) for file_path in input_files]
+	summaries = list()
+	pool = multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(memory_cap, ), maxtasksperchild=1)
+	try:
+		for summary in pool.imap_unordered(process_file, jobs):
+			print("[{done}/{total}] {status}: {file} ({cells} cells, {seconds} sec) {error}".format(
+				done=len(summaries) + 1, total=len(jobs), **summary))
+			summaries.append(summary)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	return(summaries)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Calcium Imaging Analyzer {} - batch processing".format(current_app_version))
+	parser.add_argument("input_directory", help="directory with .lsm files")
+	parser.add_argument("output_directory", help="directory to write tiffs/, figures/ and results/ to (one folder per file)")
+	parser.add_argument("--config", default=None, help=".json file with analysis parameters")
+	parser.add_argument("--workers", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+		help="number of worker processes (default: number of CPUs - 1)")
+	parser.add_argument("--memory-cap", type=int, default=0, help="memory limit per worker process in MB (default: none)")
+	parser.add_argument("--pattern", default="*.lsm", help="file name pattern of input files (default: *.lsm)")
+	parser.add_argument("--recursive", action="store_true", help="also search subdirectories of the input directory")
+	args = parser.parse_args(argv)
+
+	config = read_config(args.config)
+	input_files = find_input_files(args.input_directory, pattern=args.pattern, recursive=args.recursive)
+	if not input_files:
+		print("No files matching '{}' found in {}!".format(args.pattern, args.input_directory))
+		return(1)
+
+	print("Calcium Imaging Analyzer {} - processing {} files with {} workers.".format(current_app_version, len(input_files),
+		args.workers))
+	summaries = run_batch(input_files=input_files, output_directory=args.output_directory, config=config,
+		workers=args.workers, memory_cap=args.memory_cap * 1024**2, input_directory=args.input_directory)
+
+	# collect the results of all recordings in one file, so that e.g. one cell can be compared across recordings
+	if config["save_results"]:
+		results_store = hlp.ResultsStore(os.path.join(args.output_directory, hlp.results_file_name))
+		for summary in summaries:
+			file_results = os.path.join(summary["output"], "results", hlp.results_file_name)
+			if summary["status"] == "ok" and os.path.exists(file_results):
+				# recordings from subfolders are prefixed with their folder, e.g. 'day1_cell' for input/day1/cell.lsm
+				folder = relative_folder(summary["file"], args.input_directory)
+				results_store.append(file_results, prefix="_".join(folder.split(os.sep) + [""]) if folder else "")
+
+	# keep a record of the run next to the results
+	with open(os.path.join(args.output_directory, "batch_summary.json"), "w") as summary_file:
+		json.dump(dict(config=config, files=summaries), summary_file, indent=2)
+	failed = [summary for summary in summaries if summary["status"] != "ok"]
+	print("Done! {} of {} files analyzed successfully.".format(len(summaries) - len(failed), len(summaries)))
+	return(1 if failed else 0)
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -9,44 +9,51 @@ current_app_version = "v0.2"
 #### Import All Required Modules ####
 #####################################
 import warnings, timeit
+import json
+import hashlib
+import inspect
+import itertools
+import pickle
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+from collections import OrderedDict
 from datetime import datetime
-with warnings.catch_warnings(): # suppresses keras' annoying numpy warning
-    warnings.simplefilter("ignore")
-    import keras
-    from keras import layers
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 import tifffile as tiff # module downloaded from https://github.com/blink1073/tifffile.git
 import numpy as np
-import pandas as pd
 import matplotlib
 import time
-matplotlib.use("TkAgg") # otherwise matplotlib will crash the app
+import os, errno
+# otherwise matplotlib will crash the app (headless batch runs set CALCIUM_ANALYZER_BACKEND to "Agg")
+matplotlib.use(os.environ.get("CALCIUM_ANALYZER_BACKEND", "TkAgg"))
 import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-import matplotlib.backends.tkagg as tkagg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
-from matplotlib.figure import Figure
-import pylab
+from matplotlib.collections import LineCollection, PolyCollection
 import sys
 from sys import platform
 if sys.version_info[0] < 3:
     import Tkinter as tk
     import ttk as ttk
     import tkMessageBox
+    import Queue as queue
 else:  
     import tkinter as tk
     from tkinter import ttk
     from tkinter import messagebox
-import os, errno
-os.environ["TF_CPP_MIN_LOG_LEVEL"] = '2'
-from skimage import measure
-from skimage import filters
-from skimage.feature import canny
-from scipy import ndimage as ndi
-from skimage.filters import sobel
-from skimage.morphology import watershed
+    import queue
+import traceback
+# heavy optional dependencies are only imported once a feature that needs them runs
+from lazy_import import LazyModule
+measure = LazyModule("skimage.measure")
+filters = LazyModule("skimage.filters")
+skimage_segmentation = LazyModule("skimage.segmentation") # watershed (moved out of skimage.morphology)
+ndi = LazyModule("scipy.ndimage")
+fft = LazyModule("scipy.fft")
+h5py = LazyModule("h5py") # only needed to save results as .h5
 
 #######################################
 #### FigureCanvas Class Definition ####
@@ -275,35 +282,20 @@ def create_new_directories(save_directory):
 			if error.errno != errno.EEXIST:
 				raise Exception("Could not create a 'results/' folder!")
 
-def save_tiffs(save_directory, image, save_tiff_checkbox):
+def save_pdf(save_directory, figure, save_pdf_checkbox, name, formats=None):
 	'''
-	This function saves .tif images to a designated directory that was previously specified.
-	'''
-	if save_tiff_checkbox:
-		try:
-			tiff.imsave("{dir}/tiffs/{day}_{time}_{name}.tif".format(
-				dir=save_directory, 
-				day=datetime.now().strftime("%Y_%m_%d"), 
-				time=datetime.now().strftime("%H.%M.%S"),
-				name="analysis_input"), image)
-			print("Image saved to: " + "{}/{}".format(save_directory, "tiffs"))
-		except:
-			print("You did not save a .tif! Check the specified save directory!")
-	else:
-		print("No .tif files written to {}/{}!".format(save_directory, "tiffs"))
-
-def save_pdf(save_directory, figure, save_pdf_checkbox, name):
-	'''
-	This function saves .pdf images to a designated directory that was previously specified.
+	This function saves figures to a designated directory that was previously specified. Figures are written on a
+	background thread as .pdf or in the 'formats' of the figure exporter (see FigureExporter), the function returns
+	immediately.
 	'''
 	if save_pdf_checkbox:
 		try:
-			figure.savefig("{dir}/figures/{day}_{time}_{name}.pdf".format(
+			figure_exporter.submit(figure, "{dir}/figures/{day}_{time}_{name}".format(
 				dir=save_directory, 
 				day=datetime.now().strftime("%Y_%m_%d"), 
 				time=datetime.now().strftime("%H.%M.%S"),
-				name=name))
-			print("Figure saved to: " + "{}/{}".format(save_directory, "figures"))
+				name=name), formats=formats)
+			print("Figure queued for export to: " + "{}/{}".format(save_directory, "figures"))
 		except:
 			print("You did not save a .pdf! Check the specified save directory!")
 	else:
@@ -313,40 +305,1239 @@ def save_pdf(save_directory, figure, save_pdf_checkbox, name):
 def save_txt(save_directory, matrix, save_txt_checkbox, name):
 	'''
 	This function saves .txt files to a designated directory that was previously specified.
+	Structured arrays (e.g. event tables) get one column per field and the field names as header.
 	'''
 	if save_txt_checkbox:
 		try:
+			options = dict()
+			if getattr(matrix, "dtype", None) is not None and matrix.dtype.names:
+				options = dict(fmt="%g", header=" ".join(matrix.dtype.names))
 			np.savetxt("{dir}/results/{day}_{time}_{name}.txt".format(
 				dir=save_directory, 
 				day=datetime.now().strftime("%Y_%m_%d"), 
 				time=datetime.now().strftime("%H.%M.%S"),
-				name=name), matrix)
+				name=name), matrix, **options)
 			print("Text file saved to: " + "{}/{}".format(save_directory, "results"))
 		except:
 			print("You did not save a .txt! Check the specified save directory!")
 	else:
 		print("No .txt files written to {}/{}".format(save_directory, "results"))
 
+def recording_name(file_path):
+	'''
+	Name of the group a recording is stored under in a ResultsStore, e.g. 'experiment_1' for '/data/experiment_1.lsm'.
+	'''
+	return(os.path.splitext(os.path.basename(file_path))[0].replace("/", "_"))
+
+def save_results(save_directory, single_cell_object, ccl_object, save_results_checkbox, recording, parameters=None,
+	source_file=""):
+	'''
+	This function adds the results of one recording (traces, region table, label image, parameters) to the .h5 results
+	file in the 'results/' folder of the save directory. Results of other recordings in the same file are kept.
+	'''
+	if save_results_checkbox:
+		try:
+			all_parameters = dict(getattr(ccl_object, "parameters", dict()))
+			all_parameters.update(parameters or dict())
+			ResultsStore("{dir}/results/{name}".format(dir=save_directory, name=results_file_name)).write(
+				recording=recording, normalized_traces=single_cell_object.normalized_traces,
+				raw_traces=single_cell_object.single_cell_traces, region_table=single_cell_object.cell_table,
+				label_image=ccl_object.im_with_cells, parameters=all_parameters, source_file=source_file,
+				events=getattr(single_cell_object, "events", None))
+			print("Results saved to: " + "{}/{}/{}".format(save_directory, "results", results_file_name))
+		except ImportError:
+			print("You did not save a .h5 file! Install h5py to save results in binary format!")
+		except:
+			print("You did not save a .h5 file! Check the specified save directory!")
+	else:
+		print("No .h5 files written to {}/{}".format(save_directory, "results"))
+
+###############################
+#### Results Store - Class ####
+###############################
+results_file_name = "analysis_results.h5"
+
+class ResultsStore():
+	'''
+	Collects the results of many recordings in one chunked, compressed HDF5 file (needs h5py). One group per recording:
+		<recording>/normalized_traces  (cells, frames) float32
+		<recording>/raw_traces         (cells, frames) float32
+		<recording>/region_table       one row per cell, 'region_table_dtype'
+		<recording>/label_image        cells are labeled 1..n like the rows of the traces
+		<recording>/events             one row per calcium event, 'event_table_dtype' (if events were detected)
+		attributes of <recording>      parameters (json), source_file, date, app_version
+	Writing a recording adds it to the file (appending), an existing recording of the same name is replaced.
+	Traces are chunked by cells, so e.g. reading one cell of every recording only decompresses a few kB per recording.
+	'''
+	def __init__(self, file_path, compression_level=4):
+		self.file_path = file_path
+		self.compression_level = compression_level
+
+	def _datasetOptions(self, shape, chunks):
+		# empty datasets can neither be chunked nor compressed
+		if 0 in shape:
+			return(dict())
+		return(dict(chunks=chunks, compression="gzip", compression_opts=self.compression_level, shuffle=True))
+
+	def _traceChunks(self, shape):
+		# ~64 kB per chunk, complete rows (cells) as long as a row fits
+		n_frames = min(shape[1], 16384)
+		return((int(max(1, min(shape[0], 16384 // n_frames))), n_frames))
+
+	def write(self, recording, normalized_traces, raw_traces=None, region_table=None, label_image=None, parameters=None,
+		source_file="", events=None):
+		'''
+		Adds the results of one recording to the file. Everything but 'normalized_traces' is optional.
+		'''
+		with h5py.File(self.file_path, "a") as store:
+			if recording in store:
+				del store[recording]
+			group = store.create_group(recording)
+			group.attrs["parameters"] = json.dumps(parameters or dict(), sort_keys=True, default=str)
+			group.attrs["source_file"] = source_file
+			group.attrs["date"] = datetime.now().isoformat()
+			group.attrs["app_version"] = current_app_version
+
+			for name, traces in (("normalized_traces", normalized_traces), ("raw_traces", raw_traces)):
+				if traces is not None:
+					traces = np.asarray(traces, dtype=np.float32)
+					group.create_dataset(name, data=traces, **self._datasetOptions(traces.shape, self._traceChunks(traces.shape)))
+			if region_table is not None:
+				group.create_dataset("region_table", data=region_table,
+									 **self._datasetOptions(region_table.shape, (min(len(region_table), 4096), )))
+			if label_image is not None:
+				label_image = np.asarray(label_image)
+				label_image = label_image.astype(np.min_scalar_type(max(int(label_image.max()), 0)) if label_image.size else
+												 np.uint8)
+				group.create_dataset("label_image", data=label_image, **self._datasetOptions(label_image.shape,
+									 (min(label_image.shape[0], 256), min(label_image.shape[1], 256))))
+			if events is not None:
+				group.create_dataset("events", data=events, **self._datasetOptions(events.shape, (min(len(events), 4096), )))
+
+	def append(self, file_path, prefix=""):
+		'''
+		Copies all recordings of another results file into this one (chunks stay compressed, nothing is decoded). Their
+		names are prefixed with 'prefix'.
+		'''
+		with h5py.File(file_path, "r") as source, h5py.File(self.file_path, "a") as store:
+			for recording in source:
+				if prefix + recording in store:
+					del store[prefix + recording]
+				source.copy(recording, store, name=prefix + recording)
+
+	def recordings(self):
+		'''
+		Returns the names of all recordings in the file.
+		'''
+		with h5py.File(self.file_path, "r") as store:
+			return(sorted(store.keys()))
+
+	def readTraces(self, recording, cells=None, frames=None, raw=False):
+		'''
+		Reads (part of) the traces of a recording. 'cells' and 'frames' can be an int, a slice or an increasing list of
+		indices (None = all); only the chunks that contain them are read from disk.
+		'''
+		with h5py.File(self.file_path, "r") as store:
+			dataset = store[recording]["raw_traces" if raw else "normalized_traces"]
+			cells = slice(None) if cells is None else cells
+			frames = slice(None) if frames is None else frames
+			return(dataset[cells, frames])
+
+	def readCell(self, cell, recordings=None, raw=False):
+		'''
+		Returns an OrderedDict of recording name -> trace of row 'cell' for all (or the given) recordings.
+		'''
+		traces = OrderedDict()
+		with h5py.File(self.file_path, "r") as store:
+			for recording in (recordings or sorted(store.keys())):
+				dataset = store[recording]["raw_traces" if raw else "normalized_traces"]
+				if cell < dataset.shape[0]:
+					traces[recording] = dataset[cell, :]
+		return(traces)
+
+	def readRegionTable(self, recording):
+		with h5py.File(self.file_path, "r") as store:
+			return(store[recording]["region_table"][()])
+
+	def readLabelImage(self, recording):
+		with h5py.File(self.file_path, "r") as store:
+			return(store[recording]["label_image"][()])
+
+	def readEvents(self, recording):
+		with h5py.File(self.file_path, "r") as store:
+			if "events" not in store[recording]:
+				return(np.zeros(0, dtype=event_table_dtype))
+			return(store[recording]["events"][()])
+
+	def readParameters(self, recording):
+		'''
+		Returns the parameters of a recording together with 'source_file', 'date' and 'app_version'.
+		'''
+		with h5py.File(self.file_path, "r") as store:
+			attributes = store[recording].attrs
+			parameters = json.loads(attributes["parameters"])
+			for key in ("source_file", "date", "app_version"):
+				parameters[key] = attributes[key]
+		return(parameters)
+
+##############################
+#### Job Executor - Class ####
+##############################
+class JobCancelled(Exception):
+	'''
+	Raised inside a job's work function when the job was cancelled (see Job.setProgress and Job.checkCancelled).
+	'''
+	pass
+
+class Job():
+	'''
+	A unit of work for the JobExecutor. 'work' is called with the job itself on the worker thread and must not touch any
+	Tk widget or pyplot figure. Its return value is passed to 'on_done' (or the exception to 'on_error') on the Tk thread.
+	Long running work functions report progress and honor cancellation via job.setProgress(fraction).
+	'''
+	def __init__(self, name, work, on_done=None, on_error=None):
+		self.name = name
+		self.work = work
+		self.on_done = on_done
+		self.on_error = on_error
+		self.progress = None # None means 'unknown', otherwise a fraction between 0 and 1
+		self._cancel_event = threading.Event()
+
+	def cancel(self):
+		self._cancel_event.set()
+
+	def cancelled(self):
+		return(self._cancel_event.is_set())
+
+	def checkCancelled(self):
+		if self.cancelled():
+			raise JobCancelled("Job '{}' was cancelled.".format(self.name))
+
+	def setProgress(self, fraction):
+		self.progress = fraction
+		self.checkCancelled()
+
+class JobExecutor():
+	'''
+	Runs jobs one after another on a background thread, so the Tk mainloop never blocks. Finished jobs are handed back to
+	the Tk thread by polling a result queue with master.after(); 'on_status' is called there as well after every poll (e.g.
+	to update a JobStatusBar). Jobs can be queued while another one runs and cancelled while running or waiting.
+	'''
+	def __init__(self, master, poll_interval=100, on_status=None):
+		self.master = master
+		self.poll_interval = poll_interval
+		self.on_status = on_status
+		self.current_job = None
+		self._pending = list()
+		self._lock = threading.Lock()
+		self._jobs = queue.Queue()
+		self._results = queue.Queue()
+
+		worker = threading.Thread(target=self._run, name="JobExecutor")
+		worker.daemon = True # do not keep the app alive after the window was closed
+		worker.start()
+		self.master.after(self.poll_interval, self._poll)
+
+	def submit(self, name, work, on_done=None, on_error=None):
+		'''
+		Queues 'work' and returns the corresponding Job.
+		'''
+		job = Job(name=name, work=work, on_done=on_done, on_error=on_error)
+		with self._lock:
+			self._pending.append(job)
+		self._jobs.put(job)
+		return(job)
+
+	def pendingJobs(self):
+		with self._lock:
+			return(list(self._pending))
+
+	def cancel(self, job=None):
+		'''
+		Cancels 'job' or, by default, the job that is currently running.
+		'''
+		job = job or self.current_job
+		if job is not None:
+			job.cancel()
+
+	def cancelAll(self):
+		for job in self.pendingJobs() + [self.current_job]:
+			self.cancel(job)
+
+	def _run(self):
+		# worker thread: run queued jobs forever
+		while True:
+			job = self._jobs.get()
+			with self._lock:
+				self._pending.remove(job)
+				self.current_job = job
+			if job.cancelled():
+				outcome, value = "cancelled", None
+			else:
+				try:
+					outcome, value = "done", job.work(job)
+				except JobCancelled:
+					outcome, value = "cancelled", None
+				except Exception as error:
+					traceback.print_exc()
+					outcome, value = "error", error
+			with self._lock:
+				self.current_job = None
+			self._results.put((job, outcome, value))
+
+	def _poll(self):
+		# Tk thread: deliver results of finished jobs and update the status display
+		try:
+			while True:
+				job, outcome, value = self._results.get_nowait()
+				if outcome == "done" and job.on_done is not None:
+					job.on_done(value)
+				elif outcome == "error" and job.on_error is not None:
+					job.on_error(value)
+				elif outcome == "cancelled":
+					print("Cancelled '{}'.".format(job.name))
+		except queue.Empty:
+			pass
+		if self.on_status is not None:
+			self.on_status(self)
+		self.master.after(self.poll_interval, self._poll)
+
+class JobStatusBar(ttk.Frame):
+	'''
+	Shows the job that is currently running, its progress and the number of queued jobs, with buttons to cancel the
+	running job or all jobs. Pass 'showStatus' as 'on_status' to a JobExecutor and call 'connect' with that executor.
+	'''
+	def __init__(self, master, *args, **kwargs):
+		ttk.Frame.__init__(self, master, *args, **kwargs)
+		self.executor = None
+		self.status_var = tk.StringVar()
+		self.status_var.set("No analysis running.")
+		self.progressbar = ttk.Progressbar(self, orient=tk.HORIZONTAL, length=220, mode="determinate", maximum=100)
+		self.progressbar.grid(row=0, column=0, padx=2)
+		tk.Button(self, text="Cancel", command=self.cancel).grid(row=0, column=1, padx=2)
+		tk.Button(self, text="Cancel All", command=self.cancelAll).grid(row=0, column=2, padx=2)
+		tk.Label(self, textvariable=self.status_var, font="Arial 11 italic").grid(row=1, column=0, columnspan=3, sticky=tk.W)
+
+	def connect(self, executor):
+		self.executor = executor
+
+	def cancel(self):
+		if self.executor is not None:
+			self.executor.cancel()
+
+	def cancelAll(self):
+		if self.executor is not None:
+			self.executor.cancelAll()
+
+	def showStatus(self, executor):
+		job, queued = executor.current_job, len(executor.pendingJobs())
+		if job is None:
+			self.progressbar.stop()
+			self.progressbar.config(mode="determinate", value=0)
+			self.status_var.set("No analysis running." if not queued else "{} job(s) queued.".format(queued))
+			return
+		if job.progress is None: # unknown progress, keep the bar moving
+			if str(self.progressbar.cget("mode")) != "indeterminate":
+				self.progressbar.config(mode="indeterminate")
+				self.progressbar.start(20)
+		else:
+			self.progressbar.stop()
+			self.progressbar.config(mode="determinate", value=100 * job.progress)
+		status = "Running: {}".format(job.name)
+		if job.cancelled():
+			status += " (cancelling...)"
+		if queued:
+			status += ", {} job(s) queued".format(queued)
+		self.status_var.set(status + ".")
+
 #############################
-#### Analysis Function 1 ####
+#### Movie Cache - Class ####
 #############################
+class MovieCache():
+	'''
+	In-process LRU store for the LazyLSMReaders of .lsm movies. Entries are keyed by (absolute path, file size,
+	modification time) plus channel and position, so a file that changes on disk is opened again. Uncompressed movies are
+	read through memory maps, compressed ones keep every frame they decode ('keep_decoded'), so a movie is decoded only
+	once no matter how often it is previewed or analyzed. Every reader is charged the size of its (decoded) movie; when
+	all readers exceed 'memory_budget' bytes, the least recently used ones are closed (dropping their memory maps and
+	decoded frames) until the budget is met. The most recently used reader is always kept, compressed movies larger
+	than the budget are decoded chunk by chunk on every read instead.
+	'''
+	def __init__(self, memory_budget=2 * 1024**3):
+		self.memory_budget = memory_budget
+		self._readers = OrderedDict() # least recently used first
+		self._lock = threading.Lock()
 
-def preprocessingFunction(image_number, cutoff1, cutoff2, file_path, save_directory, save_tiff_checkbox, save_pdf_checkbox,
-	figure_size=(9, 9)):
-	''' 
-	Analysis function 1 Doc String: Explore different filters / data pre-processing
-	The following code reads a .lsm file (maybe batches in a future version) and
-	analyses them. This includes a plot of useful statistics.
-	''' 
-	# disable popup windows (also no plt.show("hold") otherwise tkinter won't show the figure in canvas)
-	matplotlib.interactive(False)
+	def cacheKey(self, file_path):
+		'''
+		Returns the key that identifies a file's current content (path, size, mtime).
+		'''
+		file_path = os.path.abspath(file_path)
+		file_stat = os.stat(file_path)
+		return((file_path, file_stat.st_size, file_stat.st_mtime))
+
+	def reader(self, file_path, channel=0, position=0):
+		'''
+		Returns a LazyLSMReader for 'channel' at 'position' of 'file_path'. Readers are cached, so the page index of a
+		file is only parsed and its frames are only decoded once.
+		'''
+		key = self.cacheKey(file_path) + (channel, position)
+		with self._lock:
+			if key in self._readers:
+				self._readers[key] = self._readers.pop(key) # most recently used
+			else:
+				for stale_key in [k for k in self._readers if k[0] == key[0] and k[:3] != key[:3]]:
+					self._readers.pop(stale_key).close()
+				reader = LazyLSMReader(file_path, channel=channel, position=position)
+				reader.keep_decoded = reader.nbytes <= self.memory_budget
+				self._readers[key] = reader
+			self._evict()
+			return(self._readers[key])
+
+	def nbytes(self):
+		'''
+		Returns the number of bytes charged to the cached readers.
+		'''
+		return(sum(reader.nbytes for reader in self._readers.values()))
+
+	def _evict(self):
+		# closes the least recently used readers until the rest fits into the budget; an analysis that still uses an
+		# evicted reader can go on, its file is reopened but decoded frames are no longer kept
+		while len(self._readers) > 1 and self.nbytes() > self.memory_budget:
+			reader = self._readers.popitem(last=False)[1]
+			reader.keep_decoded = False
+			reader.close()
+
+	def clear(self):
+		with self._lock:
+			for reader in self._readers.values():
+				reader.close()
+			self._readers.clear()
+
+# a single cache is shared by all analysis functions
+movie_cache = MovieCache()
+
+def load_frame(file_path, frame_number, channel=0, position=0):
+	'''
+	Reads a single frame (0-indexed) of a .lsm movie without decoding the rest of the file.
+	'''
+	return(movie_cache.reader(file_path, channel=channel, position=position).read_frame(frame_number))
+
+#################################
+#### Lazy LSM Reader - Class ####
+#################################
+class LazyLSMReader():
+	'''
+	Reads single frames or ranges of frames from a .lsm (or any .tif) movie. The TIFF page offsets are used to seek
+	to the requested frames, so the rest of the file is never touched. Uncompressed frames are returned as NumPy views
+	into a read-only memory map of the file; compressed frames are decoded page by page. A page can hold several frames
+	(e.g. a whole stack in one multi-plane page), the sizes of all axes come from the series, not the number of pages.
+	The axes of the first series (thumbnail pages of .lsm files are skipped) are read from the file's metadata and named
+	'T' (time), 'C' (channel), 'P' (position) and 'Y'/'X' in 'sizes'. A reader returns the frames of one 'channel' at one
+	'position'; other channels and positions are never read. Files without a time axis use their first axis with more
+	than one entry (e.g. 'Z' or an unnamed axis) as time; any other axis is fixed at its first entry.
+	With 'keep_decoded', decoded (compressed) frames are kept in memory ('nbytes' for the whole movie) and returned
+	read-only, like memory-mapped frames. A closed reader reopens its file on the next read.
+	'''
+	channel_axes = "CS" # channels are either separate images ('C') or samples of one image ('S', e.g. RGB)
+	position_axes = "PM" # positions of a multi-position ('P') or tiled mosaic ('M') acquisition
+
+	def __init__(self, file_path, channel=0, position=0, keep_decoded=False):
+		self.file_path = file_path
+		self.keep_decoded = keep_decoded
+		self._tif = tiff.TiffFile(file_path)
+		self._lock = threading.Lock()
+		self._mmap = None
+		self._decoded, self._is_decoded = None, None
+		self._last_page = None
+
+		series = self._tif.series[0]
+		pages = list(series.pages)
+		keyframe = getattr(pages[0], "keyframe", pages[0])
+		self.axes, shape = self.seriesAxes(series, keyframe, len(pages))
+		y_axis = self.axes.index("Y")
+		frame_axes = self.axes[:y_axis] # every axis but the frame's 'Y', 'X' (and samples 'S')
+
+		# name the axes (by their index, unnamed axes share a letter): time, channel, position, rows, columns
+		find = lambda letters, axes: ([axes.index(letter) for letter in letters if letter in axes] + [None])[0]
+		channel_axis, position_axis = find(self.channel_axes, self.axes), find(self.position_axes, frame_axes)
+		time_axis = find("T", frame_axes)
+		if time_axis is None:
+			time_axis = ([i for i, length in enumerate(shape[:len(frame_axes)]) if length > 1 and
+						  i not in (channel_axis, position_axis)] + [None])[0]
+		axis_length = lambda axis: shape[axis] if axis is not None else 1
+		self.sizes = OrderedDict([("T", axis_length(time_axis)), ("C", axis_length(channel_axis)),
+								  ("P", axis_length(position_axis)), ("Y", axis_length(find("Y", self.axes))),
+								  ("X", axis_length(find("X", self.axes)))])
+		if not 0 <= channel < self.sizes["C"]:
+			raise IndexError("Channel {} does not exist ({} has {} channel(s))!".format(channel, file_path, self.sizes["C"]))
+		if not 0 <= position < self.sizes["P"]:
+			raise IndexError("Position {} does not exist ({} has {} position(s))!".format(position, file_path,
+							 self.sizes["P"]))
+		self.channel, self.position = channel, position
+
+		# page of every frame of the selected channel and position and where in the page the frame starts: the pages hold
+		# the series in order, one or several frames per page (e.g. a whole stack in one multi-plane page)
+		frame_index = [np.zeros(1, dtype=np.int64)] * len(frame_axes)
+		for axis, value in ((time_axis, np.arange(self.sizes["T"])), (channel_axis, channel), (position_axis, position)):
+			if axis is not None and axis < len(frame_axes):
+				frame_index[axis] = np.asarray(value)
+		self._plane_shape = tuple(shape[y_axis:])
+		self._plane_size = int(np.prod(self._plane_shape))
+		frame_starts = np.ravel_multi_index(np.broadcast_arrays(*frame_index), shape[:y_axis]).ravel() * self._plane_size \
+			if frame_axes else np.zeros(1, dtype=np.int64)
+		self._page_shape = tuple(keyframe.shape)
+		self._page_numbers, self._plane_starts = np.divmod(frame_starts, int(np.prod(self._page_shape)))
+		self._pages = [pages[i] for i in self._page_numbers]
+
+		self.n_frames = len(self._pages)
+		self.frame_shape = (self.sizes["Y"], self.sizes["X"])
+		self.dtype = np.dtype(self._tif.byteorder + np.dtype(keyframe.dtype).char)
+		self.nbytes = self.n_frames * int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+		# a frame holds the samples of all channels if they are stored as 'S' (last), the selected one is every n-th value
+		self._plane_index = (slice(None), slice(None)) + ((channel, ) if len(self._plane_shape) > 2 else ())
+		plane_strides = np.empty(self._plane_shape, dtype=self.dtype).strides
+		self._frame_strides = plane_strides[:2]
+		sample_offset = channel * plane_strides[2] if len(self._plane_shape) > 2 else 0
+
+		# frames can only be memory-mapped if they are stored uncompressed and in one piece
+		page_offsets = np.array([self._pageOffset(page, keyframe) for page in self._pages], dtype=np.int64)
+		self._offsets = np.where(page_offsets >= 0, page_offsets + self._plane_starts * self.dtype.itemsize + sample_offset,
+								 -1)
+		self.is_memmappable = bool(np.all(self._offsets >= 0))
+
+	@staticmethod
+	def seriesAxes(series, keyframe, n_pages):
+		'''
+		Returns the axes and shape of a series. The sizes of all axes (e.g. 'T' of a stack stored in one multi-plane page)
+		come from the series; series whose size does not match their pages (no or broken metadata) are treated as a
+		stack of 'T' pages. Raises a ValueError if the frames of the series cannot be mapped to its pages.
+		'''
+		axes, shape = str(series.axes).upper(), tuple(series.shape)
+		page_ndim, page_size = len(keyframe.shape), int(np.prod(keyframe.shape))
+		if len(axes) != len(shape) or int(np.prod(shape)) != n_pages * page_size:
+			page_axes = {2: "YX", 3: "YXS" if keyframe.shape[-1] <= 4 else "CYX"}.get(page_ndim, "Q" * (page_ndim - 2) + "YX")
+			axes, shape = "T" + page_axes, (n_pages, ) + tuple(keyframe.shape)
+		if axes.count("Y") != 1 or not axes.endswith(("YX", "YXS")):
+			raise ValueError("Cannot read series with axes '{}' (shape {}): frames must be its last axes "
+							 "('YX' or 'YXS').".format(axes, shape))
+		if page_size % int(np.prod(shape[axes.index("Y"):])):
+			raise ValueError("Cannot read series with axes '{}' (shape {}): its frames are split across pages of shape "
+							 "{}.".format(axes, shape, tuple(keyframe.shape)))
+		return(axes, shape)
+
+	def _pageOffset(self, page, keyframe):
+		# returns the file offset of a frame's data or -1 if the frame cannot be memory-mapped
+		if int(keyframe.compression) != 1 or keyframe.bitspersample != self.dtype.itemsize * 8:
+			return(-1)
+		offsets, bytecounts = page.dataoffsets, page.databytecounts
+		if not offsets:
+			return(-1)
+		for i in range(1, len(offsets)):
+			if offsets[i] != offsets[i-1] + bytecounts[i-1]:
+				return(-1)
+		if sum(bytecounts) < int(np.prod(self._page_shape)) * self.dtype.itemsize:
+			return(-1)
+		return(offsets[0])
+
+	def _memmap(self):
+		if self._mmap is None:
+			self._mmap = np.memmap(self.file_path, dtype=np.uint8, mode="r")
+		return(self._mmap)
+
+	def _checkIndex(self, index):
+		if index < 0 or index >= self.n_frames:
+			raise IndexError("Frame {} does not exist (movie has {} frames)!".format(index + 1, self.n_frames))
+
+	def read_frame(self, index):
+		'''
+		Returns frame 'index' (0-indexed) as a np.array of shape 'frame_shape'.
+		'''
+		self._checkIndex(index)
+		if self._offsets[index] >= 0:
+			return(np.ndarray(self.frame_shape, dtype=self.dtype, buffer=self._memmap(), offset=int(self._offsets[index]),
+							  strides=self._frame_strides))
+		with self._lock: # the file handle is shared and must not be used by two threads at once
+			if self._is_decoded is None or not self._is_decoded[index]:
+				self._open()
+				frame = self._readPlane(index)
+				if not self.keep_decoded:
+					return(frame)
+				if self._decoded is None:
+					self._decoded = np.empty((self.n_frames, ) + self.frame_shape, dtype=self.dtype)
+					self._is_decoded = np.zeros(self.n_frames, dtype=bool)
+				self._decoded[index] = frame
+				self._is_decoded[index] = True
+			frame = self._decoded[index]
+		frame.flags.writeable = False # a view of the kept frames
+		return(frame)
+
+	def _readPlane(self, index):
+		# decodes the page of frame 'index' and cuts the frame out, the last page is kept if a page holds several frames
+		page_number, start = self._page_numbers[index], self._plane_starts[index]
+		if self._last_page is not None and self._last_page[0] == page_number:
+			page = self._last_page[1]
+		else:
+			page = self._pages[index].asarray().reshape(-1)
+			if page.size > self._plane_size:
+				self._last_page = (page_number, page)
+		frame = page[start:start + self._plane_size].reshape(self._plane_shape)[self._plane_index]
+		return(frame.copy() if self._last_page is not None else frame)
+
+	def read_frames(self, start, stop):
+		'''
+		Returns frames 'start' until 'stop' (0-indexed, 'stop' excluded) as a np.array of shape (frames, ) + 'frame_shape'.
+		If all frames are memory-mappable and equally spaced in the file, the result is a strided view of the memory map.
+		'''
+		start, stop = max(start, 0), min(stop, self.n_frames)
+		if stop <= start:
+			return(np.empty((0, ) + self.frame_shape, dtype=self.dtype))
+		offsets = self._offsets[start:stop]
+		if np.all(offsets >= 0):
+			steps = np.diff(offsets)
+			if len(steps) == 0 or np.all(steps == steps[0]):
+				stride = int(steps[0]) if len(steps) else int(np.prod(self._page_shape)) * self.dtype.itemsize
+				return(np.ndarray((stop - start, ) + self.frame_shape, dtype=self.dtype, buffer=self._memmap(),
+								  offset=int(offsets[0]), strides=(stride, ) + self._frame_strides))
+		frames = np.empty((stop - start, ) + self.frame_shape, dtype=self.dtype)
+		for i in range(start, stop):
+			frames[i - start] = self.read_frame(i)
+		return(frames)
+
+	def _open(self):
+		# reopens the file after 'close' (e.g. a reader the movie cache evicted that is still in use)
+		if self._tif is None:
+			self._tif = tiff.TiffFile(self.file_path)
+			pages = list(self._tif.series[0].pages)
+			self._pages = [pages[i] for i in self._page_numbers]
+
+	def close(self):
+		'''
+		Closes the file and drops the memory map and all decoded frames.
+		'''
+		with self._lock:
+			if self._tif is not None:
+				self._tif.close()
+			self._tif, self._pages = None, None
+			self._decoded, self._is_decoded = None, None
+			self._last_page = None
+		self._mmap = None
+
+###################################
+#### Motion Correction - Class ####
+###################################
+def fft_backend():
+	'''
+	Returns the FFT module to use and its keyword arguments: scipy.fft (multithreaded, keeps float32) if available,
+	np.fft otherwise (scipy < 1.4).
+	'''
+	try:
+		fft.rfft2
+		return(fft, dict(workers=-1))
+	except ImportError:
+		return(np.fft, dict())
+
+class MotionCorrection():
+	'''
+	Rigid (translation only) motion correction of a .lsm movie. The shift of every frame against a reference image (mean
+	of 'reference_window' frames starting at 'reference_frame') is estimated by phase correlation with subpixel precision
+	on a central, windowed 'estimation_size' x 'estimation_size' patch. Each frame is then moved back by its shift
+	(bilinear interpolation, on 'workers' threads). Frames are read, corrected and written in chunks of 'chunk_size'
+	frames (by default as many as fit into 64 MB as float32), so the movie never has to fit into memory. Pixels that are
+	shifted in from outside the field of view are 0. Only 'channel' at 'position' is corrected.
+	The corrected movie is written to a .npy file in 'cache_directory' (the per-frame shifts go next to it), named after
+	the source (path, size, mtime, channel, position) and the reference. The correction is therefore computed once and
+	reused by later analyses of the same recording. Instances can be used like a LazyLSMReader (n_frames, frame_shape,
+	dtype, read_frame, read_frames), e.g. as input of AnalyzeSingleCells; 'shifts' holds the (row, column) shift of
+	every frame in pixels.
+	'''
+	def __init__(self, file_path, cache_directory=None, reference_frame=0, reference_window=10, estimation_size=256,
+				 chunk_size=None, workers=None, channel=0, position=0, progress=None):
+		self.file_path = file_path
+		self.channel, self.position = channel, position
+		self.workers = workers or multiprocessing.cpu_count()
+		self.cache_directory = cache_directory or os.path.join(tempfile.gettempdir(), "calcium_analyzer_cache")
+		self.reference_frame, self.reference_window = int(reference_frame), int(reference_window)
+		self.estimation_size = int(estimation_size)
+		self.chunk_size = chunk_size
+		self.corrected_path, self.shifts_path = self.cachePaths()
+
+		if not (os.path.exists(self.corrected_path) and os.path.exists(self.shifts_path)):
+			self.correct(progress=progress)
+		else:
+			print("Using motion corrected movie from {}.".format(self.corrected_path))
+		self._movie = np.load(self.corrected_path, mmap_mode="r")
+		self.shifts = np.load(self.shifts_path)
+		self.n_frames = self._movie.shape[0]
+		self.frame_shape = tuple(self._movie.shape[1:])
+		self.dtype = self._movie.dtype
+
+	def cachePaths(self):
+		'''
+		Returns the paths of the corrected movie and of the shifts in the cache directory.
+		'''
+		source_key = "{}|{}|{}|{}|{}|{}|{}|{}".format(*(movie_cache.cacheKey(self.file_path) + (self.reference_frame,
+													  self.reference_window, self.estimation_size, self.channel, self.position)))
+		source_hash = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:8]
+		base_path = os.path.join(self.cache_directory, "{}_{}_motion_corrected".format(recording_name(self.file_path),
+								 source_hash))
+		return(base_path + ".npy", base_path + "_shifts.npy")
+
+	def correct(self, progress=None):
+		'''
+		Estimates the shifts and writes the corrected movie (via temporary '.part' files, so that an interrupted
+		correction is never mistaken for a finished one). 'progress' is called with the finished fraction.
+		'''
+		if not os.path.exists(self.cache_directory):
+			os.makedirs(self.cache_directory)
+		timer_start = timeit.default_timer()
+		fft_module, fft_options = fft_backend()
+		reader = LazyLSMReader(self.file_path, channel=self.channel, position=self.position)
+		pool = ThreadPool(self.workers) if self.workers > 1 else None # numpy releases the GIL while frames are shifted
+		movie_part_path, shifts_part_path = self.corrected_path + ".part", self.shifts_path + ".part"
+		try:
+			n_frames, frame_shape = reader.n_frames, reader.frame_shape
+			dtype = reader.dtype.newbyteorder("=")
+			patch, window = self.estimationPatch(frame_shape)
+			first = min(max(self.reference_frame, 0), n_frames - 1)
+			reference = reader.read_frames(first, first + self.reference_window).astype(np.float32).mean(axis=0)[patch]
+			reference_spectrum = np.conj(fft_module.rfft2((reference - reference.mean()) * window, **fft_options))
+
+			chunk_size = self.chunk_size or max(1, 64 * 1024**2 // (4 * frame_shape[0] * frame_shape[1]))
+			shifts = np.zeros((n_frames, 2), dtype=np.float32)
+			corrected_movie = np.lib.format.open_memmap(movie_part_path, mode="w+", dtype=dtype,
+														shape=(n_frames, ) + frame_shape)
+			corrected = np.empty((chunk_size, ) + frame_shape, dtype=np.float32)
+			for start in range(0, n_frames, chunk_size):
+				stop = min(start + chunk_size, n_frames)
+				frames = reader.read_frames(start, stop).astype(np.float32)
+				patches = frames[(slice(None), ) + patch]
+				patches = (patches - patches.mean(axis=(1, 2), keepdims=True)) * window
+				spectra = fft_module.rfft2(patches, **fft_options)
+				shifts[start:stop] = self.estimateShifts(spectra, reference_spectrum, window.shape, fft_module, fft_options)
+
+				def shift_frame(i):
+					self.shiftFrame(frames[i], shifts[start + i], out=corrected[i])
+				if pool is not None:
+					pool.map(shift_frame, range(stop - start))
+				else:
+					for i in range(stop - start):
+						shift_frame(i)
+				if np.issubdtype(dtype, np.integer):
+					np.rint(corrected[:stop - start], out=corrected[:stop - start])
+					np.clip(corrected[:stop - start], np.iinfo(dtype).min, np.iinfo(dtype).max, out=corrected[:stop - start])
+				corrected_movie[start:stop] = corrected[:stop - start]
+				if progress is not None:
+					progress(float(stop) / n_frames)
+
+			corrected_movie.flush()
+			del corrected_movie
+			with open(shifts_part_path, "wb") as shifts_file:
+				np.save(shifts_file, shifts)
+		except:
+			for part_path in (movie_part_path, shifts_part_path):
+				if os.path.exists(part_path):
+					os.remove(part_path)
+			raise
+		finally:
+			reader.close()
+			if pool is not None:
+				pool.close()
+		for part_path, path in ((movie_part_path, self.corrected_path), (shifts_part_path, self.shifts_path)):
+			if os.path.exists(path): # os.rename does not overwrite on windows
+				os.remove(path)
+			os.rename(part_path, path)
+		print("Motion correction of {} frames done ({:.1f} sec, max. shift {:.1f} pixels).".format(n_frames,
+			timeit.default_timer() - timer_start, float(np.abs(shifts).max()) if n_frames else 0.0))
+
+	def estimationPatch(self, frame_shape):
+		'''
+		Returns the slices of the central patch the shifts are estimated on and a 2D Hann window of the patch's shape
+		(suppresses the edges, which would otherwise dominate the correlation).
+		'''
+		patch = tuple(slice((length - min(length, self.estimation_size)) // 2,
+							(length + min(length, self.estimation_size)) // 2) for length in frame_shape)
+		window = np.outer(np.hanning(patch[0].stop - patch[0].start), np.hanning(patch[1].stop - patch[1].start))
+		return(patch, window.astype(np.float32))
+
+	@staticmethod
+	def estimateShifts(spectra, reference_spectrum, patch_shape, fft_module=np.fft, fft_options=dict()):
+		'''
+		Returns the (row, column) displacement of each frame relative to the reference, estimated by phase correlation.
+		The integer peak of the correlation is refined by fitting a parabola through it and its neighbors (per axis).
+		'''
+		cross_power = spectra * reference_spectrum
+		cross_power /= np.abs(cross_power) + np.finfo(np.float32).eps
+		correlation = fft_module.irfft2(cross_power, s=patch_shape, **fft_options)
+
+		n_frames, (height, width) = correlation.shape[0], patch_shape
+		index = np.arange(n_frames)
+		rows, cols = np.unravel_index(correlation.reshape(n_frames, -1).argmax(axis=1), patch_shape)
+		center = correlation[index, rows, cols]
+
+		def subpixel_offset(minus, plus):
+			curvature = minus - 2 * center + plus
+			with np.errstate(divide="ignore", invalid="ignore"):
+				offset = np.where(curvature < 0, 0.5 * (minus - plus) / curvature, 0.0)
+			return(np.clip(offset, -0.5, 0.5))
+
+		row_shifts = rows + subpixel_offset(correlation[index, (rows - 1) % height, cols],
+											correlation[index, (rows + 1) % height, cols])
+		col_shifts = cols + subpixel_offset(correlation[index, rows, (cols - 1) % width],
+											correlation[index, rows, (cols + 1) % width])
+		# the correlation is circular, peaks in the second half are negative shifts
+		row_shifts = np.where(row_shifts > height / 2.0, row_shifts - height, row_shifts)
+		col_shifts = np.where(col_shifts > width / 2.0, col_shifts - width, col_shifts)
+		return(np.stack([row_shifts, col_shifts], axis=1).astype(np.float32))
+
+	@staticmethod
+	def shiftFrame(frame, shift, out):
+		'''
+		Writes 'frame' moved back by 'shift' (its (row, column) displacement) to 'out', i.e. out[y, x] = frame[y + shift]
+		with bilinear interpolation. Pixels without data in 'frame' are 0.
+		'''
+		height, width = frame.shape
+		integer_shift = np.floor(shift).astype(int)
+		row_fraction, col_fraction = [float(fraction) for fraction in shift - integer_shift] # keeps 'frame' float32
+		out[...] = 0
+		neighbors = [(0, 0, (1 - row_fraction) * (1 - col_fraction)), (0, 1, (1 - row_fraction) * col_fraction),
+					 (1, 0, row_fraction * (1 - col_fraction)), (1, 1, row_fraction * col_fraction)]
+		for row_step, col_step, weight in neighbors:
+			row, col = integer_shift[0] + row_step, integer_shift[1] + col_step
+			if weight == 0 or abs(row) >= height or abs(col) >= width:
+				continue
+			source = frame[max(0, row):height - max(0, -row), max(0, col):width - max(0, -col)]
+			out[max(0, -row):height - max(0, row), max(0, -col):width - max(0, col)] += weight * source
+		# rows/columns that are only partially covered by 'frame' have no valid data either
+		row_border, col_border = int(np.ceil(abs(shift[0]))), int(np.ceil(abs(shift[1])))
+		if row_border:
+			out[(slice(height - row_border, None) if shift[0] > 0 else slice(0, row_border)), :] = 0
+		if col_border:
+			out[:, (slice(width - col_border, None) if shift[1] > 0 else slice(0, col_border))] = 0
+		return(out)
+
+	def read_frame(self, index):
+		if index < 0 or index >= self.n_frames:
+			raise IndexError("Frame {} does not exist (movie has {} frames)!".format(index + 1, self.n_frames))
+		return(self._movie[index])
+
+	def read_frames(self, start, stop):
+		return(self._movie[max(start, 0):min(stop, self.n_frames)])
+
+	def close(self):
+		self._movie = None
+
+##################################
+#### Projection Image - Class ####
+##################################
+projection_modes = ("max", "mean", "std", "percentile")
+
+def project_movie(movie, mode="max", percentile=95, memory_budget=256 * 1024**2, progress=None):
+	'''
+	Collapses a movie (any frame source like a LazyLSMReader or MotionCorrection) into one image in a single pass over its
+	frames: the per-pixel 'max', 'mean', standard deviation ('std') or 'percentile'. Frames are read in chunks of about
+	64 MB and only per-pixel sums are kept, so memory does not grow with the length of the movie. A percentile needs the
+	values of all frames at once; if they do not fit into 'memory_budget' (in bytes), only every n-th frame is used.
+	'max' keeps the dtype of the movie, all other projections are float32. 'progress' is called with the finished
+	fraction.
+	'''
+	if mode not in projection_modes:
+		raise ValueError("Enter a valid projection! ({})".format(", ".join(projection_modes)))
+	n_frames, frame_shape = movie.n_frames, tuple(movie.frame_shape)
+	if n_frames == 0:
+		raise ValueError("Cannot project a movie without frames!")
+	n_pixels = int(np.prod(frame_shape))
+
+	if mode == "percentile":
+		step = max(1, int(np.ceil(n_frames * n_pixels * movie.dtype.itemsize / float(memory_budget))))
+		frame_indices = range(0, n_frames, step)
+		frames = np.empty((len(frame_indices), ) + frame_shape, dtype=movie.dtype.newbyteorder("="))
+		for i, index in enumerate(frame_indices):
+			frames[i] = movie.read_frame(index)
+			if progress is not None:
+				progress(0.5 * (i + 1) / len(frame_indices))
+		# np.percentile copies its input, so blocks of rows are reduced one after the other
+		projection = np.empty(frame_shape, dtype=np.float32)
+		block_rows = max(1, 64 * 1024**2 // (8 * len(frame_indices) * frame_shape[1]))
+		for row in range(0, frame_shape[0], block_rows):
+			projection[row:row + block_rows] = np.percentile(frames[:, row:row + block_rows], percentile, axis=0)
+		return(projection)
+
+	# mean and standard deviation are accumulated as deviations from the first frame, which keeps the float32 chunk
+	# arithmetic precise (the shifted sums are small) while the totals are kept in float64
+	chunk_size = max(1, 64 * 1024**2 // (4 * n_pixels))
+	projection, total, squares = None, None, None
+	for start in range(0, n_frames, chunk_size):
+		frames = movie.read_frames(start, min(start + chunk_size, n_frames))
+		if mode == "max":
+			chunk_max = frames.max(axis=0)
+			projection = chunk_max if projection is None else np.maximum(projection, chunk_max, out=projection)
+		else:
+			if projection is None:
+				projection = frames[0].astype(np.float32)
+				total, squares = np.zeros(frame_shape), np.zeros(frame_shape)
+			deviations = frames.astype(np.float32)
+			deviations -= projection
+			total += deviations.sum(axis=0)
+			if mode == "std":
+				np.square(deviations, out=deviations)
+				squares += deviations.sum(axis=0)
+		if progress is not None:
+			progress(float(min(start + chunk_size, n_frames)) / n_frames)
+
+	if mode == "max":
+		return(np.array(projection, dtype=projection.dtype.newbyteorder("=")))
+	mean_deviation = total / n_frames
+	if mode == "std":
+		return(np.sqrt(np.clip(squares / n_frames - mean_deviation**2, 0, None)).astype(np.float32))
+	return((projection + mean_deviation).astype(np.float32))
+
+def projection_image(file_path, mode="max", percentile=95, movie=None, cache_directory=None, channel=0, position=0,
+	progress=None):
+	'''
+	Returns the projection (see project_movie) of 'channel' at 'position' of the .lsm movie at 'file_path' or of 'movie'
+	(e.g. its motion corrected version). Projections are saved as .npy files in 'cache_directory', named after the
+	source (path, size, mtime, channel, position) and the projection, and are only computed once per file.
+	'''
+	cache_directory = cache_directory or os.path.join(tempfile.gettempdir(), "calcium_analyzer_cache")
+	source_path = getattr(movie, "corrected_path", None) or file_path # the corrected movie has a cache key of its own
+	source_key = "{}|{}|{}|{}|{}|{}|{}".format(*(movie_cache.cacheKey(source_path) + (mode, percentile, channel, position)))
+	source_hash = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:8]
+	projection_path = os.path.join(cache_directory, "{}_{}_{}_projection.npy".format(recording_name(file_path),
+								   source_hash, mode))
+	if os.path.exists(projection_path):
+		print("Using {} projection from {}.".format(mode, projection_path))
+		return(np.load(projection_path))
+
+	projection = project_movie(movie or movie_cache.reader(file_path, channel=channel, position=position), mode=mode,
+							   percentile=percentile,
+							   progress=progress)
+	if not os.path.exists(cache_directory):
+		os.makedirs(cache_directory)
+	with open(projection_path + ".part", "wb") as projection_file:
+		np.save(projection_file, projection)
+	if os.path.exists(projection_path): # os.rename does not overwrite on windows
+		os.remove(projection_path)
+	os.rename(projection_path + ".part", projection_path)
+	return(projection)
+
+###################################
+#### Background Export - Class ####
+###################################
+def tiff_compression_options(level):
+	'''
+	Returns the zlib compression keyword arguments for TiffWriter.save/write of the installed tifffile version.
+	'''
+	writer = getattr(tiff.TiffWriter, "write", None) or tiff.TiffWriter.save
+	getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+	specification = getargspec(writer)
+	arguments = specification.args + list(getattr(specification, "kwonlyargs", []))
+	if "compressionargs" in arguments: # tifffile >= 2022.7
+		return(dict(compression="zlib", compressionargs=dict(level=level)))
+	if "compression" in arguments:
+		return(dict(compression=("zlib", level)))
+	return(dict(compress=level)) # tifffile < 2018.10
+
+class BackgroundWriter():
+	'''
+	Writes files one after another on a daemon thread, so that the GUI (or an analysis) does not wait for the disk.
+	Subclasses queue jobs with '_queue(key, job)' and implement '_writeJob(*job)'; a key can only be queued once at a
+	time. The thread is started with the first job (and again in forked batch workers, threads do not survive a fork).
+	'''
+	def __init__(self):
+		self._in_progress = set()
+		self._lock = threading.Lock()
+		self._jobs = queue.Queue()
+		self._worker = None
+
+	def _startWorker(self):
+		if self._worker is None or not self._worker.is_alive():
+			self._worker = threading.Thread(target=self._run, name=type(self).__name__)
+			self._worker.daemon = True # do not keep the app alive after the window was closed
+			self._worker.start()
+
+	def _queue(self, key, job):
+		# returns False if 'key' is already queued
+		with self._lock:
+			if key in self._in_progress:
+				return(False)
+			self._in_progress.add(key)
+			self._startWorker()
+		self._jobs.put((key, job))
+		return(True)
+
+	def pending(self):
+		with self._lock:
+			return(len(self._in_progress))
+
+	def wait(self):
+		'''
+		Blocks until all queued jobs are written (e.g. before a batch worker or the app exits).
+		'''
+		self._jobs.join()
+
+	def _run(self):
+		# worker thread: write queued jobs forever
+		while True:
+			key, job = self._jobs.get()
+			try:
+				self._writeJob(*job)
+			except Exception:
+				traceback.print_exc()
+			finally:
+				with self._lock:
+					self._in_progress.discard(key)
+				self._jobs.task_done()
+
+class TiffExporter(BackgroundWriter):
+	'''
+	Writes .tif copies of input movies on a background thread, so that a preview does not wait for the export.
+	Exports are zlib compressed (level 1, higher levels are ~3x slower for a few % smaller files), tiled and BigTIFF,
+	frames are streamed from the source file (never the whole movie in memory, tifffile >= 2019 only). The file name is
+	derived from the source (path, size, mtime), so an existing export of the same, unchanged source is not written again.
+	Files are written to a temporary '.part' file first and renamed when complete, i.e. a .tif in 'tiffs/' is never a
+	partial export (unfinished exports are written again next time).
+	'''
+	def __init__(self, compression_level=1, tile=(256, 256)):
+		BackgroundWriter.__init__(self)
+		self.compression_level = compression_level
+		self.tile = tile
+
+	def exportPath(self, file_path, save_directory):
+		'''
+		Returns the path the export of 'file_path' is written to, e.g. 'tiffs/experiment_1_3f2a9c1e.tif'.
+		'''
+		source_key = "{}|{}|{}".format(*movie_cache.cacheKey(file_path))
+		source_hash = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:8]
+		return("{dir}/tiffs/{name}_{hash}.tif".format(dir=save_directory, name=recording_name(file_path), hash=source_hash))
 
+	def submit(self, file_path, save_directory):
+		'''
+		Queues the export of 'file_path' and returns the export path. Returns None if the export already exists or is
+		already queued.
+		'''
+		export_path = self.exportPath(file_path, save_directory)
+		if os.path.exists(export_path) or not self._queue(export_path, (file_path, export_path)):
+			return(None)
+		return(export_path)
+
+	def _writeJob(self, file_path, export_path):
+		try:
+			timer_start = timeit.default_timer()
+			self.write(file_path, export_path)
+			print("Image saved to: {} ({:.1f} sec).".format(export_path, timeit.default_timer() - timer_start))
+		except Exception:
+			traceback.print_exc()
+			print("You did not save a .tif! Check the specified save directory!")
+
+	def write(self, file_path, export_path):
+		'''
+		Writes the export of 'file_path' (all channels and positions) to 'export_path' on the calling thread.
+		'''
+		part_path = export_path + ".part"
+		reader = LazyLSMReader(file_path) # own file handles, the movie cache may close its readers at any time
+		readers = [[reader if channel == position == 0 else LazyLSMReader(file_path, channel=channel, position=position)
+					for channel in range(reader.sizes["C"])] for position in range(reader.sizes["P"])]
+		try:
+			# one stack of positions, frames and channels; axes with a single entry (e.g. one channel) are left out
+			axes = "".join(axis for axis in "PTC" if axis == "T" or reader.sizes[axis] > 1) + "YX"
+			shape = tuple(reader.sizes[axis] for axis in axes)
+			options = tiff_compression_options(self.compression_level)
+			with tiff.TiffWriter(part_path, bigtiff=True) as writer:
+				if hasattr(writer, "write"): # tifffile >= 2019: stream tile by tile
+					writer.write(self._tiles(readers), shape=shape, dtype=reader.dtype.newbyteorder("="), tile=self.tile,
+								 metadata=dict(axes=axes), **options)
+				else:
+					movie = np.stack([np.stack([channel_reader.read_frames(0, reader.n_frames) for channel_reader in
+												position_readers], axis=1) for position_readers in readers])
+					writer.save(movie.reshape(shape), tile=self.tile, metadata=dict(axes=axes), **options)
+		except:
+			if os.path.exists(part_path):
+				os.remove(part_path)
+			raise
+		finally:
+			for position_readers in readers:
+				for channel_reader in position_readers:
+					channel_reader.close()
+		if os.path.exists(export_path): # os.rename does not overwrite on windows
+			os.remove(export_path)
+		os.rename(part_path, export_path)
+
+	def _tiles(self, readers):
+		# yields all tiles of all frames in the order tifffile writes them (position by position, frame by frame,
+		# channel by channel, row by row, edge tiles padded)
+		tile_rows, tile_cols = self.tile
+		for position_readers in readers:
+			for index in range(position_readers[0].n_frames):
+				for reader in position_readers:
+					frame = reader.read_frame(index)
+					dtype = reader.dtype.newbyteorder("=")
+					for row in range(0, frame.shape[0], tile_rows):
+						for col in range(0, frame.shape[1], tile_cols):
+							tile = frame[row:row + tile_rows, col:col + tile_cols]
+							if tile.shape != self.tile:
+								tile = np.pad(tile, ((0, tile_rows - tile.shape[0]), (0, tile_cols - tile.shape[1])),
+											  "constant")
+							yield(np.ascontiguousarray(tile, dtype=dtype))
+
+tiff_exporter = TiffExporter()
+
+def export_tiffs(save_directory, file_path, save_tiff_checkbox):
+	'''
+	This function queues a compressed .tif copy of the input movie for export to the 'tiffs/' folder of the save
+	directory (see TiffExporter) and returns immediately.
+	'''
+	if save_tiff_checkbox:
+		export_path = tiff_exporter.submit(file_path=file_path, save_directory=save_directory)
+		if export_path is None:
+			print("An export of {} already exists in {}/{}!".format(file_path, save_directory, "tiffs"))
+		else:
+			print("Writing .tif to {} in the background...".format(export_path))
+	else:
+		print("No .tif files written to {}/{}!".format(save_directory, "tiffs"))
+
+def figure_snapshot(figure):
+	'''
+	Returns a pickled copy of 'figure' that can be drawn on another thread, or None if the figure cannot be pickled.
+	'''
+	canvas = figure.canvas
+	FigureCanvasAgg(figure) # detached from pyplot and Tk, unpickling the copy does not create a window
+	try:
+		return(pickle.dumps(figure, pickle.HIGHEST_PROTOCOL))
+	except Exception:
+		return(None)
+	finally:
+		figure.set_canvas(canvas)
+
+def rasterize_heavy_artists(figure, max_vector_lines=50, max_vector_points=5000):
+	'''
+	Rasterizes the data layer of the axes that make vector files large and slow: axes with images, collections (contours,
+	scatter plots, line collections), more than 'max_vector_lines' lines or more than 'max_vector_points' points in one
+	line. Images, collections, patches and lines of such axes are drawn into one image per axes; spines, ticks, labels,
+	text and legends stay vector graphics.
+	'''
+	for axis in figure.axes:
+		lines = axis.get_lines()
+		if (axis.images or axis.collections or len(lines) > max_vector_lines or
+			any(len(line.get_xdata()) > max_vector_points for line in lines)):
+			axis.set_rasterization_zorder(2.1) # lines have zorder 2, spines/axes 2.5, text 3 and legends 5
+
+class FigureExporter(BackgroundWriter):
+	'''
+	Saves figures on a background thread in any combination of 'formats' ('pdf', 'png', 'svg'). In .pdf and .svg files,
+	heavy artists (see rasterize_heavy_artists) are embedded as images with 'dpi' dots per inch, .png files use the same
+	dpi. A copy of the figure is exported, so the original can be shown, changed or closed right after 'submit'. Figures
+	that cannot be copied (pickled) are saved on the calling thread instead.
+	'''
+	def __init__(self, formats=("pdf", ), dpi=150, max_vector_lines=50, max_vector_points=5000):
+		BackgroundWriter.__init__(self)
+		self.formats = formats
+		self.dpi = dpi
+		self.max_vector_lines = max_vector_lines
+		self.max_vector_points = max_vector_points
+		self._counter = itertools.count()
+
+	def submit(self, figure, base_path, formats=None, dpi=None):
+		'''
+		Queues 'figure' for export to 'base_path' + '.pdf' (.png, .svg) and returns the list of file paths.
+		'''
+		formats, dpi = formats or self.formats, dpi or self.dpi
+		snapshot = figure_snapshot(figure)
+		if snapshot is None:
+			self.write(figure, base_path, formats, dpi)
+		else:
+			self._queue(next(self._counter), (snapshot, base_path, formats, dpi))
+		return(["{}.{}".format(base_path, file_format) for file_format in formats])
+
+	def _writeJob(self, snapshot, base_path, formats, dpi):
+		try:
+			self.write(pickle.loads(snapshot), base_path, formats, dpi)
+			print("Figure saved to: {}.{}".format(base_path, "/.".join(formats)))
+		except Exception:
+			traceback.print_exc()
+			print("You did not save a figure! Check the specified save directory!")
+
+	def write(self, figure, base_path, formats, dpi):
+		'''
+		Saves 'figure' in all 'formats' on the calling thread. Heavy artists of the figure are rasterized, i.e. the figure
+		is changed; the background thread only writes copies.
+		'''
+		FigureCanvasAgg(figure)
+		rasterize_heavy_artists(figure, max_vector_lines=self.max_vector_lines, max_vector_points=self.max_vector_points)
+		for file_format in formats:
+			figure.savefig("{}.{}".format(base_path, file_format), format=file_format, dpi=dpi)
+
+figure_exporter = FigureExporter()
+
+#################################
+#### Pixel Histogram - Class ####
+#################################
+class PixelHistogram():
+	'''
+	Gray value histogram of an image that is computed once (np.bincount) and then answers all cutoff related questions
+	from its cumulative sum: the percentage of pixels below any number of cutoffs, binned histograms for plotting and
+	automatic thresholds. Works for 8-, 12- and 16-bit images alike.
+	'''
+	def __init__(self, image):
+		pixels = np.asarray(image).ravel()
+		if not np.issubdtype(pixels.dtype, np.integer):
+			pixels = np.floor(np.clip(pixels, 0, None)).astype(np.int64) # gray values of float images are truncated
+		self.counts = np.bincount(pixels)
+		self.cumulative_counts = np.cumsum(self.counts)
+		self.n_pixels = int(self.cumulative_counts[-1])
+		self.max_value = len(self.counts) - 1
+
+	def percentBelow(self, cutoffs):
+		'''
+		Returns the percentage of pixels with a gray value strictly below each of the 'cutoffs'.
+		'''
+		below = np.concatenate(([0], self.cumulative_counts))
+		return(below[np.clip(np.asarray(cutoffs, dtype=np.int64), 0, self.max_value + 1)] * 100.0 / self.n_pixels)
+
+	def percentileThreshold(self, percent):
+		'''
+		Returns the smallest cutoff that puts at least 'percent' % of all pixels below the cutoff.
+		'''
+		return(int(np.searchsorted(self.cumulative_counts * 100.0 / self.n_pixels, percent, side="left")) + 1)
+
+	def otsuThreshold(self):
+		'''
+		Returns the gray value cutoff that maximizes the between-class variance (Otsu's method). Pixels >= cutoff are
+		foreground, in line with the 'pixel_threshold' of ConnectedComponentsLabeling. Images with a single gray value
+		return 'max_value'.
+		'''
+		gray_values = np.arange(len(self.counts), dtype=np.float64)
+		weight_background = self.cumulative_counts[:-1].astype(np.float64)
+		weight_foreground = self.n_pixels - weight_background
+		sum_background = np.cumsum(gray_values * self.counts)[:-1]
+		sum_foreground = np.sum(gray_values * self.counts) - sum_background
+		with np.errstate(divide="ignore", invalid="ignore"):
+			between_variance = weight_background * weight_foreground * \
+				(sum_background / weight_background - sum_foreground / weight_foreground)**2
+		finite = np.isfinite(between_variance)
+		if not np.any(finite): # a single gray value (e.g. a constant frame) cannot be split into two classes
+			return(self.max_value)
+		return(int(np.argmax(np.where(finite, between_variance, -np.inf))) + 1)
+
+#############################
+#### Analysis Function 1 ####
+#############################
+
+def preprocessingData(image_number, file_path, save_directory, save_tiff_checkbox, channel=0, position=0):
+	'''
+	Reads everything the preview figure needs (selected frame of 'channel' at 'position', number of frames, sizes of all
+	axes, gray value histogram) and saves the input as .tif if the checkbox is checked. Returns a dictionary or False
+	if no .lsm file was specified.
+	This part does not touch any GUI element and can run on a background thread.
+	'''
 	# read in .lsm data and return a numpy array with certain dimensions: 
 	if file_path and file_path.endswith(".lsm"):
 		try:
-			image = tiff.imread(file_path)
+			reader = movie_cache.reader(file_path, channel=channel, position=position) # only the selected frame is read
 			print("You successfully imported a .lsm file from:" + "\n" + str(file_path) + ".")
-			selected_image = (image[0, 0, (int(image_number)-1), 0:512, 0:512])
+			print("Axes: " + ", ".join("{}={}".format(axis, length) for axis, length in reader.sizes.items()) + ".")
+			selected_image = reader.read_frame(int(image_number)-1)
 			print("You selected image number {}.".format(str(image_number)))
 		except Exception as error: # raise exception if user has no permission to write in directory!
 			raise error
@@ -356,112 +1547,271 @@ def preprocessingFunction(image_number, cutoff1, cutoff2, file_path, save_direct
 
 	# create new directories for output files and save tiffs if checkbox is checked	
 	create_new_directories(save_directory=save_directory)
-	save_tiffs(save_directory=save_directory, image=image, save_tiff_checkbox=save_tiff_checkbox)
+	export_tiffs(save_directory=save_directory, file_path=file_path, save_tiff_checkbox=save_tiff_checkbox)
+
+	return(dict(selected_image=selected_image, n_frames=reader.n_frames, sizes=reader.sizes,
+				histogram=PixelHistogram(image=selected_image)))
+
+def downsample_image(image, max_size=256):
+	'''
+	Block-averages an image so that no side is longer than 'max_size' pixels. Returns the small image (float32) and the
+	column and row coordinates of the block centers in pixels of the original image.
+	'''
+	image = np.asarray(image)
+	factor = int(max(1, -(-max(image.shape) // max_size)))
+	n_rows, n_cols = max(1, image.shape[0] // factor), max(1, image.shape[1] // factor)
+	if factor == 1 or min(image.shape) < factor:
+		small = image.astype(np.float32)
+		factor, n_rows, n_cols = 1, image.shape[0], image.shape[1]
+	else:
+		small = image[:n_rows * factor, :n_cols * factor].reshape(n_rows, factor, n_cols, factor).mean(axis=(1, 3),
+																									   dtype=np.float32)
+	return(small, np.arange(n_cols) * factor + (factor - 1) / 2.0, np.arange(n_rows) * factor + (factor - 1) / 2.0)
+
+class PreviewFigure():
+	'''
+	The exploratory data analysis figure (image, contours, histogram, pixels below cutoff, contours of the masked image)
+	as a persistent object. All artists are created once, 'update' only moves the cutoff lines, relabels legends and
+	titles and redraws the contours of the two masked images. Contours are computed on a block-averaged copy of the image
+	of at most 'contour_size' pixels per side (about the size of a panel on screen, see downsample_image), which is
+	masked instead of the full image.
+	The changing artists are animated: once the figure is shown on a canvas, the background of every region with animated
+	artists (the three panels with cutoff lines, the two masked images with their titles) is cached. An update restores,
+	redraws and blits only the regions that changed, so a new cutoff takes milliseconds. Saved figures contain all
+	artists.
+	'''
+	def __init__(self, preview_data, image_number, file_path, cutoff1, cutoff2, figure_size=(9, 9), contour_size=256):
+		self.preview_data = preview_data
+		self.contour_image, self.contour_x, self.contour_y = downsample_image(preview_data["selected_image"], contour_size)
+		self.contour_y = (preview_data["selected_image"].shape[0] - 1) - self.contour_y # like origin="image", row 0 on top
+		self.cutoffs = [cutoff1, cutoff2]
+		self.backgrounds = None # one cached background per region, see onDraw
+		self.figure = self.createFigure(image_number=image_number, file_path=file_path, figure_size=figure_size)
+		self.figure.canvas.mpl_connect("draw_event", self.onDraw)
+
+	def contour(self, axes, image):
+		# an image without any contour level (e.g. everything masked) gives an empty plot instead of a warning
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore")
+			contour_set = axes.contour(self.contour_x, self.contour_y, image, cmap="gray")
+		return(contour_set)
+
+	def contourArtists(self, contour_set):
+		# a ContourSet is one artist in newer matplotlib versions, a list of collections in older ones
+		if isinstance(contour_set, matplotlib.artist.Artist):
+			return([contour_set])
+		return(list(contour_set.collections))
+
+	def createFigure(self, image_number, file_path, figure_size):
+		selected_image = self.preview_data["selected_image"]
+		histogram = self.preview_data["histogram"]
+
+		# disable popup windows (also no plt.show("hold") otherwise tkinter won't show the figure in canvas)
+		matplotlib.interactive(False)
+
+		# plot your image (use .set_action methods for axes!)
+		fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = plt.subplots(nrows=2, ncols=3, figsize=figure_size)
+		if getattr(fig.canvas, "manager", None) is not None: # figures of headless (Agg) batch runs have no window
+			fig.canvas.manager.set_window_title("Figure of {}".format(str(file_path)))
+		fig.subplots_adjust(wspace=0.2, hspace=0.2, right=0.98, left=0.10, bottom=0.07, top=0.93)
+
+		# subplot (1, 1)
+		ax1.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False)
+		im1 = ax1.imshow(selected_image, cmap="viridis", interpolation="bicubic")
+		# colormaps "jet", "gray, "viridis" work
+		# "bicubic" interpolation smoothes the edges, "nearest" leads to a more pixelated figure
+		colbar_ax = fig.add_axes([0.02, 0.57, 0.035, 0.33])
+		# Add axes for colorbar at [left, bottom, width, height] (quantities are in fractions of figure)
+		fig.colorbar(im1, cax=colbar_ax)
+		ax1.set_title("Image {} of {}".format(str(image_number), str(self.preview_data["n_frames"])))
+
+		# create a contour figure that extracts prominent features (origin upper left corner)
+		self.contour(ax2, self.contour_image)
+		ax2.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False) # Hide the axis but leave the spine
+		ax2.set_title("Feature Extraction without\nPrior Background Reduction")
+
+		# analyze the effect of masking certain pixel values from the image:
+		# first, a histogram helps to see the distribution of pixel values (binned from the gray value counts, so that 12-
+		# and 16-bit images are as fast as 8-bit images)
+		hist_range = max(256, histogram.max_value + 1)
+		ax3.hist(np.arange(len(histogram.counts)), weights=histogram.counts, bins=256, range=(0.0, float(hist_range)),
+				 fc="k", ec="k")
+		try:
+			ax3.set_yscale("log", nonpositive="clip")
+		except (TypeError, ValueError): # matplotlib < 3.3 (python 2.7)
+			ax3.set_yscale("log", nonposy="clip")
+		ax3.set_title("Histogram of Gray Scale\nValues in Image {}".format(str(image_number)))
+		ax3.tick_params(width=1.5, which="both", labelsize=12)
+
+		# second, a scatter plot demonstrating the number of pixels below certain cutoff (at most ~1000 points are drawn)
+		cutoffs = np.arange(histogram.max_value)
+		pixel_values = histogram.percentBelow(cutoffs)
+		cutoffs, pixel_values = cutoffs[::max(1, len(cutoffs) // 1024)], pixel_values[::max(1, len(cutoffs) // 1024)]
+
+		# create another subplot where subplot '4' would usually be and plot scatter plot with y axis break
+		# also, determine optimal break point for the upper panel ax4_1 using the second smallest pixel value
+		y_limits_top = (pixel_values[1] - 2, 102) if len(pixel_values) > 1 else (-2, 102)
+		y_limits_bottom = (-0.5, 2)
+
+		ax4_1 = plt.subplot2grid((6, 3), (3, 0), rowspan=2) # 0-indexed!
+		ax4_2 = plt.subplot(6, 3, 16)
+		ax4_1.scatter(x=cutoffs, y=pixel_values, s=20, c="darkred")
+		ax4_1.set_title("% of Pixels Below Gray Scale Cutoff")
+		ax4_1.tick_params(width=1.5, labelsize=12)
+		ax4_1.set_ylim(y_limits_top)
+		ax4_1.tick_params(bottom = False, labelbottom = False)
+
+		ax4_2.scatter(x=cutoffs, y=pixel_values, s=20, c="darkred")
+		ax4_2.tick_params(width=1.5, labelsize=12)
+		ax4_2.set_ylim(y_limits_bottom)
+		ax4_2.set_xlabel("Gray Scale Value Cutoff")
+
+		# cutoff lines (one per cutoff and panel) and legends, these are moved and relabeled by 'update'
+		self.cutoff_axes = [ax3, ax4_1, ax4_2]
+		self.cutoff_lines = list()
+		for cutoff, color in zip(self.cutoffs, ("darkred", "darkblue")):
+			self.cutoff_lines.append([axis.axvline(x=cutoff, color=color, linewidth=3, linestyle='--') for axis in
+									  self.cutoff_axes])
+		self.legends = [axis.legend([lines[index] for lines in self.cutoff_lines], self.legendLabels(), loc=location)
+						for index, axis, location in ((0, ax3, "upper right"), (2, ax4_2, "lower right"))]
+
+		# hide spines:
+		ax4_1.spines["bottom"].set_visible(False)
+		ax4_2.spines["top"].set_visible(False)
+
+		# unfortunately the y label is not centered...
+		ax4_1.set_ylabel("Percentage of Pixels Below Cutoff")
+
+		# add diagonal 'break' lines
+		d = .025  # size of diagonal lines in axes coordinates
+		# arguments to pass to plot, just so we don't keep repeating them
+		kwargs = dict(transform=ax4_1.transAxes, color="black", clip_on=False, lw=3)
+		ax4_1.plot((-d, +d), (0, 0), **kwargs)        # top-left diagonal
+		ax4_1.plot((1 - d, 1 + d), (0, 0), **kwargs)  # top-right diagonal
+		kwargs.update(transform=ax4_2.transAxes)  # switch to the bottom axes
+		ax4_2.plot((-d, +d), (1,  1), **kwargs)  # bottom-left diagonal
+		ax4_2.plot((1 - d, 1 + d), (1, 1), **kwargs)  # bottom-right diagonal
+
+		# mask different gray scale values from the image (limits are fixed, so new contours do not rescale the axes)
+		self.masked_axes = [ax5, ax6]
+		self.masked_contours = [list(), list()]
+		for axis in self.masked_axes:
+			axis.set_xlim(ax2.get_xlim())
+			axis.set_ylim(ax2.get_ylim())
+			axis.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False)
+		for index in range(len(self.masked_axes)):
+			self.drawMaskedImage(index)
+
+		# change width of spine and spine color for some of the subplots
+		subplots_list = [ax1, ax2, ax3, ax4_1, ax4_2, ax5, ax5, ax6]
+
+		for axis in subplots_list:
+			[i.set_linewidth(2) for i in axis.spines.values()]
+
+		for artist in self.animatedArtists():
+			artist.set_animated(True)
+		return(fig)
+
+	def legendLabels(self):
+		return(["Cutoff {} = {}".format(number + 1, str(cutoff)) for number, cutoff in enumerate(self.cutoffs)])
+
+	def drawMaskedImage(self, index):
+		for artist in self.masked_contours[index]:
+			artist.remove()
+		masked_image = np.where(self.contour_image < self.cutoffs[index], 0, self.contour_image)
+		self.masked_contours[index] = self.contourArtists(self.contour(self.masked_axes[index], masked_image))
+		for artist in self.masked_contours[index]:
+			artist.set_animated(True)
+		self.masked_axes[index].set_title("Gray Scale Cutoff = {}".format(str(self.cutoffs[index])))
+
+	def cutoffArtists(self):
+		# everything in the regions of the cutoff panels (the legends are inside of ax3 and ax4_2)
+		return([line for lines in self.cutoff_lines for line in lines] + list(self.legends))
+
+	def maskedArtists(self, index):
+		return([self.masked_axes[index].title] + list(self.masked_contours[index]))
+
+	def animatedArtists(self):
+		return(self.cutoffArtists() + [artist for index in range(len(self.masked_axes))
+									   for artist in self.maskedArtists(index)])
+
+	def regionBoxes(self, renderer):
+		# the cutoff panels, then the masked images including the space of their titles above them; padded, because
+		# clipped lines can touch the edge pixels of a panel that copy_from_bbox leaves out
+		boxes = [axis.bbox.frozen() for axis in self.cutoff_axes]
+		for axis in self.masked_axes:
+			title = axis.title.get_window_extent(renderer)
+			boxes.append(matplotlib.transforms.Bbox.from_extents(min(axis.bbox.x0, title.x0), axis.bbox.y0,
+																 max(axis.bbox.x1, title.x1), title.y1))
+		return([box.padded(2) for box in boxes])
+
+	def onDraw(self, event):
+		# after every full draw (first draw, resizing) cache everything but the animated artists and draw those on top;
+		# savefig draws animated artists itself (and at another dpi), so its draws are skipped
+		canvas = self.figure.canvas
+		if hasattr(canvas, "copy_from_bbox") and not canvas.is_saving():
+			self.region_boxes = self.regionBoxes(event.renderer)
+			self.backgrounds = [canvas.copy_from_bbox(box) for box in self.region_boxes]
+			self.drawAnimated()
+
+	def drawAnimated(self):
+		for artist in self.animatedArtists():
+			self.figure.draw_artist(artist)
+
+	def update(self, cutoff1, cutoff2):
+		'''
+		Moves the cutoff lines to new cutoffs and redraws only what depends on them.
+		'''
+		changed = [index for index, cutoff in enumerate((cutoff1, cutoff2)) if cutoff != self.cutoffs[index]]
+		if not changed:
+			return
+		for index in changed:
+			self.cutoffs[index] = (cutoff1, cutoff2)[index]
+			for line in self.cutoff_lines[index]:
+				line.set_xdata([self.cutoffs[index], self.cutoffs[index]])
+			self.drawMaskedImage(index)
+		for legend in self.legends:
+			for text, label in zip(legend.get_texts(), self.legendLabels()):
+				text.set_text(label)
+
+		canvas = self.figure.canvas
+		if self.backgrounds is None:
+			canvas.draw_idle()
+			return
+		# the cutoff panels always change, of the masked images only those with a new cutoff
+		regions = list(range(len(self.cutoff_axes))) + [len(self.cutoff_axes) + index for index in changed]
+		for region in regions:
+			canvas.restore_region(self.backgrounds[region])
+		artists = self.cutoffArtists() + [artist for index in changed for artist in self.maskedArtists(index)]
+		for artist in artists:
+			self.figure.draw_artist(artist)
+		for region in regions:
+			canvas.blit(self.region_boxes[region])
+
+def preprocessingFunction(image_number, cutoff1, cutoff2, file_path, save_directory, save_tiff_checkbox, save_pdf_checkbox,
+	figure_size=(9, 9), preview_data=None, channel=0, position=0):
+	''' 
+	Analysis function 1 Doc String: Explore different filters / data pre-processing
+	The following code reads a .lsm file (maybe batches in a future version) and
+	analyses them. This includes a plot of useful statistics.
+	If 'preview_data' (see preprocessingData) was already computed, e.g. on a background thread, the file is not read again.
+	The figure is built by a PreviewFigure, use one directly to update the cutoffs of a figure that is already shown.
+	''' 
+	# disable popup windows (also no plt.show("hold") otherwise tkinter won't show the figure in canvas)
+	matplotlib.interactive(False)
+
+	if preview_data is None:
+		preview_data = preprocessingData(image_number=image_number, file_path=file_path, save_directory=save_directory,
+										 save_tiff_checkbox=save_tiff_checkbox, channel=channel, position=position)
+	if preview_data is False:
+		return(False)
+	selected_image = preview_data["selected_image"]
 		
 	# check image dimensions before plotting
 	print("Image format is " +  str(selected_image.dtype) + " with dimensions " + str(selected_image.shape) + ".")
 
-	# plot your image (use .set_action methods for axes!)
-	fig, ((ax1, ax2, ax3), (ax4, ax5, ax6)) = plt.subplots(nrows=2, ncols=3, figsize=figure_size)
-	fig.canvas.set_window_title("Figure of {}".format(str(file_path)))
-	fig.subplots_adjust(wspace=0.2, hspace=0.2, right=0.98, left=0.10, bottom=0.07, top=0.93)
-
-	# subplot (1, 1)
-	ax1.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False)
-	im1 = ax1.imshow(selected_image, cmap="viridis", interpolation="bicubic") 
-	# colormaps "jet", "gray, "viridis" work
-	# "bicubic" interpolation smoothes the edges, "nearest" leads to a more pixelated figure
-	colbar_ax = fig.add_axes([0.02, 0.57, 0.035, 0.33]) 
-	# Add axes for colorbar at [left, bottom, width, height] (quantities are in fractions of figure)
-	fig.colorbar(im1, cax=colbar_ax)
-	ax1.set_title("Image {} of {}".format(str(image_number), str(image.shape[2])))
-
-	# create a contour figure that extracts prominent features (origin upper left corner)
-	ax2.contour(selected_image, origin="image", cmap="gray")
-	ax2.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False) # Hide the axis but leave the spine
-	ax2.set_title("Feature Extraction without\nPrior Background Reduction")
-
-	# analyze the effect of masking certain pixel values from the image:
-	# first, a boxplot helps to see the distribution of pixel values
-	ax3.hist(selected_image.ravel(), bins=256, range=(0.0, 256.0), fc="k", ec="k")
-	ax3.set_yscale("log", nonposy = "clip")
-	ax3.set_title("Histogram of Gray Scale\nValues in Image {}".format(str(image_number)))
-	ax3.tick_params(width=1.5, which="both", labelsize=12)
-	ax3.axvline(x=cutoff1, color="darkred", linewidth=3, linestyle='--')
-	ax3.axvline(x=cutoff2, color="darkblue", linewidth=3, linestyle='--')
-	ax3.legend(["Cutoff 1 = {}".format(str(cutoff1)), "Cutoff 2 = {}".format(str(cutoff2))], loc="upper right")
-
-	# second, a scatter plot demonstrating the number of pixels below certain cutoff
-	pixel_values = []
-	cutoffs = []
-
-	tmp1 = np.copy(selected_image) # --> assignment statements in python do NOT copy objects but create binding
-	for cutoff in range(selected_image.max()):
-		mask = tmp1 < cutoff
-		tmp1[mask] = 0
-		pixel_values.append(pylab.mean(mask) * 100)
-		cutoffs.append(cutoff)
-
-	# create another subplot where subplot '4' would usually be and plot scatter plot with y axis break
-	# also, determine optimal break point for the upper panel ax4_1 using the second smallest pixel value
-	y_limits_top = (pixel_values[1] - 2, 102) 
-	y_limits_bottom = (-0.5, 2) 
-
-	ax4_1 = plt.subplot2grid((6, 3), (3, 0), rowspan=2) # 0-indexed!
-	ax4_2 = plt.subplot(6, 3, 16)
-	ax4_1.scatter(x=cutoffs, y=pixel_values, s=20, c="darkred")
-	ax4_1.set_title("% of Pixels Below Gray Scale Cutoff")
-	ax4_1.tick_params(width=1.5, labelsize=12)
-	ax4_1.set_ylim(y_limits_top)
-	ax4_1.axvline(x=cutoff1, color="darkred", linewidth=3, linestyle='--')
-	ax4_1.axvline(x=cutoff2, color="darkblue", linewidth=3, linestyle='--')
-	ax4_1.tick_params(bottom = False, labelbottom = False)
-
-	ax4_2.scatter(x=cutoffs, y=pixel_values, s=20, c="darkred")
-	ax4_2.tick_params(width=1.5, labelsize=12)
-	ax4_2.set_ylim(y_limits_bottom)
-	ax4_2.set_xlabel("Gray Scale Value Cutoff")
-	ax4_2.axvline(x=cutoff1, color="darkred", linewidth=3, linestyle='--')
-	ax4_2.axvline(x=cutoff2, color="darkblue", linewidth=3, linestyle='--')
-	ax4_2.legend(["Cutoff 1 = {}".format(str(cutoff1)), "Cutoff 2 = {}".format(str(cutoff2))], loc="lower right")
-
-	# hide spines:
-	ax4_1.spines["bottom"].set_visible(False)
-	ax4_2.spines["top"].set_visible(False)
-
-	# unfortunately the y label is not centered...
-	ax4_1.set_ylabel("Percentage of Pixels Below Cutoff")
-
-	# add diagonal 'break' lines
-	d = .025  # size of diagonal lines in axes coordinates
-	# arguments to pass to plot, just so we don't keep repeating them
-	kwargs = dict(transform=ax4_1.transAxes, color="black", clip_on=False, lw=3)
-	ax4_1.plot((-d, +d), (0, 0), **kwargs)        # top-left diagonal
-	ax4_1.plot((1 - d, 1 + d), (0, 0), **kwargs)  # top-right diagonal
-	kwargs.update(transform=ax4_2.transAxes)  # switch to the bottom axes
-	ax4_2.plot((-d, +d), (1,  1), **kwargs)  # bottom-left diagonal
-	ax4_2.plot((1 - d, 1 + d), (1, 1), **kwargs)  # bottom-right diagonal
-
-	# mask different gray scale values from the image
-	tmp2 = np.copy(selected_image)
-	tmp2[tmp2 < cutoff1] = 0
-
-	ax5.contour(tmp2, origin="image", cmap="gray")
-	ax5.set_title("Gray Scale Cutoff = {}".format(str(cutoff1)))
-	ax5.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False)
-
-	tmp3 = np.copy(selected_image)
-	tmp3[tmp3 < cutoff2] = 0
-
-	ax6.contour(tmp3, origin="image", cmap="gray")
-	ax6.set_title("Gray Scale Cutoff = {}".format(str(cutoff2)))
-	ax6.tick_params(bottom=False, left=False, labelbottom=False, labelleft=False)
-
-	# change width of spine and spine color for some of the subplots
-	subplots_list = [ax1, ax2, ax3, ax4_1, ax4_2, ax5, ax5, ax6]
-
-	for axis in subplots_list:
-		[i.set_linewidth(2) for i in axis.spines.values()]	
+	fig = PreviewFigure(preview_data=preview_data, image_number=image_number, file_path=file_path, cutoff1=cutoff1,
+						cutoff2=cutoff2, figure_size=figure_size).figure
 
 	# if the checkbox is checked, save figure as pdf
 	save_pdf(save_directory=save_directory, figure=fig, save_pdf_checkbox=save_pdf_checkbox, name="exploratory_data_analysis")
@@ -471,39 +1821,136 @@ def preprocessingFunction(image_number, cutoff1, cutoff2, file_path, save_direct
 ############################
 #### Analysis 2 - Class ####
 ############################
+# one row per labeled region; 'bbox' is (min_row, min_col, max_row, max_col) with exclusive max like in skimage
+region_table_dtype = np.dtype([("label", np.int64), ("area", np.int64), ("bbox", np.int64, (4, )),
+							   ("centroid", np.float64, (2, )), ("mean_intensity", np.float64)])
+
+def build_region_table(label_image, intensity_image=None):
+	'''
+	Summarizes all regions of a label image (0 = background) in a structured np.array with 'region_table_dtype'. Areas,
+	centroids and mean intensities are accumulated with np.bincount and bounding boxes with ndi.find_objects, so the label
+	image is only traversed a few times regardless of the number of regions. Rows are sorted by label.
+	'''
+	labels = np.asarray(label_image)
+	n_labels = int(labels.max()) if labels.size else 0
+	flat_labels = labels.ravel()
+	rows, cols = np.indices(labels.shape)
+
+	area = np.bincount(flat_labels, minlength=n_labels + 1)
+	present = np.flatnonzero(area[1:]) + 1
+	region_table = np.zeros(len(present), dtype=region_table_dtype)
+	region_table["label"] = present
+	region_table["area"] = area[present]
+	region_table["centroid"][:, 0] = np.bincount(flat_labels, weights=rows.ravel(), minlength=n_labels + 1)[present] / area[present]
+	region_table["centroid"][:, 1] = np.bincount(flat_labels, weights=cols.ravel(), minlength=n_labels + 1)[present] / area[present]
+	if intensity_image is not None:
+		intensity_sum = np.bincount(flat_labels, weights=np.asarray(intensity_image, dtype=np.float64).ravel(),
+									minlength=n_labels + 1)
+		region_table["mean_intensity"] = intensity_sum[present] / area[present]
+	else:
+		region_table["mean_intensity"] = np.nan
+
+	bounding_boxes = ndi.find_objects(labels)
+	region_table["bbox"] = np.array([(box[0].start, box[1].start, box[0].stop, box[1].stop) for box in
+									 (bounding_boxes[label - 1] for label in present)], dtype=np.int64).reshape(-1, 4)
+	return(region_table)
+
+def label_runs(binary_image, fully_connected=True):
+	'''
+	Connected components labeling of a binary image (non-zero = foreground) with 8-connectivity if 'fully_connected',
+	4-connectivity otherwise. The labels come from scipy's compiled two-pass labeler (ndi.label), numbered 1..n in
+	raster order of the first pixel of each component like measure.label. The region table ('region_table_dtype', mean
+	intensities NaN) is computed in one vectorized pass over the runs of foreground pixels of every row, so its cost
+	grows with the number of runs, not the number of pixels.
+	Returns the label image and the region table.
+	'''
+	binary = np.asarray(binary_image)
+	if binary.dtype != bool:
+		binary = binary != 0
+	height, width = binary.shape
+	label_image, n_labels = ndi.label(binary, structure=np.ones((3, 3), dtype=bool) if fully_connected else None)
+
+	# runs start where a row switches from 0 to 1 and end (exclusive) where it switches back
+	# (padded with a 0 on both sides, so every row has as many switches up as down and they alternate)
+	padded = np.zeros((height, width + 2), dtype=bool)
+	padded[:, 1:-1] = binary
+	switches = np.flatnonzero(padded[:, 1:] != padded[:, :-1])
+	run_rows, run_starts = np.divmod(switches[0::2], width + 1)
+	run_ends = switches[1::2] - run_rows * (width + 1)
+	run_labels = label_image[run_rows, run_starts]
+
+	# per-label statistics from the runs
+	lengths = run_ends - run_starts
+	area = np.bincount(run_labels, weights=lengths, minlength=n_labels + 1)[1:]
+	bbox = np.zeros((n_labels + 1, 4), dtype=np.int64)
+	bbox[:, 0:2] = np.iinfo(np.int64).max
+	np.minimum.at(bbox[:, 0], run_labels, run_rows)
+	np.minimum.at(bbox[:, 1], run_labels, run_starts)
+	np.maximum.at(bbox[:, 2], run_labels, run_rows + 1)
+	np.maximum.at(bbox[:, 3], run_labels, run_ends)
+	region_table = np.zeros(n_labels, dtype=region_table_dtype)
+	region_table["label"] = np.arange(1, n_labels + 1)
+	region_table["area"] = area
+	region_table["bbox"] = bbox[1:]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		region_table["centroid"][:, 0] = np.bincount(run_labels, weights=run_rows * lengths, minlength=n_labels + 1)[1:] / area
+		region_table["centroid"][:, 1] = np.bincount(run_labels, weights=(run_starts + run_ends - 1) * lengths,
+													 minlength=n_labels + 1)[1:] / (2.0 * area)
+	region_table["mean_intensity"] = np.nan
+	return(label_image, region_table)
+
 # skimage help page (http://www.scipy-lectures.org/packages/scikit-image/auto_examples/plot_labels.html)
 # also useful: https://stackoverflow.com/questions/46441893/connected-component-labeling-in-python
 class ConnectedComponentsLabeling():
     '''
     ConnectedComponentsLabeling class can be used to analyze a gray scale image with respect to components it contains.
-	'method' is 'ccl' by default but 'segmentation' via a watershed algorithm is also implementation
+        'method' is 'ccl' by default but 'segmentation' via a watershed algorithm is also implementation
+        'input_image' can be a single frame or a projection of the whole movie (see projection_image), 'projection' names
+        the projection ('max', 'mean', 'std', 'percentile'; None for a single frame) and is kept with the parameters
+        'tile_size' splits 'segmentation' into tiles that are processed in parallel (see imageSegmentation)
     '''
     def __init__(self, input_image, pixel_threshold=200, min_threshold=100, max_threshold=10000, skimage=True, fully_connected=True,
-    			 method="ccl"):
+                         method="ccl", projection=None, tile_size=None):
         # monitor elapsed time
         timer_start = timeit.default_timer()
+        self.ccl_region_table = None
+        self.parameters = dict(pixel_threshold=pixel_threshold, min_threshold=min_threshold, max_threshold=max_threshold,
+                               method=method, fully_connected=fully_connected, projection=projection or "frame")
         
         # transform input image to binary image
         if method == "ccl":
-        	self.im_ccl = self.transformToClusterImage(input_im=input_image, pixel_threshold=pixel_threshold, skimage=skimage, 
-        										   	   fully_connected=fully_connected)
+                self.im_ccl = self.transformToClusterImage(input_im=input_image, pixel_threshold=pixel_threshold, skimage=skimage, 
+                                                                                                   fully_connected=fully_connected)
         elif method == "segmentation":
-        	self.im_ccl = self.imageSegmentation(input_im=input_image, pixel_threshold=pixel_threshold)
+                self.im_ccl = self.imageSegmentation(input_im=input_image, pixel_threshold=pixel_threshold, tile_size=tile_size)
 
         else:
-        	raise ValueError("Enter a valid cell identification method! ('ccl', 'segmentation')")
+                raise ValueError("Enter a valid cell identification method! ('ccl', 'segmentation')")
 
-        # find clusters in ccl image 
+        # find clusters in ccl image and summarize them in a region table (label, area, bbox, centroid, mean intensity)
         print("Looking for cells...")
-        self.clust_list = self.findClusterSize(input_im_ccl=self.im_ccl)
+        if self.ccl_region_table is not None:
+                # areas, bounding boxes and centroids are known from labeling, only the mean intensities are missing
+                self.region_table = self.ccl_region_table
+                intensity_sum = np.bincount(self.im_ccl.ravel(), weights=np.asarray(input_image, dtype=np.float64).ravel(),
+                                            minlength=len(self.region_table) + 1)
+                self.region_table["mean_intensity"] = intensity_sum[1:] / self.region_table["area"]
+        else:
+                self.region_table = build_region_table(label_image=self.im_ccl, intensity_image=input_image)
         print("Cells found!")
 
-        # analyze cluster list "clust_list" with respect to size thresholds to find cluster indices for subsetting the original image
+        # filter the region table with respect to size thresholds to find the clusters that are considered to be cells
         print("Applying min/max size thresholds...")
-        self.clust_index = self.findClusterIndex(input_list=self.clust_list, min_threshold=min_threshold, max_threshold=max_threshold)
+        self.cell_table = self.filterRegionTable(region_table=self.region_table, min_threshold=min_threshold,
+                                                 max_threshold=max_threshold)
+        self.clust_index = self.cell_table["label"]
+
+        # lastly, subset the original image with the cell table and derive "cells" from those clusters
+        self.im_with_cells = self.findCellsInClusters(input_im_ccl=self.im_ccl, cell_table=self.cell_table)
 
-        # lastly, subset the original image with indices and derive "cells" from those clusters
-        self.im_with_cells = self.findCellsInClusters(input_im_ccl=self.im_ccl, cluster_index=self.clust_index)
+        # cells are numbered 1..n in 'im_with_cells', the cell table follows the same numbering
+        self.cell_table = self.cell_table.copy()
+        self.cell_table["label"] = np.arange(1, len(self.cell_table) + 1)
         
         # end and print counter
         timer_end = timeit.default_timer()
@@ -511,60 +1958,23 @@ class ConnectedComponentsLabeling():
         print("{} sec elapsed.".format(timer_end - timer_start))
 
     def CCL_algorithm(self, binary_image, fully_connected):
-	'''
-	!!!!!!!!!!!!!!
-	ATTENTION: Does currently not work. No second-pass loop with 'union-find' implemented. Thus, labels are still a mess! Use
-			   skimage's build-in function for connected components labeling!
-	!!!!!!!!!!!!!!
-	Connected components labeling algorithm. Takes a binary image (0, 1) as an input.
-	'Fully_connected=boolean' defines whether to use 4- or 8-connectivity:
-		# i = row index
-		# j = column index
-		### which positions to test ###
-		###
-		###	[i-1, j-1]  [i-1, j] [i-1, j+1]
-		###	          \	  |	    /
-		###	[i, j-1] - 	[i, j]
-		###
-	'''
-	print("Start CCL algorithm.")
-
-	# initialize an all-0 np.array and a counter
-	cluster_counter = 0
-	ccl_image = np.zeros(shape=binary_image.shape, dtype=np.int)
-
-	# iterator over image (actual algorithm)
-	for i in range(0, binary_image.shape[0]): 
-
-		for j in range(0, binary_image.shape[1]): 
-			
-			# test elements
-			if binary_image[i, j] == 1:
-				## test all adjacent elements
-				# -- 1 --
-				if fully_connected and i != 0 and j != 0 and binary_image[i-1, j-1] == 1: 
-					ccl_image[i, j] = ccl_image[i-1, j-1]
-				# -- 2 --
-				elif i != 0 and binary_image[i-1, j] == 1: 
-					ccl_image[i, j] = ccl_image[i-1, j]
-				# -- 3 --
-				elif binary_image[i, j-1] == 1: 
-					ccl_image[i, j] = ccl_image[i, j-1]
-				# -- 4 --
-				# test whether element is last in a row as well!
-				elif fully_connected and j < (binary_image.shape[1]-1) and i != 0 and binary_image[i-1, j+1] == 1: 
-					ccl_image[i, j] = ccl_image[i-1, j+1]
-				
-				# if none of them is a 'positive' neighbor, assign a new cluster number to the element
-				else:
-					cluster_counter += 1
-					ccl_image[i, j] = cluster_counter
+        '''
+        Connected components labeling algorithm. Takes a binary image (0, 1) as an input.
+        'Fully_connected=boolean' defines whether to use 4- or 8-connectivity:
+                # i = row index
+                # j = column index
+                ### which positions to test ###
+                ###
+                ###	[i-1, j-1]  [i-1, j] [i-1, j+1]
+                ###	          \	  |	    /
+                ###	[i, j-1] - 	[i, j]
+                ###
+        Labels with scipy's compiled labeler (see label_runs), the region table of the clusters is computed from the runs of
+        foreground pixels and kept in 'self.ccl_region_table'.
+        '''
+        ccl_image, self.ccl_region_table = label_runs(binary_image, fully_connected=fully_connected)
+        return(ccl_image)
 
-	return(ccl_image)
-	'''
-	The second half of the algorithm needs to be implemented if you want to use this self-made function for CCL!
-    '''
-    
     def transformToClusterImage(self, input_im, pixel_threshold, skimage, fully_connected):
         '''
         Transform input image to binary image and analyze with skimage's connected components labeling algorithm or with
@@ -575,196 +1985,763 @@ class ConnectedComponentsLabeling():
         internal_copy[internal_copy != 0] = 1
         
         if skimage:
-        	copy1_ccl = measure.label(internal_copy)
+                copy1_ccl = measure.label(internal_copy, connectivity=2 if fully_connected else 1)
         else:
-        	copy1_ccl = self.CCL_algorithm(internal_copy, fully_connected)
+                copy1_ccl = self.CCL_algorithm(internal_copy, fully_connected)
         
         return(copy1_ccl)
 
-    def imageSegmentation(self, input_im, pixel_threshold):
-		'''
-		Might be more robust than CCL under certain circumstances. 
-		Resource: http://scikit-image.org/docs/dev/user_guide/tutorial_segmentation.html
-		'''
-
-		markers = np.zeros_like(input_im)
-		markers[input_im < pixel_threshold] = 1 # set pixel values to marker values depending on 'pixel_treshold'
-		markers[input_im >= pixel_threshold] = 2
-		elevation_map = sobel(input_im) # compute an elevation map
-
-		segmentation = watershed(elevation_map, markers) # apply whatershed algorithm
-		segmentation2 = ndi.binary_fill_holes(segmentation - 1) # fill small holes
-		labeled_image, x = ndi.label(segmentation2) # label cells in image
-
-		return(labeled_image)
-
-    def findClusterSize(self, input_im_ccl):
-        '''
-        v0.15: np.unique() based algorithm finds clusters.
-        ***************************
-        DEPRECATED: Loops over "Connected components image" and finds clusters. A counter is integrated so that users can 
-        approximate how long the analysis will take. Throws an error if number of clusters is very large.
-        ***************************
-        '''        
-        # initialize counters, a list of clusters to append cluster size to, and loop over matrix elements to find clusters
-        #cluster_list = list()
-        #row_count, elem_count = 0, 0
-
-        #for number in range(1, input_im_ccl.max()+1, 1):
-        #    print("Evaluating cluster {number} of {max_number}.".format(number=number, max_number=input_im_ccl.max()))
-        #    cluster_count = 0
-        #    for row in input_im_ccl:
-        #        for element in row:
-        #            if element == number:
-        #                cluster_count += 1
-        #    cluster_list.append(cluster_count)
-
-        # warning if input has a large number of clusters
-        #if input_im_ccl.max() > 500:
-        #    warnings.warn("Consider to reduce the number of potential cells that are evaluated by using a filter.", RuntimeWarning, 
-        #                  stacklevel=2)
-
-		# a faster alternative to looping over the matrix elements!
-        unique_clusts, counts_clusts = np.unique(input_im_ccl, return_counts=True)
-        cluster_list = list(counts_clusts)
-        cluster_list.pop(0)
-        
-        # return list of cluster sizes
-        return(cluster_list)
-
-    def findClusterIndex(self, input_list, min_threshold, max_threshold):
+    def imageSegmentation(self, input_im, pixel_threshold, tile_size=None, overlap=16, workers=None, band=0.25):
+                '''
+                Might be more robust than CCL under certain circumstances. 
+                Resource: http://scikit-image.org/docs/dev/user_guide/tutorial_segmentation.html
+                Pixels below (1 - 'band') * 'pixel_threshold' are background markers, pixels from (1 + 'band') *
+                'pixel_threshold' on are cell markers, and the band in between is flooded by a watershed on the sobel
+                elevation map (see watershedMarkers). Only the band and the markers next to it take part in the flood.
+                With 'tile_size' (e.g. 512), the band is flooded on tiles of 'tile_size' x 'tile_size' pixels on
+                'workers' threads (one per CPU by default). The flood of a connected band region only depends on the
+                region and the markers around it, so a region is taken from the tile that contains its top left pixel if
+                it fits into that tile extended by 'overlap' pixels on each side; larger regions are flooded on their
+                own bounding box. The stitched image equals the untiled one. Holes are filled and cells are labeled on
+                the stitched image, i.e. cells that cross tile borders get a single label.
+                '''
+                markers = self.watershedMarkers(input_im, pixel_threshold, band)
+                unmarked = markers == 0
+                flood_mask = ndi.binary_dilation(unmarked) # the band and its 4-connected neighbors
+
+                # compute an elevation map; its values are replaced by their rank (ties in raster order), so the flood
+                # order never depends on how the watershed breaks ties and is the same on tiles and on the whole image
+                elevation = filters.sobel(input_im)[flood_mask]
+                ranks = np.empty(elevation.size, dtype=np.int64)
+                ranks[np.argsort(elevation, kind="stable")] = np.arange(elevation.size)
+                elevation_map = np.zeros(input_im.shape, dtype=np.int64)
+                elevation_map[flood_mask] = ranks
+
+                segmentation = markers == 2
+                if tile_size is None or (input_im.shape[0] <= tile_size and input_im.shape[1] <= tile_size):
+                        # apply watershed algorithm
+                        flooded = skimage_segmentation.watershed(elevation_map, markers, mask=flood_mask)
+                        segmentation[unmarked] = flooded[unmarked] == 2
+                else:
+                        height, width = input_im.shape
+                        band_regions, n_regions = ndi.label(unmarked) # 4-connected, like the flood of watershed
+                        region_slices = ndi.find_objects(band_regions)
+
+                        # bounding boxes of all band regions, extended by the one pixel of markers around them
+                        boxes = np.array([(rows.start, cols.start, rows.stop, cols.stop) for rows, cols in
+                                          region_slices], dtype=np.int64).reshape(-1, 4)
+                        tile_rows, tile_cols = boxes[:, 0] // tile_size, boxes[:, 1] // tile_size
+                        fits = ((np.maximum(boxes[:, 0] - 1, 0) >= np.maximum(tile_rows * tile_size - overlap, 0)) &
+                                (np.maximum(boxes[:, 1] - 1, 0) >= np.maximum(tile_cols * tile_size - overlap, 0)) &
+                                (np.minimum(boxes[:, 2] + 1, height) <=
+                                 np.minimum((tile_rows + 1) * tile_size + overlap, height)) &
+                                (np.minimum(boxes[:, 3] + 1, width) <=
+                                 np.minimum((tile_cols + 1) * tile_size + overlap, width)))
+                        n_tile_cols = -(-width // tile_size)
+                        region_tile = np.full(n_regions + 1, -1, dtype=np.int64) # tile that floods a region (-1 = none)
+                        region_tile[1:][fits] = (tile_rows * n_tile_cols + tile_cols)[fits]
+
+                        def flood(area, regions):
+                                # floods 'area' (a pair of slices) and keeps the result on the pixels of 'regions'
+                                selected = regions[band_regions[area]]
+                                flooded = skimage_segmentation.watershed(elevation_map[area], markers[area],
+                                                                         mask=flood_mask[area])
+                                segmentation[area][selected] = flooded[selected] == 2
+
+                        def flood_tile(corner):
+                                row, col = corner
+                                area = (slice(max(row - overlap, 0), min(row + tile_size + overlap, height)),
+                                        slice(max(col - overlap, 0), min(col + tile_size + overlap, width)))
+                                flood(area, region_tile == (row // tile_size) * n_tile_cols + col // tile_size)
+
+                        def flood_region(label):
+                                top, left, bottom, right = boxes[label - 1]
+                                area = (slice(max(top - 1, 0), min(bottom + 1, height)),
+                                        slice(max(left - 1, 0), min(right + 1, width)))
+                                flood(area, np.arange(n_regions + 1) == label)
+
+                        corners = [(row, col) for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+                        tasks = [(flood_tile, corner) for corner in corners]
+                        tasks += [(flood_region, label) for label in np.flatnonzero(~fits) + 1]
+                        pool = ThreadPool(min(workers or multiprocessing.cpu_count(), len(tasks)))
+                        try:
+                                pool.map(lambda task: task[0](task[1]), tasks)
+                        finally:
+                                pool.close()
+
+                segmentation2 = ndi.binary_fill_holes(segmentation) # fill small holes
+                labeled_image, x = ndi.label(segmentation2) # label cells in image
+
+                return(labeled_image)
+
+    @staticmethod
+    def watershedMarkers(input_im, pixel_threshold, band=0.25):
+                '''
+                Returns the watershed markers of 'input_im': 1 (background) below (1 - 'band') * 'pixel_threshold',
+                2 (cells) from (1 + 'band') * 'pixel_threshold' on and 0 (flooded by the watershed) in between.
+                '''
+                markers = np.zeros(input_im.shape, dtype=np.int32)
+                markers[input_im < (1 - band) * pixel_threshold] = 1
+                markers[input_im >= (1 + band) * pixel_threshold] = 2
+                return(markers)
+
+    def filterRegionTable(self, region_table, min_threshold, max_threshold):
         '''
-        Finds indices of clusters.
+        Returns the rows of a region table whose area lies within 'min_threshold' and 'max_threshold' (both included).
         '''
-        cluster_index = list()
-        for element in input_list:
-            if element >= min_threshold and element <= max_threshold:
-                cluster_index.append(input_list.index(element)+1)
-
-        if len(cluster_index) == 0:
-        	raise ValueError("No cells in range {min} - {max}!".format(min=min_threshold, max=max_threshold))
+        size_mask = (region_table["area"] >= min_threshold) & (region_table["area"] <= max_threshold)
+        if not np.any(size_mask):
+                raise ValueError("No cells in range {min} - {max}!".format(min=min_threshold, max=max_threshold))
         else:
-        	return(cluster_index)
+                return(region_table[size_mask])
 
-    def findCellsInClusters(self, input_im_ccl, cluster_index):
+    def findCellsInClusters(self, input_im_ccl, cell_table):
         '''
-        Finds "cells" in clusters.
+        Finds "cells" in clusters. The cluster in row i of 'cell_table' becomes cell i+1, all other clusters become
+        background (0). Relabeling is done with a single lookup table (old label -> new label) that is applied to the whole
+        image at once.
         '''
-        # duplicate input image to make sure that it does not get changed during analysis
-        input_im_ccl_2 = np.copy(input_im_ccl)
-
-        # subset input image with cluster indices to delete background and identify actual cells
-        for row in range(0, input_im_ccl_2.shape[0]):
-            for col in range(0, input_im_ccl_2.shape[1]):
-                if input_im_ccl_2[row, col] in set(cluster_index): # using a set considerably speeds up this step
-                    input_im_ccl_2[row, col] = cluster_index.index(input_im_ccl_2[row, col]) + 1
-                else:
-                    input_im_ccl_2[row, col] = 0
-        return(input_im_ccl_2)
+        # build the lookup table, every label that is not listed in 'cell_table' maps to 0
+        lookup_table = np.zeros(int(input_im_ccl.max()) + 1, dtype=input_im_ccl.dtype)
+        lookup_table[cell_table["label"]] = np.arange(1, len(cell_table) + 1)
+
+        # indexing with the label image returns a new array, so the input image does not get changed during analysis
+        return(lookup_table[input_im_ccl])
+
+def plot_cell_identification(selected_image, ccl_object, image_number, pixel_threshold, min_threshold, max_threshold):
+	'''
+	Plots the native image, all clusters and the clusters that passed the size thresholds (i.e. cells) next to each other.
+	Returns the figure.
+	'''
+	fig, (ax1, ax2, ax3) = plt.subplots(nrows=1, ncols=3, figsize=(12, 8))
+	fig.subplots_adjust(wspace=0.2, hspace=0.05, right=0.80, left=0.05, bottom=0.05, top=0.95)
+
+	# subplot 1
+	ax1.set_title("Native Image {}".format(image_number))
+	ax1.axis("off")
+	ax1.imshow(selected_image, cmap="gray")
+
+	# subplot 2
+	ax2.set_title("Processed Image {}\nAll Sizes (Filter={})".format(image_number, pixel_threshold))
+	ax2.axis("off")
+	ax2.imshow(ccl_object.im_ccl, cmap="nipy_spectral")
+
+	# subplot 3
+	ax3.set_title("Processed Image {no}\nSizes {min} - {max} (Filter={filter})".format(no=image_number,
+		min=min_threshold, max=max_threshold, filter=pixel_threshold))
+	ax3.axis("off")
+	subplot3 = ax3.imshow(ccl_object.im_with_cells, cmap="nipy_spectral")
+	colbar_ax = fig.add_axes([0.85, 0.2, 0.03, 0.6])
+	fig.colorbar(subplot3, cax=colbar_ax)
+	return(fig)
 
 ############################
 #### Analysis 3 - Class ####
 ############################
+class CellTraceExtractor():
+	'''
+	Computes a reduction ('mean', 'sum', 'median', 'max' or 'min') of the pixels of every cell in a label image for all
+	frames of a movie in a single pass. Pixels are sorted by label once, afterwards each chunk of 'chunk_size' frames is
+	reduced for all cells at the same time with a label-indexed reduction (ufunc.reduceat).
+	Labels without any pixels yield NaN (or 0 for 'sum') just like a reduction over an empty mask would.
+	If the cell table of a ConnectedComponentsLabeling object is passed as 'cell_table', cell count and sizes are taken
+	from it instead of being counted again.
+	'''
+	reducers = ("mean", "sum", "median", "max", "min")
+
+	def __init__(self, label_image, method="mean", chunk_size=256, cell_table=None):
+		if method not in self.reducers:
+			raise ValueError("Specify a valid method! ('mean', 'sum', 'median', 'max', 'min')")
+		self.method = method
+		self.chunk_size = chunk_size
+
+		labels = np.asarray(label_image).ravel()
+		if cell_table is not None:
+			self.n_cells = len(cell_table)
+		else:
+			self.n_cells = int(labels.max()) if labels.size else 0
+
+		# sort the indices of all labeled pixels by label, so that every cell is one contiguous segment
+		pixel_index = np.flatnonzero(labels)
+		self._pixel_index = pixel_index[np.argsort(labels[pixel_index], kind="mergesort")]
+		if cell_table is not None:
+			self.cell_sizes = np.asarray(cell_table["area"])
+		else:
+			self.cell_sizes = np.bincount(labels, minlength=self.n_cells + 1)[1:]
+		self._present = self.cell_sizes > 0
+		self._starts = (np.cumsum(self.cell_sizes) - self.cell_sizes)[self._present]
+
+	def extract(self, frames, progress=None):
+		'''
+		Takes a (frames, rows, columns) array (or memory map) or a LazyLSMReader and returns an array with one row per cell
+		and one column per frame. Readers are streamed from disk 'chunk_size' frames at a time, so peak memory depends on
+		the chunk size, not on the length of the movie. 'progress' is called with the fraction of frames done after every
+		chunk (see Job.setProgress).
+		'''
+		streaming = hasattr(frames, "read_frames")
+		n_frames = frames.n_frames if streaming else frames.shape[0]
+		traces = np.full((self.n_cells, n_frames), 0.0 if self.method == "sum" else np.nan, dtype=np.float64)
+		if not np.any(self._present):
+			return(traces)
+
+		for chunk_start in range(0, n_frames, self.chunk_size):
+			chunk_stop = min(chunk_start + self.chunk_size, n_frames)
+			if streaming:
+				chunk = frames.read_frames(chunk_start, chunk_stop)
+			else:
+				chunk = frames[chunk_start:chunk_stop]
+			traces[self._present, chunk_start:chunk_stop] = self.reduceChunk(chunk).T
+			if progress is not None:
+				progress(float(chunk_stop) / n_frames)
+		return(traces)
+
+	def reduceChunk(self, chunk):
+		'''
+		Reduces a (frames, rows, columns) chunk to an array of shape (frames, non-empty cells).
+		'''
+		pixels = np.asarray(chunk).reshape(chunk.shape[0], -1)[:, self._pixel_index]
+		if self.method == "sum":
+			return(np.add.reduceat(pixels, self._starts, axis=1, dtype=np.float64))
+		elif self.method == "mean":
+			return(np.add.reduceat(pixels, self._starts, axis=1, dtype=np.float64) / self.cell_sizes[self._present])
+		elif self.method == "max":
+			return(np.maximum.reduceat(pixels, self._starts, axis=1).astype(np.float64))
+		elif self.method == "min":
+			return(np.minimum.reduceat(pixels, self._starts, axis=1).astype(np.float64))
+		else:
+			# medians cannot be expressed as a ufunc reduction, so loop over cells (but not over frames)
+			stops = np.append(self._starts[1:], pixels.shape[1])
+			return(np.column_stack([np.median(pixels[:, start:stop], axis=1) for start, stop in zip(self._starts, stops)]))
+
+# F0 estimates for NormalizeCellTraces; 'mean' is the mean of the frames start:stop, all others follow slow drifts
+baseline_methods = ("mean", "percentile", "minimum", "bleach")
+
+def rolling_minimum(traces, window, out=None):
+	'''
+	Minimum of a centered window of 'window' frames (shrinking at both ends) for every row of a (cells, frames) array.
+	Uses the van Herk/Gil-Werman algorithm: the padded rows are cut into blocks of one window, and every window minimum
+	is the smaller of a suffix minimum of one block and a prefix minimum of the next. Both are running minima along the
+	blocks, so the cost per frame does not depend on the window size and all cells are processed together.
+	'''
+	traces = np.atleast_2d(traces)
+	n_cells, n_frames = traces.shape
+	half = int(max(1, min(window, 2 * n_frames - 1))) // 2
+	window = 2 * half + 1
+	n_padded = -(-(n_frames + 2 * half) // window) * window
+
+	padded = np.full((n_cells, n_padded), np.inf, dtype=np.float32)
+	padded[:, half:half + n_frames] = traces
+	blocks = padded.reshape(n_cells, -1, window)
+	suffix = np.minimum.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_cells, n_padded)
+	np.minimum.accumulate(blocks, axis=2, out=blocks) # 'padded' now holds the prefix minima
+
+	if out is None:
+		out = np.empty((n_cells, n_frames), dtype=np.float32)
+	np.minimum(suffix[:, :n_frames], padded[:, window - 1:window - 1 + n_frames], out=out)
+	return(out)
+
+def rolling_percentile(traces, window, percentile=10, out=None, memory_budget=64 * 1024**2):
+	'''
+	Percentile of a centered window of 'window' frames for every row of a (cells, frames) array, exactly as np.percentile
+	(linear interpolation) computes it for each window. Windows are handled in blocks of 'step' (~ sqrt(window) / 2)
+	consecutive windows: the frames all windows of a block share are sorted once, and the percentile of every window is
+	partitioned from the few sorted values that can hold it plus the 'step' - 1 frames only that window contains. All
+	cells are handled together in chunks of blocks that fit 'memory_budget'.
+	Frames closer to the ends than half a window get the percentile of the first/last window.
+	Sorting every block's core costs O(frames * sqrt(window) * log(window)) per cell, not O(frames). The function is not
+	in place either: besides 'out' it keeps two float32 arrays of the size of 'traces', a copy padded with the last frame
+	to whole blocks and the window percentiles before they are centered into 'out'.
+	'''
+	traces = np.ascontiguousarray(np.atleast_2d(traces), dtype=np.float32)
+	n_cells, n_frames = traces.shape
+	window = int(max(1, min(window, n_frames)))
+	position = percentile / 100.0 * (window - 1)
+	rank = int(np.floor(position)) # the percentile lies between the values of rank 'rank' and 'next_rank' of a window
+	next_rank = min(rank + 1, window - 1)
+	fraction = np.float32(position - rank)
+
+	# a block holds 'step' windows, the 'core_size' frames they share are sorted; values below 'first' and from 'last'
+	# on in a sorted core can never be of rank 'rank' or 'next_rank' in a window of the block
+	step = int(max(1, min(window, round(np.sqrt(window) / 2))))
+	core_size = window - step + 1
+	first = max(0, rank - (step - 1))
+	last = min(core_size, next_rank + 1)
+	n_candidates = last - first + step - 1
+	n_windows = n_frames - window + 1
+	n_blocks = -(-n_windows // step)
+
+	padded = np.empty((n_cells, n_blocks * step + window - 1), dtype=np.float32) # the last block may be incomplete
+	padded[:, :n_frames] = traces
+	padded[:, n_frames:] = traces[:, -1:]
+	cell_stride, frame_stride = padded.strides
+	def blocks(offset, length, n):
+		# (cells, blocks, frames) view of 'length' frames per block, starting 'offset' frames after the first block
+		return(np.lib.stride_tricks.as_strided(padded[:, offset:], shape=(n_cells, n, length),
+											   strides=(cell_stride, step * frame_stride, frame_stride)))
+
+	values = np.empty((n_cells, n_blocks * step), dtype=np.float32)
+	block_chunk = int(max(1, memory_budget // (n_cells * (core_size + step * n_candidates) * padded.itemsize)))
+	for first_block in range(0, n_blocks, block_chunk):
+		n = min(block_chunk, n_blocks - first_block)
+		offset = first_block * step
+		candidates = np.empty((n_cells, n, step, n_candidates), dtype=np.float32)
+		candidates[..., :last - first] = np.sort(blocks(offset + step - 1, core_size, n), axis=2)[:, :, None, first:last]
+		if step > 1:
+			# frames before and after the core, window j of a block contains ends[j:j + step - 1]
+			ends = np.concatenate((blocks(offset, step - 1, n), blocks(offset + window, step - 1, n)), axis=2)
+			candidates[..., last - first:] = np.lib.stride_tricks.as_strided(ends, shape=(n_cells, n, step, step - 1),
+				strides=ends.strides + ends.strides[2:])
+		candidates.partition((rank - first, next_rank - first), axis=3)
+		lower = candidates[..., rank - first].reshape(n_cells, n * step)
+		block = values[:, offset:offset + n * step]
+		np.subtract(candidates[..., next_rank - first].reshape(n_cells, n * step), lower, out=block)
+		block *= fraction
+		block += lower
+
+	if out is None:
+		out = np.empty((n_cells, n_frames), dtype=np.float32)
+	half = window // 2
+	out[:, half:half + n_windows] = values[:, :n_windows]
+	out[:, :half] = values[:, :1]
+	out[:, half + n_windows:] = values[:, n_windows - 1:n_windows]
+	return(out)
+
+def bleach_baseline(traces, out=None, iterations=3):
+	'''
+	Fits a decaying exponential F0 = a * exp(b * t) to every row of a (cells, frames) array by linear least squares on
+	log(F), solved in closed form for all cells at once. Every further iteration refits only the frames below the last
+	fit, so calcium transients do not pull the baseline up. 'out' (float32) holds log(F) while fitting, a single float32
+	work array of the same shape holds the weights, the weighted log(F) and the fit in turn.
+	'''
+	traces = np.atleast_2d(traces)
+	n_cells, n_frames = traces.shape
+	if out is None:
+		out = np.empty((n_cells, n_frames), dtype=np.float32)
+	np.maximum(traces, np.finfo(np.float32).tiny, out=out, casting="unsafe")
+	np.log(out, out=out)
+	time_points = np.linspace(-1, 1, n_frames).astype(np.float32) # centered, so the normal equations are well conditioned
+	work = np.ones((n_cells, n_frames), dtype=np.float32) # weights of the first fit
+	for iteration in range(max(1, iterations)):
+		if iteration:
+			np.less_equal(out, work, out=work, casting="unsafe") # frames below the last fit
+		n = work.sum(axis=1, dtype=np.float64)
+		sum_t = work.dot(time_points).astype(np.float64)
+		sum_tt = work.dot(time_points**2).astype(np.float64)
+		work *= out
+		sum_y = work.sum(axis=1, dtype=np.float64)
+		sum_ty = work.dot(time_points).astype(np.float64)
+		denominator = n * sum_tt - sum_t**2
+		with np.errstate(divide="ignore", invalid="ignore"):
+			slope = np.where(denominator > 0, (n * sum_ty - sum_t * sum_y) / denominator, 0).astype(np.float32)
+			intercept = np.where(n > 0, (sum_y - slope * sum_t) / n, 0).astype(np.float32)
+		np.multiply(slope[:, None], time_points, out=work)
+		work += intercept[:, None]
+	np.exp(work, out=out)
+	return(out)
+
+def min_max_decimate(traces, max_points=2000):
+	'''
+	Shortens the rows of a (cells, frames) array to at most 'max_points' values for plotting. The frames are cut into
+	max_points / 2 bins and every bin is replaced by its minimum and maximum (at its first and last frame), which keeps
+	the envelope of every trace including single-frame transients. Returns the frame numbers and the decimated traces;
+	short traces are returned unchanged.
+	'''
+	traces = np.atleast_2d(traces)
+	n_frames = traces.shape[1]
+	frames = np.arange(n_frames)
+	if n_frames <= max_points or max_points < 2:
+		return(frames, traces)
+	bin_starts = np.unique(np.linspace(0, n_frames, max_points // 2, endpoint=False).astype(np.int64))
+	bin_stops = np.append(bin_starts[1:], n_frames) - 1
+	decimated = np.empty((traces.shape[0], 2 * len(bin_starts)), dtype=traces.dtype)
+	decimated[:, 0::2] = np.minimum.reduceat(traces, bin_starts, axis=1)
+	decimated[:, 1::2] = np.maximum.reduceat(traces, bin_starts, axis=1)
+	return(np.column_stack((bin_starts, bin_stops)).ravel(), decimated)
+
 class AnalyzeSingleCells():
 	'''
 	To initialize an instance of this class, pass in a .lsm 'movie' and a mask in form of a 'ccl_object'.
 	Start/stop defines the time span that should be used as baseline or for normalization.
+	The movie is either a decoded array or a LazyLSMReader. Readers are streamed from disk in chunks of 'chunk_size'
+	frames, so movies larger than the available memory can be analyzed; both give the same traces.
+	With 'plot=False' no figure is created ('figure' is None), e.g. when the analysis runs on a background thread and
+	PlotCellTraces is called on the Tk thread afterwards. 'progress' is forwarded to CellTraceExtractor.extract.
+	'baseline', 'baseline_window' and 'baseline_percentile' select the F0 of NormalizeCellTraces, 'plot_style' is passed
+	to PlotCellTraces.
 	'''
-	def __init__(self, input_movie, ccl_object, start, stop, method="mean", legend=True):
+	max_line_cells = 50 # PlotCellTraces draws a heatmap instead of lines for more cells (style 'auto')
+
+	def __init__(self, input_movie, ccl_object, start, stop, method="mean", legend=True, plot=True, progress=None,
+				 chunk_size=256, baseline="mean", baseline_window=300, baseline_percentile=10, plot_style="auto"):
 		'''
 		Calls all class functions and ultimately returns a figure
 		'''
-		self.single_cell_traces = self.subsetWithCclObject(input_mov=input_movie, ccl_object=ccl_object, method=method)
+		self.cell_table = ccl_object.cell_table # row i describes the cell in row i of the traces
 
-		self.normalized_traces = self.NormalizeCellTraces(cell_traces=self.single_cell_traces, start=start, stop=stop)
+		self.single_cell_traces = self.subsetWithCclObject(input_mov=input_movie, ccl_object=ccl_object, method=method,
+														   progress=progress, chunk_size=chunk_size)
 
-		self.figure = self.PlotCellTraces(cell_traces=self.normalized_traces, legend=legend)
-	
+		self.normalized_traces = self.NormalizeCellTraces(cell_traces=self.single_cell_traces, start=start, stop=stop,
+														  baseline=baseline, window=baseline_window,
+														  percentile=baseline_percentile)
+		self.events = None # set by detectEvents
 
-	def subsetWithCclObject(self, input_mov, ccl_object, method):
-		# create a list to save all 'mean pixel value per cell over time' to
-		clusters_list = list()
+		if plot:
+			self.figure = self.PlotCellTraces(cell_traces=self.normalized_traces, legend=legend, style=plot_style)
+		else:
+			self.figure = None
 	
-		# loop over all cells or clusters that were identified
-		if method == "mean":
-			for i in range(1, (ccl_object.im_with_cells.max()+1)):
-				mask = (ccl_object.im_with_cells == i) # creates a mask for a particular cluster i
-				cells_list = list() # create a list to save mean values to
-				# loop over all images in movie and extract sum of pixel values for a particular cluster i	
-				for j in range(0, input_mov.shape[2]):
-					tmp_im = input_mov[0, 0, j, :, :]
-					cells_list.append(np.mean(tmp_im[mask]))
-
-				# append 'cells_list' to list of all clusters
-				clusters_list.append(cells_list)
-
-		elif method == "sum":
-			for i in range(1, (ccl_object.im_with_cells.max()+1)):
-				mask = (ccl_object.im_with_cells == i) # creates a mask for a particular cluster i
-				cells_list = list() # create a list to save mean values to
-				# loop over all images in movie and extract sum of pixel values for a particular cluster i	
-				for j in range(0, input_mov.shape[2]):
-					tmp_im = input_mov[0, 0, j, :, :]
-					cells_list.append(np.sum(tmp_im[mask]))
-
-				# append 'cells_list' to list of all clusters
-				clusters_list.append(cells_list)		
 
+	def subsetWithCclObject(self, input_mov, ccl_object, method, progress=None, chunk_size=256):
+		'''
+		Extracts one trace per cell (rows) over all frames of the movie (columns). All cells are reduced at once by
+		a CellTraceExtractor, 'method' can be 'mean', 'sum', 'median', 'max' or 'min'.
+		'''
+		extractor = CellTraceExtractor(label_image=ccl_object.im_with_cells, method=method, chunk_size=chunk_size,
+									   cell_table=ccl_object.cell_table)
+		if hasattr(input_mov, "read_frames"): # LazyLSMReader, stream frames from disk
+			return(extractor.extract(input_mov, progress=progress))
+		frames = np.asarray(input_mov)
+		while frames.ndim > 3: # arrays are (frames, rows, columns), leading axes of bigger arrays are fixed at 0
+			frames = frames[0]
+		return(extractor.extract(frames, progress=progress))
+
+	def NormalizeCellTraces(self, cell_traces, start, stop, baseline="mean", window=300, percentile=10, out=None):
+		'''
+		Normalized calcium imaging data in form of an array (F / F0, float32). All rows are normalized at once, F0 is
+			'mean'       the mean of timepoints 'start' until 'stop' per row
+			'percentile' the 'percentile' of a sliding window of 'window' frames (see rolling_percentile)
+			'minimum'    the minimum of a sliding window of 'window' frames (see rolling_minimum)
+			'bleach'     an exponential decay fitted to every row (see bleach_baseline)
+		The traces are copied to 'out' (a new float32 array by default, pass the traces themselves to normalize them in
+		place) and divided by F0 there, so besides the output only one baseline buffer is allocated.
+		'''
+		if baseline not in baseline_methods:
+			raise ValueError("Specify a valid baseline! ('mean', 'percentile', 'minimum', 'bleach')")
+		if out is None:
+			out = np.array(cell_traces, dtype=np.float32)
+		elif out is not cell_traces:
+			out[...] = cell_traces
+
+		if baseline == "mean":
+			f0 = np.mean(out[:, start:stop], axis=1, keepdims=True)
+		elif baseline == "percentile":
+			f0 = rolling_percentile(out, window, percentile)
+		elif baseline == "minimum":
+			f0 = rolling_minimum(out, window)
 		else:
-			raise ValueError("Specify a valid method! ('mean', 'sum')")
-
-		# return mean pixel values per cell in a list
-		return(np.array(clusters_list))
-
+			f0 = bleach_baseline(out)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			np.divide(out, f0, out=out)
+		return(out)
 
-	def NormalizeCellTraces(self, cell_traces, start, stop):
+	def detectEvents(self, threshold=0.2, end_threshold=None, min_duration=1):
 		'''
-		Normalized calcium imaging data in form of an array. The mean of timepoints 'start' until 'stop' per row is used for 
-		normalizing the rest of the respective row. Outputs an array as well.
+		Detects calcium events in the normalized traces (see detect_events), stores and returns them.
 		'''
+		self.events = detect_events(self.normalized_traces, threshold=threshold, end_threshold=end_threshold,
+									min_duration=min_duration)
+		return(self.events)
 
-		# create a new array of correct dimensions to store results in
-		output_array = np.zeros(shape=cell_traces.shape, dtype=np.float)
-
-		for i in range(cell_traces.shape[0]):
-			output_array[i, :] = np.divide(cell_traces[i, :], np.mean(cell_traces[i, start:stop]))
-
-		return(output_array)
-
-	def PlotCellTraces(self, cell_traces, legend):
+	def PlotCellTraces(self, cell_traces, legend, style="auto", max_points=None):
 		'''
 		Takes a np.array with one or multiple rows and plots it as a time course. Use normalized data with this function!
+		'style' is 'lines' (all traces in one LineCollection), 'heatmap' (one row of pixels per cell) or 'auto' (lines for
+		up to 'max_line_cells' cells, a heatmap for more, where overlapping lines are unreadable and slow to rasterize).
+		Traces longer than 'max_points' frames (default: two per pixel of the axes) are decimated to the minimum and maximum
+		of each bin of frames (see min_max_decimate), so transients stay visible and drawing time does not grow with the
+		length of the recording. Decimated lines are drawn as filled min/max bands (a PolyCollection), which looks the same
+		but rasterizes much faster than lines zigzagging between minima and maxima. The legend is only drawn for lines.
 		'''
-		# create a time scale for x axis
-		time_scale = np.arange(1, (cell_traces.shape[1]+1))
-
-		# set up a figure and a list to save legend labels to
-		fig = plt.figure(figsize=(10,10))	
-		legend_labels = list()
-
-		# loop over rows in input np.array to plot all traces
-		for i in range(cell_traces.shape[0]):
-			plt.plot(time_scale, cell_traces[i, :]) 
-			legend_labels.append("cell_{number}".format(number=i))
-
-		# add a legend and return figure
-		if legend:
-			plt.legend(legend_labels, loc="upper left")
+		cell_traces = np.atleast_2d(cell_traces)
+		if style == "auto":
+			style = "lines" if cell_traces.shape[0] <= self.max_line_cells else "heatmap"
+		if style not in ("lines", "heatmap"):
+			raise ValueError("Specify a valid style! ('auto', 'lines', 'heatmap')")
+
+		# set up a figure
+		fig = plt.figure(figsize=(10,10))
+		axes = fig.add_subplot(111)
+
+		# create a time scale for x axis and decimate long traces
+		if max_points is None:
+			max_points = int(2 * axes.get_position().width * fig.get_figwidth() * fig.dpi)
+		time_scale, values = min_max_decimate(cell_traces, max_points)
+		time_scale = time_scale + 1
+
+		if style == "lines":
+			colors = plt.rcParams["axes.prop_cycle"].by_key().get("color", ["C0"])
+			if values.shape[1] == cell_traces.shape[1]:
+				segments = np.empty(values.shape + (2, ), dtype=np.float32)
+				segments[:, :, 0] = time_scale
+				segments[:, :, 1] = values
+				axes.add_collection(LineCollection(segments, colors=colors, linewidths=plt.rcParams["lines.linewidth"]))
+			else:
+				# upper edge: maxima from the first to the last bin, lower edge: minima back to the first bin
+				n_points = values.shape[1]
+				bands = np.empty((values.shape[0], 2 * n_points, 2), dtype=np.float32)
+				bands[:, :n_points, 0] = time_scale
+				bands[:, :n_points, 1] = np.repeat(values[:, 1::2], 2, axis=1)
+				bands[:, n_points:, 0] = time_scale[::-1]
+				bands[:, n_points:, 1] = np.repeat(values[:, 0::2], 2, axis=1)[:, ::-1]
+				axes.add_collection(PolyCollection(bands, facecolors=colors, edgecolors=colors,
+												   linewidths=plt.rcParams["lines.linewidth"] / 2))
+			axes.autoscale_view()
+
+			# add a legend (proxy lines, the collection has only one entry)
+			if legend:
+				legend_lines = [matplotlib.lines.Line2D([], [], color=colors[i % len(colors)]) for i in range(len(values))]
+				axes.legend(legend_lines, ["cell_{number}".format(number=i) for i in range(len(values))], loc="upper left")
+			plt.ylabel("F / F0 (Relative Fluorescence)")
+		else:
+			if values.shape[1] != cell_traces.shape[1]: # one pixel per bin, the maximum keeps transients visible
+				values = values[:, 1::2]
+			finite = values[np.isfinite(values)]
+			limits = np.percentile(finite, (1, 99)) if finite.size else (0, 1)
+			image = axes.imshow(values, aspect="auto", interpolation="nearest", cmap="viridis", vmin=limits[0],
+								vmax=limits[1], extent=(0.5, cell_traces.shape[1] + 0.5, len(values) - 0.5, -0.5))
+			fig.colorbar(image, ax=axes, label="F / F0 (Relative Fluorescence)")
+			plt.ylabel("Cell")
 		plt.title("Single Cell Traces")
-		plt.ylabel("F / F0 (Relative Fluorescence)")
 		plt.xlabel("Time (Secs)")
 		return(fig)
 
+#################################
+#### Event Detection - Class ####
+#################################
+# one row per calcium event; 'offset' is the first frame after the event (exclusive like a slice end)
+event_table_dtype = np.dtype([("cell", np.int32), ("onset", np.int32), ("peak", np.int32), ("offset", np.int32),
+							  ("duration", np.int32), ("amplitude", np.float32)])
+
+def detect_events(traces, threshold=0.2, end_threshold=None, min_duration=1, baseline=1.0):
+	'''
+	Detects calcium events in all rows of a (cells, frames) matrix of normalized traces (F / F0) at once and returns
+	them in a structured np.array with 'event_table_dtype', sorted by cell and onset. Thresholds are in dF/F
+	(trace - 'baseline') and can be scalars or one value per cell. With hysteresis, an event is a stretch of frames
+	above 'end_threshold' (default: half of 'threshold') that rises above 'threshold' at least once, so noise around
+	the threshold does not split one transient into many. 'amplitude' is the dF/F at the peak frame, events shorter
+	than 'min_duration' frames are dropped. Runs in a few passes over the matrix, i.e. in linear time.
+	'''
+	traces = np.atleast_2d(np.asarray(traces, dtype=np.float32))
+	n_cells, n_frames = traces.shape
+	threshold = np.asarray(threshold, dtype=np.float32).reshape(-1, 1)
+	end_threshold = threshold / 2 if end_threshold is None else np.asarray(end_threshold, dtype=np.float32).reshape(-1, 1)
+
+	# dF/F with one column of -inf per row, so events never run from one cell into the next
+	dff = np.full((n_cells, n_frames + 1), -np.inf, dtype=np.float32)
+	np.subtract(traces, np.float32(baseline), out=dff[:, :n_frames])
+	above = dff > end_threshold
+	flat_above = above.ravel()
+	if not flat_above.size: # no cells
+		return(np.zeros(0, dtype=event_table_dtype))
+	edges = np.flatnonzero(flat_above[1:] != flat_above[:-1]) + 1
+	if flat_above[0]:
+		edges = np.concatenate(([0], edges))
+	starts, stops = edges[0::2], edges[1::2] # stretches above 'end_threshold', stop is exclusive
+
+	# hysteresis: keep stretches that reach 'threshold', counted with a cumulative sum over the flat matrix
+	crossings = np.concatenate(([0], np.cumsum((dff > threshold).ravel(), dtype=np.int64)))
+	keep = (crossings[stops] > crossings[starts]) & (stops - starts >= min_duration)
+	starts, stops = starts[keep], stops[keep]
+
+	events = np.zeros(len(starts), dtype=event_table_dtype)
+	if not len(starts):
+		return(events)
+	flat_dff = dff.ravel()
+	amplitude = np.maximum.reduceat(flat_dff, np.column_stack((starts, stops)).ravel())[0::2]
+
+	# peak = first frame of an event that reaches its maximum, searched only among the frames of the events
+	durations = stops - starts
+	event_ids = np.repeat(np.arange(len(starts)), durations)
+	frames = np.arange(len(event_ids)) + np.repeat(starts - (np.cumsum(durations) - durations), durations)
+	at_maximum = flat_dff[frames] == amplitude[event_ids]
+	event_ids, frames = event_ids[at_maximum], frames[at_maximum]
+	peaks = frames[np.concatenate(([True], event_ids[1:] != event_ids[:-1]))]
+
+	events["cell"] = starts // (n_frames + 1)
+	events["onset"] = starts % (n_frames + 1)
+	events["peak"] = peaks % (n_frames + 1)
+	events["offset"] = stops % (n_frames + 1)
+	events["duration"] = durations
+	events["amplitude"] = amplitude
+	return(events)
+
 ############################
 #### Analysis 4 - Class ####
 ############################
 class TransformAndFilter():
 	'''
 	This class implements methods for filtering and transforming time series data. It requires a time series object as an input.
-	The class methods perform Fourier transform, Kalman filtering, and XXXX.
+	The time series is a (cells, frames) trace matrix, e.g. 'normalized_traces' of AnalyzeSingleCells. All rows are
+	transformed at once with real FFTs along the time axis in float32. Frequencies are in cycles per frame unless a
+	'sampling_rate' (frames per second) is given, then they are in Hz.
+	Filters are zero-phase Butterworth responses of order 'order' (lowpass, highpass, bandpass). Before filtering, the
+	traces are mirrored at both ends by 'padding' frames (default: a quarter of the trace) so that the first and last
+	frames do not bleed into each other, and zero-padded to a length the FFT is fast for. Transfer functions and the
+	padded work buffer are cached per length, so calls with traces of the same shape only transform and multiply.
+	The Kalman filter and RTS smoother treat every trace as a random walk observed with noise. All cells are updated
+	together as vectors, only the time axis is looped over, in preallocated float32 state buffers.
 	'''
-	def __init__(self, *args, **kwargs):
-		pass
+	filter_types = ("lowpass", "highpass", "bandpass")
+
+	def __init__(self, time_series=None, sampling_rate=1.0, order=4, padding=None):
+		self.time_series = time_series
+		self.sampling_rate = float(sampling_rate)
+		self.order = order
+		self.padding = padding
+		self.fft_module, self.fft_options = fft_backend()
+		self._transfer_functions = dict()
+		self._buffer = None
+		self._kalman_buffers = None
+
+	def fftLength(self, n_samples):
+		'''
+		Returns the smallest length >= 'n_samples' the FFT is fast for.
+		'''
+		if hasattr(self.fft_module, "next_fast_len"):
+			return(self.fft_module.next_fast_len(n_samples, real=True))
+		return(int(2**np.ceil(np.log2(max(n_samples, 1)))))
+
+	def frequencies(self, n_fft):
+		return(np.fft.rfftfreq(n_fft, d=1.0 / self.sampling_rate))
+
+	def fourierTransform(self, time_series=None):
+		'''
+		Returns the frequencies and the amplitude spectrum (one row per trace) of the time series.
+		'''
+		traces = self._traces(time_series)
+		n_frames = max(traces.shape[1], 1)
+		amplitude = np.abs(self.fft_module.rfft(traces, axis=1, **self.fft_options)) * (2.0 / n_frames)
+		amplitude[:, 0] /= 2 # the mean (and the Nyquist frequency of even lengths) has no mirrored negative frequency
+		if n_frames % 2 == 0 and amplitude.shape[1] > 1:
+			amplitude[:, -1] /= 2
+		return(self.frequencies(traces.shape[1]), amplitude.astype(np.float32))
+
+	def transferFunction(self, n_fft, filter_type, cutoffs):
+		'''
+		Returns the (cached) magnitude response of a Butterworth filter at the frequencies of an FFT of length 'n_fft'.
+		'cutoffs' is one frequency for 'lowpass'/'highpass' and a (low, high) pair for 'bandpass'.
+		'''
+		cutoffs = tuple(float(cutoff) for cutoff in np.atleast_1d(cutoffs))
+		key = (n_fft, filter_type, cutoffs, self.order, self.sampling_rate)
+		if key not in self._transfer_functions:
+			frequencies = self.frequencies(n_fft)
+			with np.errstate(divide="ignore", over="ignore"):
+				lowpass = lambda cutoff: 1.0 / np.sqrt(1.0 + (frequencies / cutoff)**(2 * self.order))
+				highpass = lambda cutoff: 1.0 / np.sqrt(1.0 + (cutoff / frequencies)**(2 * self.order))
+				if filter_type == "lowpass" and len(cutoffs) == 1:
+					response = lowpass(cutoffs[0])
+				elif filter_type == "highpass" and len(cutoffs) == 1:
+					response = highpass(cutoffs[0])
+				elif filter_type == "bandpass" and len(cutoffs) == 2:
+					response = highpass(min(cutoffs)) * lowpass(max(cutoffs))
+				else:
+					raise ValueError("Enter a valid filter! ('lowpass'/'highpass' with one cutoff, 'bandpass' with two)")
+			self._transfer_functions[key] = response.astype(np.float32)
+		return(self._transfer_functions[key])
+
+	def filterTraces(self, filter_type, cutoffs, time_series=None):
+		'''
+		Filters every row of the time series and returns a float32 array of the same shape.
+		'''
+		traces = self._traces(time_series)
+		n_traces, n_frames = traces.shape
+		if n_frames < 2:
+			return(traces.astype(np.float32))
+		padding = min(n_frames - 1, n_frames // 4 if self.padding is None else int(self.padding))
+		n_fft = self.fftLength(n_frames + 2 * padding)
+
+		# mirrored ends and zeros up to the FFT length, written into a buffer that is kept for the next call
+		if self._buffer is None or self._buffer.shape != (n_traces, n_fft):
+			self._buffer = np.empty((n_traces, n_fft), dtype=np.float32)
+		padded = self._buffer
+		padded[:, padding:padding + n_frames] = traces
+		padded[:, :padding] = traces[:, padding:0:-1]
+		padded[:, padding + n_frames:2 * padding + n_frames] = traces[:, -2:-padding - 2:-1]
+		padded[:, 2 * padding + n_frames:] = 0
+
+		spectrum = self.fft_module.rfft(padded, axis=1, **self.fft_options)
+		spectrum *= self.transferFunction(n_fft, filter_type, cutoffs)
+		filtered = self.fft_module.irfft(spectrum, n=n_fft, axis=1, **self.fft_options)
+		return(np.array(filtered[:, padding:padding + n_frames], dtype=np.float32))
+
+	def lowpass(self, cutoff, time_series=None):
+		return(self.filterTraces("lowpass", cutoff, time_series))
+
+	def highpass(self, cutoff, time_series=None):
+		return(self.filterTraces("highpass", cutoff, time_series))
+
+	def bandpass(self, low, high, time_series=None):
+		return(self.filterTraces("bandpass", (low, high), time_series))
+
+	def noiseVariance(self, time_series=None):
+		'''
+		Estimates the measurement noise variance of every trace from the median absolute frame-to-frame difference,
+		which is robust to the (slow) signal and to single transients.
+		'''
+		traces = self._traces(time_series)
+		if traces.shape[1] < 2:
+			return(np.ones(traces.shape[0], dtype=np.float32))
+		mad = np.median(np.abs(np.diff(traces, axis=1)), axis=1) / 0.6745
+		variance = (mad**2 / 2).astype(np.float32)
+		variance[~(variance > 0)] = 1
+		return(variance)
+
+	def kalmanFilter(self, process_noise=None, measurement_noise=None, time_series=None, smooth=False):
+		'''
+		Runs a Kalman filter (and with 'smooth=True' a Rauch-Tung-Striebel smoother) over every row of the time series.
+		'measurement_noise' is the noise variance of the traces (a scalar or one value per trace, default: estimated
+		with 'noiseVariance'), 'process_noise' the variance of the frame-to-frame change of the underlying signal
+		(default: 1% of the measurement noise). Larger process noise follows the data more closely.
+		Returns a float32 array of the same shape as the time series.
+		'''
+		traces = self._traces(time_series)
+		n_traces, n_frames = traces.shape
+		if not n_frames:
+			return(np.empty((n_traces, 0), dtype=np.float32))
+		r = self.noiseVariance(traces) if measurement_noise is None else measurement_noise
+		r = np.broadcast_to(np.asarray(r, dtype=np.float32), (n_traces,))
+		q = np.float32(0.01) * r if process_noise is None else process_noise
+		q = np.broadcast_to(np.asarray(q, dtype=np.float32), (n_traces,))
+
+		# time-major buffers so that every step works on contiguous rows
+		if self._kalman_buffers is None or self._kalman_buffers[0].shape != (n_frames, n_traces):
+			self._kalman_buffers = (np.empty((n_frames, n_traces), dtype=np.float32),
+				np.empty((n_frames, n_traces), dtype=np.float32), np.empty(n_traces, dtype=np.float32),
+				np.empty(n_traces, dtype=np.float32))
+		state, variance, gain, work = self._kalman_buffers
+		state[...] = traces.T
+		variance[0] = r
+
+		# forward pass: the measurements in 'state' are overwritten by the filtered estimates
+		for t in range(1, n_frames):
+			np.add(variance[t - 1], q, out=work) # predicted variance
+			np.add(work, r, out=gain)
+			np.divide(work, gain, out=gain)
+			np.subtract(state[t], state[t - 1], out=state[t])
+			np.multiply(state[t], gain, out=state[t])
+			np.add(state[t], state[t - 1], out=state[t])
+			np.subtract(1, gain, out=gain)
+			np.multiply(work, gain, out=variance[t])
+
+		# backward pass: the filtered estimates are overwritten by the smoothed ones
+		if smooth:
+			for t in range(n_frames - 2, -1, -1):
+				np.add(variance[t], q, out=work)
+				np.divide(variance[t], work, out=gain)
+				np.subtract(state[t + 1], state[t], out=work)
+				np.multiply(work, gain, out=work)
+				np.add(state[t], work, out=state[t])
+		return(np.ascontiguousarray(state.T))
+
+	def kalmanSmoother(self, process_noise=None, measurement_noise=None, time_series=None):
+		return(self.kalmanFilter(process_noise, measurement_noise, time_series, smooth=True))
+
+	def _traces(self, time_series):
+		time_series = self.time_series if time_series is None else time_series
+		if time_series is None:
+			raise ValueError("Pass a time series (cells, frames) to filter!")
+		return(np.atleast_2d(np.asarray(time_series, dtype=np.float32)))
 
 
 
@@ -0,0 +1,49 @@
+'''
+LAZY IMPORTS! CalciumImagingAnalyzer App
+developed by Daniel (d.schuette@online.de)
+Heavy dependencies (skimage submodules, scipy.ndimage, pandas, ...) slow down the start of the app and of every batch
+worker. Modules wrapped in a LazyModule are only imported when one of their attributes is used for the first time.
+-> runs with python 2.7.14 and python 3.6.x
+repository: https://github.com/DanielSchuette/CalciumImagingAnalyzer.git
+'''
+import importlib
+import threading
+
+class LazyModule(object):
+	'''
+	Stands in for the module 'module_name' until one of its attributes is accessed, then imports the module once and
+	forwards all attribute lookups to it. Use it like a regular module:
+		measure = LazyModule("skimage.measure")
+		labels = measure.label(image) # skimage.measure is imported here
+	An ImportError (e.g. a missing optional dependency) is raised at that point, not when the app starts.
+	'''
+	def __init__(self, module_name):
+		self.__dict__["_module_name"] = module_name
+		self.__dict__["_module"] = None
+		self.__dict__["_lock"] = threading.Lock()
+
+	def _load(self):
+		if self._module is None:
+			with self._lock:
+				if self._module is None:
+					self.__dict__["_module"] = importlib.import_module(self._module_name)
+		return(self._module)
+
+	def is_loaded(self):
+		'''
+		Returns whether the wrapped module has been imported yet.
+		'''
+		return(self._module is not None)
+
+	def __getattr__(self, attribute):
+		return(getattr(self._load(), attribute))
+
+	def __setattr__(self, attribute, value):
+		setattr(self._load(), attribute, value)
+
+	def __dir__(self):
+		return(dir(self._load()))
+
+	def __repr__(self):
+		state = "loaded" if self.is_loaded() else "not loaded"
+		return("<LazyModule '{}' ({})>".format(self._module_name, state))
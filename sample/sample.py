@@ -13,28 +13,10 @@ background_color2 = "light blue"
 #### Import All Required Modules ####
 #####################################
 import warnings, timeit
-with warnings.catch_warnings(): # suppresses keras' annoying numpy warning
-	warnings.simplefilter("ignore")
-	import keras
-	from keras import layers
-	import tensorflow as tf
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
-import tensorflow.core.protobuf
-import google.protobuf
-import tifffile as tiff # module downloaded from https://github.com/blink1073/tifffile.git
-import numpy as np
-import pandas as pd
-import matplotlib
 import time
-matplotlib.use("TkAgg") # otherwise matplotlib will crash the app
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-import matplotlib.backends.tkagg as tkagg
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
-from matplotlib.figure import Figure
-import pylab
+from collections import OrderedDict
 import sys
 from sys import platform
 if sys.version_info[0] < 3:
@@ -50,14 +32,7 @@ else: # Python 3 does work as well after fixing 'Foundation' module (from pyobjc
     from tkinter import filedialog as tkFileDialog
 
 import os, errno
-os.environ["TF_CPP_MIN_LOG_LEVEL"] = '2'
-import helpers as hlp # imports helpers.py
-from skimage import measure
-from skimage import filters
-from skimage.feature import canny
-from scipy import ndimage as ndi
-from skimage.filters import sobel
-from skimage.morphology import watershed
+import helpers as hlp # imports helpers.py (heavy dependencies like skimage are imported lazily, see lazy_import.py)
 import logging
 
 # initiate logging for debug purposes
@@ -97,6 +72,9 @@ main_frame.canvas.create_rectangle(430, 5, 905, 740, fill=background_color2, wid
 def callback_when_quit():
     if tkMessageBox.askokcancel("Quit", "Do you really want to quit?\nAll unsaved progress will be lost..."):
         root.destroy()
+        print("Finishing {} export(s)...".format(hlp.figure_exporter.pending() + hlp.tiff_exporter.pending()))
+        hlp.figure_exporter.wait() # files that are written in the background
+        hlp.tiff_exporter.wait()
         logging.debug("End logging.")
         sys.exit(0)
 
@@ -115,9 +93,30 @@ save_file_path = False # initialize a directory to save to
 save_tif_var = tk.IntVar() # initialize a dynamic variable to indicate whether tiffs should be saved
 save_txt_var = tk.IntVar() # initialize a dynamic variable to indicate whether txts should be saved
 save_pdf_var = tk.IntVar() # initialize a dynamic variable to indicate whether pdfs should be saved
+save_h5_var = tk.IntVar() # initialize a dynamic variable to indicate whether results should be saved as .h5
 save_tif_var.set(0)
 save_txt_var.set(0)
 save_pdf_var.set(0)
+save_h5_var.set(0)
+
+# channel and position of multi-channel/multi-position recordings (1-indexed, like image numbers)
+channel_var = tk.IntVar()
+channel_var.set(1)
+position_var = tk.IntVar()
+position_var.set(1)
+
+def update_axis_selection(file_path):
+	# limit the channel and position selection to the axes of the selected file (only its header is read)
+	try:
+		sizes = hlp.movie_cache.reader(file_path).sizes
+	except Exception as error:
+		print("Could not read the axes of {}: {}".format(file_path, error))
+		return
+	for spinbox, variable, axis in ((channel_spinbox, channel_var, "C"), (position_spinbox, position_var, "P")):
+		spinbox.config(to=sizes[axis])
+		variable.set(min(variable.get(), sizes[axis]))
+	print("The file has {} frames, {} channel(s) and {} position(s) of {} x {} pixels.".format(sizes["T"], sizes["C"],
+		sizes["P"], sizes["Y"], sizes["X"]))
 
 def pressed_open():
 	global open_file_path
@@ -125,6 +124,8 @@ def pressed_open():
 	if open_file_path != False:
 		if not open_file_path.endswith(".lsm"):
 			tkMessageBox.showerror("Error", "You have to select a .lsm file!")
+		else:
+			update_axis_selection(open_file_path)
 	return(open_file_path)
 
 def pressed_save():	
@@ -165,85 +166,165 @@ def buttonPressed(event):
 		time.sleep(0.1)
 		button.config(state = "normal")
 
+def show_job_error(error):
+	# analyses run on a background thread (see 'job_executor'), their errors are reported here on the Tk thread
+	tkMessageBox.showerror("Error", "The analysis failed:\n{}".format(error))
+
+preview_window = None # the preview popup window stays open, new cutoffs only update its figure
+preview_figure = None
+preview_key = None # file, image, channel and position shown in the preview window
+
+def update_preview(value=None):
+	# called by the cutoff sliders of the preview window (blits the new cutoffs in a few milliseconds)
+	cutoff1, cutoff2 = cutoff1_var.get(), cutoff2_var.get()
+	for entry, cutoff in ((preview_cutoff1_entry, cutoff1), (preview_cutoff2_entry, cutoff2)):
+		state = entry["state"] # entries are disabled after <Return>, they only show the new value
+		entry["state"] = tk.NORMAL
+		entry.delete(0, tk.END)
+		entry.insert(0, str(cutoff))
+		entry["state"] = state
+	preview_figure.update(cutoff1, cutoff2)
+
 def pressed_prepro_preview():
 	global open_file_path
-	
-	# create figure using one of the analysis functions
-	fig_1 = hlp.preprocessingFunction(image_number=preview_im_no_entry.get(), file_path=open_file_path, 
-									  cutoff1=cutoff1_var.get(), cutoff2=cutoff2_var.get(), save_directory=save_file_path,
-									  save_tiff_checkbox=save_tif_var.get(), save_pdf_checkbox=save_pdf_var.get())
-	
-	if fig_1 != False:
-
-		# initialize a popup window widget:
-		popup_window = hlp.PopupWindow(master=root, title="Exploratory Data Analysis", **popup_config)
-		popup_window.minsize(400, 300)
-
-		# plot figure in popup window
-		figure_1 = hlp.scrollableFigure(figure=fig_1, master=popup_window)
-		print("You plotted an exploratory data analysis!")
-	else:
-		if sys.version_info[0] < 3:
-			tkMessageBox.showerror("Error", "You have to specify an input to plot a preview!")
+	global preview_window
+	global preview_figure
+	global preview_key
+
+	# read all entries on the Tk thread, the file is then read on the background thread
+	image_number, file_path, save_directory = preview_im_no_entry.get(), open_file_path, save_file_path
+	cutoff1, cutoff2 = cutoff1_var.get(), cutoff2_var.get()
+	save_tiff_checkbox, save_pdf_checkbox = save_tif_var.get(), save_pdf_var.get()
+	channel, position = channel_var.get() - 1, position_var.get() - 1
+	key = (file_path, image_number, channel, position)
+
+	# the image is already shown, only the cutoffs changed
+	if preview_window is not None and preview_window.winfo_exists() and preview_key == key:
+		preview_figure.update(cutoff1, cutoff2)
+		preview_window.lift()
+		hlp.save_pdf(save_directory=save_directory, figure=preview_figure.figure, save_pdf_checkbox=save_pdf_checkbox,
+					 name="exploratory_data_analysis")
+		# like preprocessingData on a new image (the save directory may have changed, a recording is only exported once)
+		hlp.create_new_directories(save_directory=save_directory)
+		hlp.export_tiffs(save_directory=save_directory, file_path=file_path, save_tiff_checkbox=save_tiff_checkbox)
+		return
+
+	def work(job):
+		return(hlp.preprocessingData(image_number=image_number, file_path=file_path, save_directory=save_directory,
+									 save_tiff_checkbox=save_tiff_checkbox, channel=channel, position=position))
+
+	def done(preview_data):
+		global preview_window
+		global preview_figure
+		global preview_key
+
+		if preview_data != False:
+			# create the figure once, later changes of the cutoffs only update it; pyplot keeps every figure until it is
+			# closed, so the figure of the previous image is closed first
+			if preview_figure is not None:
+				hlp.plt.close(preview_figure.figure)
+			preview_figure = hlp.PreviewFigure(preview_data=preview_data, image_number=image_number, file_path=file_path,
+											   cutoff1=cutoff1, cutoff2=cutoff2)
+			hlp.save_pdf(save_directory=save_directory, figure=preview_figure.figure, save_pdf_checkbox=save_pdf_checkbox,
+						 name="exploratory_data_analysis")
+
+			# initialize a popup window widget (or reuse the open one):
+			if preview_window is not None and preview_window.winfo_exists():
+				preview_window.destroy()
+			preview_window = hlp.PopupWindow(master=root, title="Exploratory Data Analysis", **popup_config)
+			preview_window.minsize(400, 300)
+			preview_key = key
+
+			# plot figure in popup window
+			figure_1 = hlp.scrollableFigure(figure=preview_figure.figure, master=preview_window)
+
+			# sliders below the figure move the cutoffs
+			slider_frame = tk.Frame(preview_window)
+			slider_frame.grid(row=2, column=0, columnspan=2, sticky=tk.EW)
+			slider_frame.columnconfigure(0, weight=1)
+			slider_frame.columnconfigure(1, weight=1)
+			max_value = max(255, preview_data["histogram"].max_value)
+			for column, (label, variable) in enumerate((("Filter 1", cutoff1_var), ("Filter 2", cutoff2_var))):
+				slider = tk.Scale(slider_frame, label=label, from_=0, to=max_value, orient=tk.HORIZONTAL, variable=variable,
+								  command=update_preview)
+				slider.grid(row=0, column=column, sticky=tk.EW)
+			print("You plotted an exploratory data analysis!")
 		else:
-			messagebox.showerror("Error", "You have to specify an input to plot a preview!")
+			tkMessageBox.showerror("Error", "You have to specify an input to plot a preview!")
+
+	job_executor.submit(name="Preview Filters", work=work, on_done=done, on_error=show_job_error)
 
 # define dynamic variables that are fed into analysis function
 ccl_object = False
 method_var = tk.StringVar()
 method_var.set("segmentation")
+motion_correction_var = tk.IntVar() # correct motion (drift) before cells are identified
+motion_correction_var.set(0)
+cells_movie = None # motion corrected movie the current cells were identified in (None = raw movie)
+cells_selection = (0, 0) # channel and position the current cells were identified in
+projection_var = tk.StringVar() # identify cells in a single frame or in a projection of the whole movie
+projection_var.set("frame")
 
 # start analysis
 def pressed_find_cells():
 	global open_file_path
 	global save_file_path
 	global save_pdf_var
-	global ccl_object
 	
 	if open_file_path:
-		# load image
-		image = tiff.imread(open_file_path)
-		selected_image = image[0, 0, (int(analysis_im_no_entry.get()) - 1), :, :]
-		ccl_object = hlp.ConnectedComponentsLabeling(input_image=selected_image, pixel_threshold=cutoff_analysis.get(), 
-												 	 min_threshold=min_cell_size.get(), max_threshold=max_cell_size.get(), 
-												 	 skimage=True, method=method_var.get())
-		# plot
-		fig_2, (ax1, ax2, ax3) = plt.subplots(nrows=1, ncols=3, figsize=(12, 8))
-		fig_2.subplots_adjust(wspace=0.2, hspace=0.05, right=0.80, left=0.05, bottom=0.05, top=0.95)
-
-		# subplot 1
-		ax1.set_title("Native Image {}".format(analysis_im_no_entry.get()))
-		ax1.axis("off")
-		ax1.imshow(selected_image, cmap="gray")
-		
-		# subplot 2
-		ax2.set_title("Processed Image {}\nAll Sizes (Filter={})".format(analysis_im_no_entry.get(), cutoff_analysis.get()))
-		ax2.axis("off")
-		ax2.imshow(ccl_object.im_ccl, cmap="nipy_spectral")
-		
-		# subplot 3
-		ax3.set_title("Processed Image {no}\nSizes {min} - {max} (Filter={filter})".format(no=analysis_im_no_entry.get(), 
-			min=min_cell_size.get(), max=max_cell_size.get(), filter=cutoff_analysis.get()))
-		ax3.axis("off")
-		subplot3 = ax3.imshow(ccl_object.im_with_cells, cmap="nipy_spectral")
-		colbar_ax = fig_2.add_axes([0.85, 0.2, 0.03, 0.6]) 
-		fig_2.colorbar(subplot3, cax=colbar_ax)
-		
-		# set up a popup window to plot figure to
-		popup_window_2 = hlp.PopupWindow(master=root, title="Find Cells - Result", **popup_config)
-		popup_window_2.minsize(550, 450)
-		figure_2 = hlp.scrollableFigure(figure=fig_2, master=popup_window_2)
-
-		# save the figure to the specified save directory if checkbox is checked
-		hlp.create_new_directories(save_directory=save_file_path)
-		hlp.save_pdf(save_directory=save_file_path, figure=fig_2, save_pdf_checkbox=save_pdf_var.get(),
-			name="cell_identification_output")
+		# read all entries on the Tk thread, reading the image and finding cells happens on the background thread
+		file_path, save_directory, save_pdf_checkbox = open_file_path, save_file_path, save_pdf_var.get()
+		image_number, method = analysis_im_no_entry.get(), method_var.get()
+		pixel_threshold, min_threshold, max_threshold = cutoff_analysis.get(), min_cell_size.get(), max_cell_size.get()
+		correct_motion, projection = motion_correction_var.get(), projection_var.get()
+		channel, position = channel_var.get() - 1, position_var.get() - 1
+		image_label = image_number if projection == "frame" else "({} projection)".format(projection)
+
+		def work(job):
+			# load image (from the motion corrected movie, which is computed once and then reused from the cache)
+			movie = None
+			cache_directory = os.path.join(save_directory, "cache") if save_directory else None
+			if correct_motion:
+				movie = hlp.MotionCorrection(file_path, cache_directory=cache_directory,
+					reference_frame=int(image_number) - 1, channel=channel, position=position, progress=job.setProgress)
+			if projection != "frame": # projections are cached per file as well
+				selected_image = hlp.projection_image(file_path, mode=projection, movie=movie,
+					cache_directory=cache_directory, channel=channel, position=position, progress=job.setProgress)
+			elif movie is not None:
+				selected_image = movie.read_frame(int(image_number) - 1)
+			else:
+				selected_image = hlp.load_frame(file_path, int(image_number) - 1, channel=channel, position=position)
+			job.checkCancelled()
+			new_ccl_object = hlp.ConnectedComponentsLabeling(input_image=selected_image, pixel_threshold=pixel_threshold, 
+													 	 	 min_threshold=min_threshold, max_threshold=max_threshold, 
+													 	 	 skimage=False, method=method,
+													 	 	 projection=None if projection == "frame" else projection, tile_size=512)
+			return(selected_image, new_ccl_object, movie)
+
+		def done(result):
+			global ccl_object, cells_movie, cells_selection
+			selected_image, ccl_object, cells_movie = result
+			cells_selection = (channel, position)
+
+			# plot
+			fig_2 = hlp.plot_cell_identification(selected_image=selected_image, ccl_object=ccl_object,
+				image_number=image_label, pixel_threshold=pixel_threshold, min_threshold=min_threshold,
+				max_threshold=max_threshold)
+			
+			# set up a popup window to plot figure to
+			popup_window_2 = hlp.PopupWindow(master=root, title="Find Cells - Result", **popup_config)
+			popup_window_2.minsize(550, 450)
+			figure_2 = hlp.scrollableFigure(figure=fig_2, master=popup_window_2)
+
+			# save the figure to the specified save directory if checkbox is checked
+			hlp.create_new_directories(save_directory=save_directory)
+			hlp.save_pdf(save_directory=save_directory, figure=fig_2, save_pdf_checkbox=save_pdf_checkbox,
+				name="cell_identification_output")
+
+		job_executor.submit(name="Find Cells", work=work, on_done=done, on_error=show_job_error)
 
 	else:
-		if sys.version_info[0] < 3:
-			tkMessageBox.showerror("Error", "You have to specify an input to find some cells!")
-		else:
-			messagebox.showerror("Error", "You have to specify an input to find some cells!")
+		tkMessageBox.showerror("Error", "You have to specify an input to find some cells!")
 
 def pressed_plot_cells():
 	global ccl_object
@@ -251,29 +332,42 @@ def pressed_plot_cells():
 	global save_file_path
 
 	if ccl_object:
-		# analyze data
-		image = tiff.imread(open_file_path)
-		single_cell_object = hlp.AnalyzeSingleCells(input_movie=image, ccl_object=ccl_object, start=0, stop=30, legend=False,
-			method="mean")
-		fig_3 = single_cell_object.figure
-		
-		# set up a popup window to plot figure to
-		popup_window_3 = hlp.PopupWindow(master=root, title="Data Analysis", **popup_config)
-		popup_window_3.minsize(550, 450)
-		figure_3 = hlp.scrollableFigure(figure=fig_3, master=popup_window_3)
-
-		# save results if checkbox is checked
-		hlp.create_new_directories(save_directory=save_file_path)
-		hlp.save_pdf(save_directory=save_file_path, figure=fig_3, save_pdf_checkbox=save_pdf_var.get(),
-			name="single_cell_traces")
-		hlp.save_txt(save_directory=save_file_path, matrix=single_cell_object.normalized_traces,
-			save_txt_checkbox=save_txt_var.get(), name="normalized_cell_traces")
+		# read all entries on the Tk thread, the movie is analyzed on the background thread
+		file_path, save_directory, cells, movie = open_file_path, save_file_path, ccl_object, cells_movie
+		channel, position = cells_selection
+		save_pdf_checkbox, save_txt_checkbox, save_h5_checkbox = save_pdf_var.get(), save_txt_var.get(), save_h5_var.get()
+
+		def work(job):
+			# analyze data (the movie is streamed from disk in chunks, so it does not need to fit into memory)
+			reader = movie or hlp.movie_cache.reader(file_path, channel=channel, position=position)
+			return(hlp.AnalyzeSingleCells(input_movie=reader, ccl_object=cells, start=0, stop=30, legend=False,
+				method="mean", plot=False, progress=job.setProgress))
+
+		def done(single_cell_object):
+			single_cell_object.figure = single_cell_object.PlotCellTraces(cell_traces=single_cell_object.normalized_traces,
+				legend=False)
+			fig_3 = single_cell_object.figure
+			
+			# set up a popup window to plot figure to
+			popup_window_3 = hlp.PopupWindow(master=root, title="Data Analysis", **popup_config)
+			popup_window_3.minsize(550, 450)
+			figure_3 = hlp.scrollableFigure(figure=fig_3, master=popup_window_3)
+
+			# save results if checkbox is checked
+			hlp.create_new_directories(save_directory=save_directory)
+			hlp.save_pdf(save_directory=save_directory, figure=fig_3, save_pdf_checkbox=save_pdf_checkbox,
+				name="single_cell_traces")
+			hlp.save_txt(save_directory=save_directory, matrix=single_cell_object.normalized_traces,
+				save_txt_checkbox=save_txt_checkbox, name="normalized_cell_traces")
+			hlp.save_results(save_directory=save_directory, single_cell_object=single_cell_object, ccl_object=cells,
+				save_results_checkbox=save_h5_checkbox, recording=hlp.recording_name(file_path),
+				parameters=dict(start=0, stop=30, trace_method="mean", motion_corrected=movie is not None, channel=channel + 1,
+				position=position + 1), source_file=file_path)
+
+		job_executor.submit(name="Plot Time Series", work=work, on_done=done, on_error=show_job_error)
 
 	else:
-		if sys.version_info[0] < 3:
-			tkMessageBox.showerror("Error", "To analyze your experiment, you have to find some cells first!")
-		else:
-			messagebox.showerror("Error", "To analyze your experiment, you have to find some cells first!")
+		tkMessageBox.showerror("Error", "To analyze your experiment, you have to find some cells first!")
 
 # define callback functions for input fields of main window
 def file_entries_callback1(event):
@@ -404,6 +498,27 @@ menubar = tk.Menu(root)
 filemenu = tk.Menu(menubar, tearoff=0)
 filemenu.add_command(label="Open...", command=pressed_open_filemenu)
 filemenu.add_command(label="Save Directory", command=pressed_save_filemenu)
+
+# figure export settings (formats and resolution of rasterized images/contours/traces)
+figure_format_vars = OrderedDict((file_format, tk.IntVar()) for file_format in ("pdf", "png", "svg"))
+figure_format_vars["pdf"].set(1)
+figure_dpi_var = tk.IntVar()
+figure_dpi_var.set(hlp.figure_exporter.dpi)
+
+def figure_export_settings_changed():
+	formats = tuple(file_format for file_format, var in figure_format_vars.items() if var.get())
+	hlp.figure_exporter.formats = formats or ("pdf", ) # at least one format
+	hlp.figure_exporter.dpi = figure_dpi_var.get()
+
+figuremenu = tk.Menu(filemenu, tearoff=0)
+for file_format, var in figure_format_vars.items():
+	figuremenu.add_checkbutton(label="Save Figures as .{}".format(file_format), variable=var,
+		command=figure_export_settings_changed)
+figuremenu.add_separator()
+for dpi in (100, 150, 300, 600):
+	figuremenu.add_radiobutton(label="{} dpi".format(dpi), variable=figure_dpi_var, value=dpi,
+		command=figure_export_settings_changed)
+filemenu.add_cascade(label="Figure Export", menu=figuremenu)
 filemenu.add_separator()
 filemenu.add_command(label="Restart", command=callback_when_restart)
 filemenu.add_separator()
@@ -422,6 +537,9 @@ analysismenu = tk.Menu(menubar, tearoff=0)
 analysismenu.add_command(label="Preview Filter Settings", command=pressed_prepro_preview)
 analysismenu.add_command(label="Find Cells...", command=pressed_find_cells)
 analysismenu.add_command(label="Plot Time Series", command=pressed_plot_cells)
+analysismenu.add_separator()
+analysismenu.add_command(label="Cancel Running Analysis", command=lambda: job_executor.cancel())
+analysismenu.add_command(label="Cancel All Analyses", command=lambda: job_executor.cancelAll())
 
 # Then, add drop down menus to menu bar
 menubar.add_cascade(label="File", menu=filemenu)
@@ -477,6 +595,14 @@ output_var.set("Please select a directory.")
 output_label = tk.Label(main_frame.canvas, textvariable=output_var, font="Arial 10 italic", bg=background_color2)
 main_frame.canvas.create_window(570, 161, window=output_label, anchor=tk.NW)
 
+# channel and position selection (limited to the axes of the selected file)
+main_frame.canvas.create_text(20, 190, text="Channel", font="Arial 12", anchor=tk.NW)
+channel_spinbox = tk.Spinbox(main_frame.canvas, from_=1, to=1, width=3, textvariable=channel_var, font="Arial 12")
+main_frame.canvas.create_window(80, 188, window=channel_spinbox, anchor=tk.NW)
+main_frame.canvas.create_text(140, 190, text="Position", font="Arial 12", anchor=tk.NW)
+position_spinbox = tk.Spinbox(main_frame.canvas, from_=1, to=1, width=3, textvariable=position_var, font="Arial 12")
+main_frame.canvas.create_window(200, 188, window=position_spinbox, anchor=tk.NW)
+
 ###############
 ## Section 2 ##
 ###############
@@ -526,6 +652,9 @@ analysis_im_no_entry.insert(0, str(analysis_im_no.get()))
 analysis_im_no_entry.bind("<Return>", get_analysis_im_number)
 analysis_im_no_entry.bind("<Button-1>", activateEntryField)
 main_frame.canvas.create_window(275, 436, window=analysis_im_no_entry, anchor=tk.NW)
+projection_menu = tk.OptionMenu(main_frame.canvas, projection_var, "frame", *hlp.projection_modes)
+projection_menu.config(bg=background_color, font="Arial 12")
+main_frame.canvas.create_window(345, 436, window=projection_menu, anchor=tk.NW)
 
 # Analysis filter
 main_frame.canvas.create_text(127, 492, text="** Analysis Filter (0-255)  ---", font="Arial 14 italic")
@@ -567,6 +696,9 @@ main_frame.canvas.create_window(240, 635, window=method_radio_segmentation, anch
 find_cells_button = tk.Button(main_frame.canvas, width=12, text="Find Cells", font="Arial 18", 
 								  highlightbackground=background_color, command=pressed_find_cells)
 main_frame.canvas.create_window(30, 660, window=find_cells_button, anchor=tk.NW)
+motion_correction_checkbutton = tk.Checkbutton(main_frame.canvas, text="correct motion first", variable=motion_correction_var,
+	bg=background_color, font="Arial 12")
+main_frame.canvas.create_window(240, 668, window=motion_correction_checkbutton, anchor=tk.NW)
 
 ###############
 ## Section 3 ##
@@ -589,13 +721,24 @@ txt_checkbutton = tk.Checkbutton(main_frame.canvas, text="save analyzed data as
 	font="Arial 12")
 pdf_checkbutton = tk.Checkbutton(main_frame.canvas, text="save figures as .pdf", variable=save_pdf_var, bg=background_color2,
 	font="Arial 12")
+h5_checkbutton = tk.Checkbutton(main_frame.canvas, text="save results as .h5", variable=save_h5_var, bg=background_color2,
+	font="Arial 12")
 main_frame.canvas.create_window(440, 240, window=tif_checkbutton, anchor=tk.NW)
 main_frame.canvas.create_window(440, 260, window=txt_checkbutton, anchor=tk.NW)
 main_frame.canvas.create_window(440, 280, window=pdf_checkbutton, anchor=tk.NW)
+main_frame.canvas.create_window(440, 300, window=h5_checkbutton, anchor=tk.NW)
 
 ## Single Cell Traces Plotting Options
 #################### ADD ####################
 
+## Analysis progress
+# analyses run on a background thread, so the window stays responsive; results are shown once a job is done
+main_frame.canvas.create_text(530, 600, text="Analysis Progress:", font="Arial 18")
+job_status_bar = hlp.JobStatusBar(main_frame.canvas)
+main_frame.canvas.create_window(440, 620, window=job_status_bar, anchor=tk.NW)
+job_executor = hlp.JobExecutor(master=root, on_status=job_status_bar.showStatus)
+job_status_bar.connect(job_executor)
+
 
 ## button callbacks and bindings
 # list all buttons for callback effects (buttonPressed)!
@@ -1,6 +1,7 @@
 # build app with python 2.7.14
 from cx_Freeze import setup, Executable
 import os
+import re
 import sys
 import io
 import matplotlib
@@ -10,15 +11,16 @@ import appdirs
 import packaging
 import packaging.version
 import packaging.specifiers
-import tensorflow
-import tensorflow.core.protobuf
-from google.protobuf import descriptor as _descriptor
 
 # Dependencies are automatically detected, but it might need
 # fine tuning.
-buildOptions = dict(includes = ["matplotlib.backends.backend_tkagg"],
+# modules wrapped in a LazyModule (see helpers.py) are imported by name at runtime and have to be listed explicitly,
+# read them from the declarations in helpers.py so the list cannot drift
+with io.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "helpers.py"), encoding="utf-8") as helpers_file:
+	lazy_packages = re.findall(r'^\w+\s*=\s*LazyModule\(["\']([\w.]+)["\']\)', helpers_file.read(), re.MULTILINE)
+buildOptions = dict(includes = ["matplotlib.backends.backend_tkagg", "lazy_import"],
 					include_files = ["../data/if_application-x-python_8974.icns", "../data/example_data.lsm"],
-					packages = ["Tkinter", "numpy.core._methods", "numpy.lib.format", "tkFileDialog", "matplotlib.style", "matplotlib.legend_handler", "FileDialog", "appdirs", "packaging", "io"], 
+					packages = ["Tkinter", "numpy.core._methods", "numpy.lib.format", "tkFileDialog", "matplotlib.style", "matplotlib.legend_handler", "FileDialog", "appdirs", "packaging", "io"] + lazy_packages, 
 					excludes = [])
 
 base = 'Win32GUI' if sys.platform=='win32' else None
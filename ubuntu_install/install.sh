@@ -9,9 +9,6 @@ sudo apt-get update
 sudo apt-get install python-pip
 pip --version
 sudo pip install tifffile
-sudo pip install keras 
-sudo pip install tensorflow==1.5 
-sudo pip install pandas
 sudo pip install matplotlib
 sudo apt-get install python-tk
 sudo pip install scikit-image